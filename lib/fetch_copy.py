@@ -2,43 +2,45 @@
 
 import logging
 from shutil import move
-from win32file import CreateFile, CloseHandle
-from win32con import GENERIC_READ, GENERIC_WRITE, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL
+from uvsync_ready import UVSyncReadinessTracker, has_exclusive_access
 
-_log = logging.getLogger("uvsync")
-
-def has_exclusive_access(filename):
-    
-    # Check if we have exclusive access to a file
-    try:
-        handle = CreateFile(str(filename), GENERIC_READ | GENERIC_WRITE, 0, None, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, None)
-        CloseHandle(handle)
-    except:
-        return False            
-    return True
+_log = logging.getLogger("uvsync.fetch")
 
 def fetch(ctx):
     
-    # Copy files from directory_inbox to directory_work filtered on expression match_expression
+    # Copy files from directory_inbox to directory_work filtered on expression match_expression.
+    # Files that are still being written are left in the inbox until a later run, see uvsync_ready.py
     
-    _log.info("Processing directory " + str(ctx.directory_inbox) + " with expression " + ctx.match_expression)
+    _log.info("Processing directory %s with expression %s", ctx.directory_inbox, ctx.match_expression)
     
-    # Get list of files in inbox for this instrument
-    ifiles = ctx.directory_inbox.glob(ctx.match_expression)
+    # Get list of files in inbox for this instrument, from the directory index if the run has one
+    ifiles = ctx.inbox_files if ctx.inbox_files is not None else ctx.directory_inbox.glob(ctx.match_expression)
     ifiles_sorted = sorted(ifiles)
 
+    # Load the state of the files seen in earlier runs
+    tracker = UVSyncReadinessTracker(ctx.directory_manifest / ("ready_%d.json" % ctx.instrument_id), ctx.ready_check, ctx.ready_stable_seconds, ctx.written_files)
+    tracker.prune(ifiles_sorted)
+
     # Copy each file to the work directory
     for fin in ifiles_sorted:
         try:
-            # If we don't have full access to the file, skip it for now
-            if not has_exclusive_access(fin):
-                _log.info("Unable to aquire exclusive access to " + str(fin))
+            # If the file is still being written, skip it for now
+            if not tracker.is_ready(fin):
+                _log.info("File %s is not ready, skipping it for now", fin)
+                ctx.metrics["files_deferred"] += 1
                 continue            
 
             # Trim of any 'A' at the beginning of the filename before moving it
             fwork = ctx.directory_work / fin.name[1:] if fin.name.startswith('A') else ctx.directory_work / fin.name            
-            _log.info("Moving from " + str(fin) + " to " + str(fwork))
+            _log.info("Moving from %s to %s", fin, fwork)
             move(fin, fwork)            
+            tracker.remove(fin)
+
+            # Add the file to the work files of the index, so the validate module finds it without listing the directory
+            if ctx.work_files is not None and fwork not in ctx.work_files:
+                ctx.work_files.append(fwork)
 
         except Exception as ex:
-            _log.error(str(ex), exc_info=True)
\ No newline at end of file
+            _log.error(str(ex), exc_info=True)
+
+    tracker.save()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import logging, csv
+from uvsync_ledger import UVSyncLedger, UVSyncLedgerReader, may_grow
+from uvsync_storage import create_storage
+from uvsync_columnstore import UVSyncColumnStore, UVSyncColumnStoreStorage
+from uvsync_archive import UVSyncArchive
+from uvsync_retry import fail_file, clear_file
+from uvsync_columnar import read_columns
+from uvsync_format import UVSyncFormatException, get_format
+from datetime import datetime
+
+_log = logging.getLogger("uvsync.store")
+
+def store(ctx, connections):
+    
+    # Function used to read and store data in downloaded UV log files for a speciffic instrument.
+    # The instrument and station info is stored in the ctx (UVSyncContext) parameter, and the layout
+    # of the files is given by the format ctx.format_name (see uvsync_format.py).
+    # The connections parameter is the connection manager of the run (see uvsync_db.py).
+    # Up to ctx.store_files_per_transaction files are stored in one transaction, with a savepoint
+    # around each file so a file that fails can be rolled back on its own
+    
+    storage = None
+
+    try:        
+        if ctx.format_name is None:
+            raise UVSyncFormatException("No format found for instrument " + ctx.instrument_name)
+
+        storage = create_storage(ctx, connections)
+
+        # If a column store is used, the committed measurements are also written to local files, and aggregated
+        # for each of ctx.aggregate_resolutions (see uvsync_columnstore.py). uvsync.load_settings checks that
+        # aggregate_resolutions is only set with column_store
+        if ctx.column_store:
+            storage = UVSyncColumnStoreStorage(storage, UVSyncColumnStore(ctx.column_store), ctx.aggregate_resolutions)
+
+        # Archive used to move stored files to the outbox directory
+        archive = UVSyncArchive(ctx.directory_outbox, ctx.archive_compression, ctx.archive_bundle)
+
+        # If an ingestion ledger is used, only the rows added to a file since it was last stored are sent to the database
+        ledger = UVSyncLedger(ctx.ingestion_ledger) if ctx.ingestion_ledger else None
+
+        # Files stored in the current transaction, with the ledger position of each file
+        stored_files = []
+        
+        # The files to read and store in the database has been added to the ctx.sync_files 
+        # list earlier by the validate function
+        for file in ctx.sync_files:
+            savepoint = "file_%d" % len(stored_files)
+            try:
+                _log.info("Storing data from file %s", file)
+                storage.savepoint(savepoint)
+                offset = None
+                last_timestamp = None
+                if ledger is not None:
+                    with file.open('rb') as fb:
+                        offset = ledger.get_offset(ctx, file)
+                        if offset:
+                            _log.info("Skipping the first %d bytes already ingested from file %s", offset, file)
+                        fd = UVSyncLedgerReader(fb, offset, complete = not may_grow(file))
+                        # Call the 'store_file_fast' function to store the new rows of a speciffic file
+                        last_timestamp = store_file_fast(storage, fd, ctx)
+                        offset = fd.offset
+                else:
+                    with file.open() as fd:
+                        # Call the 'store_file_fast' function to store a speciffic file
+                        store_file_fast(storage, fd, ctx)
+                storage.release_savepoint(savepoint)
+                stored_files.append((file, offset, last_timestamp))
+
+            except Exception as ex:
+                # Discard any changes made to the database for this file
+                _log.info("Rolling back data from file %s", file)
+                _log.error(str(ex), exc_info=True)
+                try:
+                    storage.rollback_to_savepoint(savepoint)
+                except Exception as ex:
+                    # The whole transaction is lost, leave the files stored in it in the work directory for the next run
+                    _log.error("Unable to roll back to savepoint, rolling back %d files: %s", len(stored_files), ex)
+                    storage.rollback()
+                    stored_files = []
+                # Move the stored file from the work directory to the failed directory, to be retried if the error may be temporary
+                fail_file(ctx, file, "store", ex)
+
+            if len(stored_files) >= ctx.store_files_per_transaction:
+                commit_files(storage, ledger, archive, stored_files, ctx)
+                stored_files = []
+
+        if len(stored_files):
+            commit_files(storage, ledger, archive, stored_files, ctx)
+
+    except Exception as ex:
+        _log.error(str(ex), exc_info=True)
+    finally:
+        if storage is not None:
+            storage.close()
+
+def commit_files(storage, ledger, archive, stored_files, ctx):
+
+    # Function used to commit the files stored in the current transaction and move them to the outbox directory,
+    # compressed or bundled as given by the archive (see uvsync_archive.py)
+
+    try:
+        # If everything went well, commit the data inserted to the database
+        _log.info("Committing data from %d files", len(stored_files))
+        storage.commit()
+    except Exception as ex:
+        # Leave the files in the work directory, so they are stored again on the next run
+        _log.error("Unable to commit data from %d files: %s", len(stored_files), ex, exc_info=True)
+        storage.rollback()
+        return
+
+    for file, offset, last_timestamp in stored_files:
+        try:
+            # Record how far the file has been ingested, now that the rows are committed
+            if ledger is not None:
+                ledger.update(ctx, file, offset, last_timestamp)
+
+            # Move the stored file from the work directory to the outbox directory
+            archive.archive(file, ctx.station_name)
+            clear_file(ctx, file)
+            ctx.metrics["files_stored"] += 1
+
+        except Exception as ex:
+            _log.error(str(ex), exc_info=True)
+
+def store_file(storage, fd, ctx):
+    
+    # Function used to read and store a speciffic UV log file, one row at a time
+
+    fmt = get_format(ctx.format_name)
+    key = (ctx.station_id, ctx.instrument_id, ctx.principal)
+    values = fmt.values
+    
+    insert_count = 0
+
+    rows = read_rows(fd, ctx)
+    if fmt.accept is not None:
+        rows = filter(fmt.accept, rows)
+
+    for row, dt in rows:
+
+        if dt is None:
+            dt = datetime.strptime(fmt.timestamp(row), fmt.timestamp_format)
+        storage.load_measurements([key + (dt,) + values(row)])
+        insert_count += 1
+    
+    _log.info("A total of %d lines inserted/updated", insert_count)
+    ctx.metrics["rows_inserted"] += insert_count
+
+def read_rows(fd, ctx):
+
+    # Generator used to read the rows of a speciffic UV log file, yielding each row with its date/time.
+    # In fused mode the rows come from the validate module, which validates each row as it streams past and
+    # passes on the date/time it has already parsed. Otherwise the header is skipped and the date/time is
+    # left as None, to be parsed only for the rows that are stored
+
+    if ctx.fused_validate_store:
+        yield from ctx.validate_module.iter_rows(fd, ctx)
+        return
+
+    csv_reader = csv.reader(fd, delimiter=',')
+    next(csv_reader, None)
+    for row in csv_reader:
+        yield row, None
+
+def store_file_fast(storage, fd, ctx):
+    
+    # Function used to read and store a speciffic UV log file using batch insert for speed.
+    # The rows are written through the storage backend (see uvsync_storage.py).
+    # If ctx.store_batch_size is set, the rows are sent in batches of that size while the file is being read,
+    # so memory use stays bounded for large files. All batches are part of the same transaction.
+    # The rows to store are selected by the filter of the format, and the values to store are
+    # taken from each row with the compiled extractors of the format, so the loop is the same for all formats
+
+    fmt = get_format(ctx.format_name)
+    key = (ctx.station_id, ctx.instrument_id, ctx.principal)
+    values = fmt.values
+    timestamp = fmt.timestamp
+    timestamp_format = fmt.timestamp_format
+    batch_size = ctx.store_batch_size
+    
+    # Cache list to preload parameters into memory
+    sqlparams = []
+
+    line_count = 0
+    insert_count = 0
+    last_timestamp = None
+
+    def flush(sqlparams):
+
+        # Insert rows as a batch job
+        nonlocal insert_count, last_timestamp
+        if len(sqlparams):
+            storage.load_measurements(sqlparams)
+            insert_count += len(sqlparams)
+            last_timestamp = sqlparams[-1][3]
+
+    def count(rows):
+
+        # Count the rows read before they are filtered
+        nonlocal line_count
+        for line_count, pair in enumerate(rows, 1):
+            yield pair
+
+    if ctx.columnar_parser:
+        # Read and validate the whole file as NumPy arrays, and select the rows to store with a boolean mask
+        columns = read_columns(fd, fmt.column_count, fmt.mode, fmt.timestamp_column, fmt.channel_columns)
+        line_count = columns.count
+        if fmt.filter_column is not None:
+            columns = columns.select(columns.mask(fmt.filter_column, fmt.filter_values))
+        batch_size = batch_size or max(columns.count, 1)
+        for start in range(0, columns.count, batch_size):
+            flush(columns.measurements(ctx, fmt.aux_columns, start, start + batch_size))
+    else:
+        rows = count(read_rows(fd, ctx))
+        if fmt.accept is not None:
+            rows = filter(fmt.accept, rows)
+
+        # Read the csv file line by line
+        for row, dt in rows:
+
+            if dt is None:
+                dt = datetime.strptime(timestamp(row), timestamp_format)
+            sqlparams.append(key + (dt,) + values(row))
+
+            # Send a full batch and start on a new one
+            if len(sqlparams) == batch_size:
+                flush(sqlparams)
+                sqlparams = []
+
+        flush(sqlparams)
+
+    _log.info("A total of %d lines processed", line_count)
+    _log.info("A total of %d lines inserted/updated", insert_count)
+    ctx.metrics["rows_parsed"] += line_count
+    ctx.metrics["rows_inserted"] += insert_count
+
+    # Return the date/time of the last row stored
+    return last_timestamp
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import logging, csv
+from uvsync_columnar import UVSyncColumnarException, read_columns
+from uvsync_format import get_format
+from uvsync_retry import fail_file, register_permanent
+from uvsync_ledger import UVSyncLedgerReader, may_grow
+from datetime import datetime
+
+_log = logging.getLogger("uvsync.validate")
+
+class UVSyncValidateFormatException(Exception):
+    
+    # Exception class used to report invalid UV log files
+    
+    pass
+
+# Invalid files are not retried (see uvsync_retry.py)
+register_permanent(UVSyncValidateFormatException)
+
+def validate(ctx):
+    
+    # Function used to validate data in downloaded UV log files for a speciffic instrument.
+    # The instrument and station info is stored in the ctx (UVSyncContext) parameter, and the layout
+    # of the files is given by the format ctx.format_name (see uvsync_format.py).
+    # Invalid files are moved to the 'failed' folder, valid files are added to the ctx.sync_list list
+    
+    try:
+        if ctx.format_name is None:
+            raise UVSyncValidateFormatException("No format found for instrument " + ctx.instrument_name)
+
+        # Get filenames for this instrument, from the directory index if the run has one
+        work_files = list(ctx.work_files) if ctx.work_files is not None else ctx.directory_work.glob(ctx.match_expression)
+
+        for file in work_files:
+            try:
+                # In fused mode the rows are validated by the store module while they are stored, see 'iter_rows'
+                if ctx.fused_validate_store:
+                    _log.info("Adding %s to sync list, validation deferred to store", file)
+                    ctx.sync_files.append(file)
+                    continue
+
+                _log.info("Validating data from file %s", file)                
+
+                # Open the file and call the 'validate_file' function for each speciffic file found.
+                # With an ingestion ledger a partial last line of a file that may grow is left out, as the store module does (see uvsync_ledger.py)
+                if ctx.ingestion_ledger:
+                    with file.open('rb') as fb:
+                        validate_file(UVSyncLedgerReader(fb, 0, complete = not may_grow(file)), ctx)
+                else:
+                    with file.open() as fd:                        
+                        validate_file(fd, ctx)
+
+                _log.info("Adding %s to sync list", file)
+                # Add filename to the list of files to be inserted into the database
+                ctx.sync_files.append(file)
+                ctx.metrics["files_validated"] += 1
+
+            except UVSyncValidateFormatException as ex:
+                # Validation failed, move file to 'failed' folder
+                _log.info("[FAILED] %s", ex) 
+                fail_file(ctx, file, "validate", ex)
+            except Exception as ex:
+                # Some error occurred, move file to 'failed' folder
+                _log.error("[FAILED]%s", ex, exc_info=True)                 
+                fail_file(ctx, file, "validate", ex)
+
+    except Exception as ex:
+        _log.error(str(ex), exc_info=True) 
+
+def validate_file(fd, ctx):
+    
+    # Function used to validate a speciffic UV log file
+
+    # Validate the whole file in one vectorized step if the columnar parser is used
+    if ctx.columnar_parser:
+        fmt = get_format(ctx.format_name)
+        try:
+            read_columns(fd, fmt.column_count, fmt.mode, fmt.timestamp_column, fmt.channel_columns)
+        except UVSyncColumnarException as ex:
+            raise UVSyncValidateFormatException(str(ex))
+        return
+    
+    for row, dt in iter_rows(fd, ctx):
+        pass
+
+def iter_rows(fd, ctx):
+
+    # Generator used to validate a speciffic UV log file row by row.
+    # Each valid row is yielded together with its parsed date/time, so the store module can use the rows
+    # as they stream past without parsing the file a second time. An exception is raised on the first invalid row
+
+    fmt = get_format(ctx.format_name)
+    column_count = fmt.column_count
+    mode = fmt.mode
+    timestamp = fmt.timestamp
+    timestamp_format = fmt.timestamp_format
+    
+    line_count = 0
+
+    # Read csv file line by line
+    csv_reader = csv.reader(fd, delimiter=',')    
+
+    for row in csv_reader:
+
+        line_count += 1
+
+        # Skip first row (header)
+        if line_count == 1:
+            continue        
+
+        # Check number of columns in this row
+        ncol = len(row)
+        if ncol != column_count:
+            raise UVSyncValidateFormatException("Number of columns is wrong, got " + str(ncol) + ", should be " + str(column_count))
+
+        # Check Measurement Mode in this row
+        if row[0] != mode:
+            raise UVSyncValidateFormatException("Mode is wrong, got " + str(row[0]) + ", should be " + mode)
+
+        # Check for a valid date/time
+        try:
+            dt = datetime.strptime(timestamp(row), timestamp_format)
+        except Exception:
+            raise UVSyncValidateFormatException("Invalid datetime on line " + str(line_count))
+
+        yield row, dt
@@ -1,81 +1,287 @@
 # -*- coding: utf-8 -*-
 
-import os, sys, pyodbc, configparser, pidfile
-import uvsync_log
+import os, sys, time, logging, argparse, configparser, pidfile
+import uvsync_log, uvsync_profile, uvsync_ready
 from pathlib import Path
-from uvsync_ftp import UVSyncFTPException, UVSyncFTP
-from uvsync_context import UVSyncContextException, UVSyncContext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from uvsync_ftp import UVSyncFTPException
+from uvsync_context import UVSyncContextException
+from uvsync_db import UVSyncConnectionManager
+from uvsync_metrics import UVSyncMetrics
+from uvsync_index import UVSyncDirectoryIndex
+from uvsync_catalog import UVSyncCatalog
+from uvsync_retry import prepare_retries
+from uvsync_lease import UVSyncLeases, UVSyncDirectoryLeaseStore, UVSyncDatabaseLeaseStore, station_resource, default_node
 from datetime import date
 
 # Exit codes for this program
 class ExitStatus: Success, Running, Error = range(3)
 
-def main(log):
+def run_context(ctx, connections):
+
+    # Run the fetch, validate and store stages for a speciffic instrument.
+    # This function is used both serially and by the thread and process worker pools.
+    # Returns the metrics of the context, with the wall time of each stage
+
+    # The messages of each stage are logged by the log object of the stage, so log_level_<stage> applies to them
+    log = logging.getLogger("uvsync")
+
+    ctx.reset()
+
+    # Each stage is profiled when uvsync runs with --profile (see uvsync_profile.py)
+    log.getChild("fetch").info("Fetching data for instrument %d|%s", ctx.instrument_id, ctx.instrument_name)
+    t0 = time.perf_counter()
+    with uvsync_profile.profile("fetch", ctx.instrument_name):
+        ctx.fetch_module.fetch(ctx)
+    ctx.metrics["fetch_seconds"] = time.perf_counter() - t0
+
+    log.getChild("validate").info("Validating data for instrument %d|%s at station %s", ctx.instrument_id, ctx.instrument_name, ctx.station_name)
+    t0 = time.perf_counter()
+    with uvsync_profile.profile("validate", ctx.instrument_name):
+        ctx.validate_module.validate(ctx)
+    ctx.metrics["validate_seconds"] = time.perf_counter() - t0
+
+    log.getChild("store").info("Storing data for instrument %d|%s for station %s", ctx.instrument_id, ctx.instrument_name, ctx.station_name)
+    t0 = time.perf_counter()
+    with uvsync_profile.profile("store", ctx.instrument_name):
+        ctx.store_module.store(ctx, connections)
+    ctx.metrics["store_seconds"] = time.perf_counter() - t0
+
+    return ctx.metrics
+
+def download_station(log, station, currdate):
+
+    # Download the files of a speciffic station, used by the one-shot run and by the daemon.
+    # The download is profiled when uvsync runs with --profile
+
+    with uvsync_profile.profile("download", station.station_name):
+        return station.download(log.getChild("download"), currdate)
+
+def init_worker(queue, levels, profile = None):
+
+    # Initialize logging in a worker process, so records are written by the main process,
+    # and profiling if the main process profiles the run
+
+    uvsync_log.init_worker_log("uvsync", queue, levels)
+    uvsync_profile.init_worker_profile(profile)
+
+class UVSyncSettings():
+
+    # Define a class used to hold the settings read from config.ini, shared by the one-shot run and the daemon
+
+    def __init__(self):
+
+        # Constructor, initialize all member variables
+
+        self.config = None
+        self.connection_string = None
+        self.uvsync_directory = None
+        self.download_workers = None
+        self.pipeline_workers = None
+        self.pipeline_executor = None
+
+def load_settings(log, config_file = None):
+
+    # Function used to read and check config.ini and to create the uvsync directories.
+    # The config file defaults to config.ini in the script directory
+
+    settings = UVSyncSettings()
+
+    script_dir = Path(__file__).parent.absolute()
+    log.info("Using script directory: %s", script_dir)         
+
+    config_file = Path(config_file) if config_file else script_dir / "config.ini"
+    if not config_file.exists():
+        raise Exception("No config file found (%s)" % config_file)
+    log.info("Using config file: %s", config_file) 
+
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    settings.config = config
+
+    # Apply the log format and the log level of each stage
+    uvsync_log.configure_log(log.name, config['General'])
+    
+    settings.connection_string = config['General']['connection_string']
+    log.info("Connection_string loaded") 
     
-    # Main function for verifying and storing downloaded UV log files in the database    
+    settings.uvsync_directory = config['General']['uvsync_directory']
+    log.info("Using uvsync directory: %s", settings.uvsync_directory)
 
-    config = None
-    connection_string = None
-    uvsync_directory = None
-    connection = None    
+    # Number of stations to download from at the same time
+    settings.download_workers = config['General'].getint('download_workers', fallback = 4)
+    if settings.download_workers < 1:
+        raise Exception("Invalid download_workers in config file (%d)" % settings.download_workers)
+    log.info("Using %d download workers", settings.download_workers)
 
-    try:
-        script_dir = Path(__file__).parent.absolute()
-        log.info("Using script directory: %s" % script_dir)         
+    # Number of instruments to fetch, validate and store at the same time, and the type of worker pool to use
+    settings.pipeline_workers = config['General'].getint('pipeline_workers', fallback = 1)
+    if settings.pipeline_workers < 1:
+        raise Exception("Invalid pipeline_workers in config file (%d)" % settings.pipeline_workers)
+    settings.pipeline_executor = config['General'].get('pipeline_executor', fallback = 'thread')
+    if settings.pipeline_executor not in ('thread', 'process'):
+        raise Exception("Invalid pipeline_executor in config file (%s)" % settings.pipeline_executor)
+    log.info("Using %d pipeline workers (%s)", settings.pipeline_workers, settings.pipeline_executor)
 
-        config_file = script_dir / "config.ini"        
-        if not config_file.exists():
-            raise Exception("No config file found (%s)" % config_file)
-        log.info("Using config file: %s" % config_file) 
+    # The aggregates are computed from the measurements in the column store (see uvsync_columnstore.py)
+    if config['General'].get('aggregate_resolutions', fallback = '').strip() and not config['General'].get('column_store', fallback = None):
+        raise Exception("aggregate_resolutions in config file requires column_store")
+    
+    # Create uvsync directories if they don't already exists
+    log.info("Creating directories under %s", settings.uvsync_directory)
+    directory_inbox = Path(settings.uvsync_directory) / "inbox"
+    directory_work = Path(settings.uvsync_directory) / "work"
+    directory_outbox = Path(settings.uvsync_directory) / "outbox"
+    directory_failed = Path(settings.uvsync_directory) / "failed"
+    directory_manifest = Path(settings.uvsync_directory) / "manifest"
 
-        config = configparser.ConfigParser()
-        config.read(config_file)
-        
-        connection_string = config['General']['connection_string']
-        log.info("Connection_string loaded") 
-        
-        uvsync_directory = config['General']['uvsync_directory']
-        log.info("Using uvsync directory: " + uvsync_directory)
-        
-        # Create uvsync directories if they don't already exists
-        log.info("Creating directories under %s" % uvsync_directory)
-        directory_inbox = Path(uvsync_directory) / "inbox"
-        directory_work = Path(uvsync_directory) / "work"
-        directory_outbox = Path(uvsync_directory) / "outbox"
-        directory_failed = Path(uvsync_directory) / "failed"
-
-        os.makedirs(directory_inbox, exist_ok = True)
-        os.makedirs(directory_work, exist_ok = True)
-        os.makedirs(directory_outbox, exist_ok = True)
-        os.makedirs(directory_failed, exist_ok = True)
-        
+    os.makedirs(directory_inbox, exist_ok = True)
+    os.makedirs(directory_work, exist_ok = True)
+    os.makedirs(directory_outbox, exist_ok = True)
+    os.makedirs(directory_failed, exist_ok = True)
+    os.makedirs(directory_manifest, exist_ok = True)
+
+    return settings
+
+def create_connections(settings):
+
+    # Create the connection manager used for all database access during a run
+
+    return UVSyncConnectionManager(settings.connection_string,
+        pool_size = settings.config['General'].getint('db_pool_size', fallback = 4),
+        connect_retries = settings.config['General'].getint('db_connect_retries', fallback = 3),
+        connect_backoff = settings.config['General'].getfloat('db_connect_backoff', fallback = 2.0))
+
+def create_catalog(settings, connections):
+
+    # Create the catalog of stations and instruments, saved in the file given by catalog_cache in config.ini (see uvsync_catalog.py)
+
+    return UVSyncCatalog(connections, settings.config['General'].get('catalog_cache', fallback = None),
+        ttl = settings.config['General'].getfloat('catalog_ttl', fallback = 3600.0),
+        version_query = settings.config['General'].get('catalog_version_query', fallback = None))
+
+def create_leases(settings, connections, node = None):
+
+    # Create the leases used to share the stations with other nodes, as given by lease_backend in config.ini
+    # (see uvsync_lease.py). Returns None if this node handles all stations
+
+    options = settings.config['General']
+    backend = options.get('lease_backend', fallback = 'none')
+    if backend == 'none':
+        return None
+    if backend == 'directory':
+        lease_directory = options.get('lease_directory', fallback = None)
+        if not lease_directory:
+            raise Exception("No lease_directory in config file")
+        store = UVSyncDirectoryLeaseStore(lease_directory)
+    elif backend == 'database':
+        store = UVSyncDatabaseLeaseStore(connections)
+    else:
+        raise Exception("Invalid lease_backend in config file (%s)" % backend)
+
+    node = node or options.get('node_name', fallback = None) or default_node()
+    return UVSyncLeases(store, node, options.getfloat('lease_duration', fallback = 600.0), options.getfloat('lease_settle_seconds', fallback = 10.0))
+
+def main(log, config_file = None, node = None):
+    
+    # Main function for verifying and storing downloaded UV log files in the database.
+    # The config file defaults to config.ini in the script directory.
+    # With lease_backend in config.ini, only the stations this node holds leases on are handled
+
+    settings = None
+    connections = None
+    catalog = None
+    leases = None
+
+    try:
+        settings = load_settings(log, config_file)
+        connections = create_connections(settings)
+        catalog = create_catalog(settings, connections)
+        leases = create_leases(settings, connections, node)
     except Exception as ex:
         log.error(str(ex), exc_info=True)
         return ExitStatus.Error    
     
-    try:                     
-        # List to store active stations from the database
-        stations = []
+    metrics = UVSyncMetrics()
+    status = ExitStatus.Error
 
-        try:
-            # Get active stations from the database            
-            connection = pyodbc.connect(connection_string, autocommit = False)
-            cursor = connection.cursor()
-            cursor.execute("exec select_station_infos")
-            for station_info in cursor.fetchall():
-                log.info("Creating station %d|%s" % (station_info.id, station_info.label))
-                station = UVSyncFTP(station_info, uvsync_directory)                
-                stations.append(station)
-        finally:
-            if connection is not None:
-                connection.close()    
+    try:
+        stations = None
+        if leases is not None:
+            stations = assign_leases(log, leases, catalog, settings.uvsync_directory)
+            if stations is None:
+                return status
+            leases.start()
+
+        status = download_stations(log, catalog, settings.uvsync_directory, settings.download_workers, metrics, stations)
+        if status == ExitStatus.Success:
+            status = synchronize_instruments(log, connections, catalog, settings.config, settings.uvsync_directory, settings.pipeline_workers, settings.pipeline_executor, metrics, leases)
+        return status
+    finally:
+        # The leases are kept until they expire, so this node gets the same stations on the next run
+        if leases is not None:
+            leases.stop()
+        connections.close()
+        write_metrics(log, settings.config, metrics, status)
+
+def assign_leases(log, leases, catalog, uvsync_directory):
+
+    # Function used to claim this node's share of the stations, after waiting for other nodes started at the same time
+    # (see UVSyncLeases.settle). Returns the stations this node holds leases on, None on error
+
+    try:
+        stations = create_stations(log, catalog, uvsync_directory)
+        leases.settle(log, [station_resource(station.station_id) for station in stations])
+        return leases.select(stations)
+    except Exception as ex:
+        log.error("Unable to claim leases: %s", ex, exc_info=True)
+        return None
+
+def write_metrics(log, config, metrics, status):
+
+    # Function used to write the metrics of the run to the files given by metrics_json and metrics_prometheus in config.ini
+
+    metrics.finish(status)
+    try:
+        metrics_json = config['General'].get('metrics_json', fallback = None)
+        if metrics_json:
+            log.info("Writing run report to %s", metrics_json)
+            metrics.write_json(metrics_json)
+        metrics_prometheus = config['General'].get('metrics_prometheus', fallback = None)
+        if metrics_prometheus:
+            log.info("Writing Prometheus metrics to %s", metrics_prometheus)
+            metrics.write_prometheus(metrics_prometheus)
+    except Exception as ex:
+        log.error("Unable to write metrics: %s", ex, exc_info=True)
+
+def create_stations(log, catalog, uvsync_directory):
+
+    # Function used to get all active stations from the catalog, as a list of UVSyncFTP objects.
+    # The catalog is read from the database if it is older than catalog_ttl
+
+    catalog.refresh(log)
+    return catalog.get_stations(log, uvsync_directory)
+
+def download_stations(log, catalog, uvsync_directory, download_workers, metrics, stations = None):
+
+    # Function used to download UV log files from all active stations, or from the given stations
+
+    try:                     
+        # Get active stations from the catalog, saved from the database
+        if stations is None:
+            stations = create_stations(log, catalog, uvsync_directory)
 
         # Create formatted date string of today, used later to check if a file is from today or not
         currdate = date.today().strftime("%y%m%d")
 
-        # Call the download function for each station
-        for station in stations:            
-            station.download(log, currdate)            
+        # Call the download function for each station, using one FTP session per station
+        with ThreadPoolExecutor(max_workers = download_workers) as executor:
+            results = list(executor.map(lambda station: download_station(log, station, currdate), stations))
+
+        # Log a summary of the downloads for each station
+        for result in results:
+            log.info("Download summary for station %s", result)
+            metrics.add_station(result)
     
     except UVSyncFTPException as ex:
         log.error(str(ex))
@@ -84,36 +290,155 @@ def main(log):
         log.error(str(ex), exc_info=True)
         return ExitStatus.Error    
     
-    try:                                    
-        sync_contexts = []        
+    return ExitStatus.Success
 
-        # Get all active instruments from the database and store them as a list of contexts
-        try:
-            connection = pyodbc.connect(connection_string, autocommit = False)
-            cursor = connection.cursor()
-            cursor.execute("exec select_instrument_contexts")
-            for instrument in cursor.fetchall():
-                log.info("Creating sync context for instrument %d|%s" % (instrument.instrument_id, instrument.instrument_name))
-                ctx = UVSyncContext(instrument, uvsync_directory)
-                sync_contexts.append(ctx)
-        finally:            
-            if connection is not None:
-                connection.close()        
-
-        # Execute the fetch function for each instrument
-        for ctx in sync_contexts:
-            log.info("Fetching data for instrument %d|%s" % (ctx.instrument_id, ctx.instrument_name))
-            ctx.fetch_module.fetch(ctx) # run in parallel
+def create_contexts(log, catalog, config, uvsync_directory):
+
+    # Function used to get all active instruments from the catalog, as a list of contexts.
+    # The catalog is read from the database if it is older than catalog_ttl
+
+    catalog.refresh(log)
+    return catalog.get_contexts(log, config, uvsync_directory)
+
+def index_directories(log, sync_contexts, uvsync_directory, metrics):
 
-        # Execute the validate function for each instrument
+    # Function used to list the inbox and work directories once for all contexts, and to give each context
+    # the files matching its match_expression. Files matching no instrument, or several, are reported.
+    # If a directory can't be listed, the fetch and validate modules list the directories themselves
+
+    try:
+        inbox = UVSyncDirectoryIndex(Path(uvsync_directory) / "inbox", sync_contexts)
+        work = UVSyncDirectoryIndex(Path(uvsync_directory) / "work", sync_contexts)
+    except Exception as ex:
+        log.error("Unable to index directories: %s", ex, exc_info=True)
         for ctx in sync_contexts:
-            log.info("Validating data for instrument %d|%s at station %s" % (ctx.instrument_id, ctx.instrument_name, ctx.station_name))
-            ctx.validate_module.validate(ctx) # run in parallel        
+            ctx.inbox_files = None
+            ctx.work_files = None
+        return
+
+    for name, index in (("inbox", inbox), ("work", work)):
+        log.info("Indexed %d files in %s, %d without instrument, %d with several instruments",
+            index.count, index.directory, len(index.unmatched), len(index.ambiguous))
+        for path in index.unmatched:
+            log.getChild("fetch").info("No instrument matches file %s", path)
+        for path, matches in index.ambiguous:
+            log.error("File %s matches several instruments (%s), using %s",
+                path, ", ".join(ctx.instrument_name for ctx in matches), matches[0].instrument_name)
+        metrics.add_directory(name, index)
+
+    for ctx in sync_contexts:
+        ctx.inbox_files = inbox.get_files(ctx)
+        ctx.work_files = work.get_files(ctx)
+
+def create_executor(log, pipeline_workers, pipeline_executor):
+
+    # Function used to create the pool of workers used by run_contexts.
+    # Returns the executor, or None if instruments are run one at a time, and the log listener
+    # used by worker processes, or None
 
-        # Execute the store function for each instrument
+    if pipeline_workers == 1:
+        return None, None
+
+    listener = None
+    if pipeline_executor == 'process':
+        queue, listener = uvsync_log.create_worker_queue(log)
+        listener.start()
+        executor = ProcessPoolExecutor(max_workers = pipeline_workers, initializer = init_worker, initargs = (queue, uvsync_log.get_levels(log.name), uvsync_profile.get_settings()))
+    else:
+        executor = ThreadPoolExecutor(max_workers = pipeline_workers)
+    return executor, listener
+
+def run_contexts(log, connections, sync_contexts, executor, metrics):
+
+    # Function used to run the fetch, validate and store stages for each context, either one instrument at a time
+    # or independently for each instrument in a pool of workers
+
+    status = ExitStatus.Success
+
+    # Files downloaded by this process are ready to be fetched at once (see uvsync_ready.py)
+    written = uvsync_ready.get_written()
+    for ctx in sync_contexts:
+        ctx.written_files = written
+
+    if executor is None:
         for ctx in sync_contexts:
-            log.info("Storing data for instrument %d|%s for station %s" % (ctx.instrument_id, ctx.instrument_name, ctx.station_name))
-            ctx.store_module.store(ctx, connection_string) # run in parallel        
+            try:
+                metrics.add_instrument(ctx, run_context(ctx, connections))
+            except UVSyncContextException as ex:
+                log.error(str(ex))
+                status = ExitStatus.Error
+            except Exception as ex:
+                log.error(str(ex), exc_info=True)
+                status = ExitStatus.Error
+    else:
+        futures = { executor.submit(run_context, ctx, connections): ctx for ctx in sync_contexts }
+        for future, ctx in futures.items():
+            try:
+                metrics.add_instrument(ctx, future.result())
+            except UVSyncContextException as ex:
+                log.error(str(ex))
+                status = ExitStatus.Error
+            except Exception as ex:
+                log.error(str(ex), exc_info=True)
+                status = ExitStatus.Error
+
+    return status
+
+def retry_failed(log, connections, sync_contexts, config, executor, metrics):
+
+    # Function used to move the files in the failed directory that are due for a retry back to the work directory,
+    # and to validate and store them again, in parallel for each instrument if a pool of workers is used.
+    # Files that fail again get a longer wait before the next retry (see uvsync_retry.py).
+    # Returns the scan of the failed directory, None on error
+
+    try:
+        batch_size = config['General'].getint('retry_batch_size', fallback = 100)
+        scan, contexts = prepare_retries(log, sync_contexts, batch_size)
+        if scan is None:
+            return None
+        log.info("Failed files: %d due for retry, %d waiting, %d invalid, %d without retry information",
+            sum(len(files) for files in scan.due.values()), scan.waiting, scan.permanent, scan.unknown)
+
+        retried = 0
+        if len(contexts):
+            retried = sum(len(ctx.work_files) for ctx in contexts)
+            log.info("Retrying %d failed files for %d instruments", retried, len(contexts))
+            run_contexts(log, connections, contexts, executor, UVSyncMetrics())
+        metrics.add_retry(scan, retried)
+        return scan
+
+    except Exception as ex:
+        log.error("Unable to retry failed files: %s", ex, exc_info=True)
+        return None
+
+def synchronize_instruments(log, connections, catalog, config, uvsync_directory, pipeline_workers, pipeline_executor, metrics, leases = None):
+
+    # Function used to fetch, validate and store UV log files for all active instruments,
+    # or for the instruments of the stations this node holds leases on
+
+    try:                                    
+        # Get all active instruments from the database and store them as a list of contexts
+        sync_contexts = create_contexts(log, catalog, config, uvsync_directory)
+
+        # List the inbox and work directories once for all instruments
+        index_directories(log, sync_contexts, uvsync_directory, metrics)
+
+        # The directories are indexed for all instruments, so files of instruments handled by other nodes are not reported
+        if leases is not None:
+            sync_contexts = leases.select(sync_contexts)
+
+        executor, listener = create_executor(log, pipeline_workers, pipeline_executor)
+        try:
+            status = run_contexts(log, connections, sync_contexts, executor, metrics)
+
+            # Retry the files in the failed directory that are due
+            retry_failed(log, connections, sync_contexts, config, executor, metrics)
+            return status
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if listener is not None:
+                listener.stop()
     
     except UVSyncContextException as ex:
         log.error(str(ex))
@@ -121,16 +446,32 @@ def main(log):
     except Exception as ex:
         log.error(str(ex), exc_info=True)
         return ExitStatus.Error
-    
-    return ExitStatus.Success
 
 if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Download UV log files from all stations and store them in the database")
+    parser.add_argument("--daemon", action = "store_true", help = "keep running and process new files as they arrive (see uvsync_daemon.py)")
+    parser.add_argument("--node", help = "name of this node when stations are shared by leases, needed to run several nodes on one host (see uvsync_lease.py)")
+    parser.add_argument("--profile", metavar = "DIRECTORY", help = "profile each stage with cProfile, and write the profiles and a summary to DIRECTORY (see uvsync_profile.py)")
+    parser.add_argument("--profile-sample", type = float, default = 1.0, metavar = "RATE", help = "fraction of the downloads and instruments to profile (default: 1)")
+    parser.add_argument("--profile-memory", action = "store_true", help = "also trace allocations with tracemalloc while a profiled stage runs")
+    args = parser.parse_args()
         
     try:
-        with pidfile.PIDFile():
+        # Each node on a host needs its own pid file
+        with (pidfile.PIDFile("uvsync_%s.pid" % args.node) if args.node else pidfile.PIDFile()):
             log = uvsync_log.create_log("uvsync")   
             log.info("=========== START UVSYNC ===========")
-            status = main(log)
+            if args.profile:
+                log.info("Profiling to %s", uvsync_profile.enable(args.profile, args.profile_sample, args.profile_memory))
+            try:
+                if args.daemon:
+                    import uvsync_daemon
+                    status = uvsync_daemon.run(log, node = args.node)
+                else:
+                    status = main(log, node = args.node)
+            finally:
+                uvsync_profile.finish(log)
             log.info("=========== END UVSYNC ===========")
             sys.exit(status)
     except pidfile.AlreadyRunningError:
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from itertools import repeat
+
+# NumPy is an optional dependency, only needed when aggregate_resolutions is set in config.ini
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class UVSyncAggregateException(Exception):
+
+    # Exception class used to report UVSyncAggregate speciffic errors
+    pass
+
+class UVSyncAggregates():
+
+    # Define a class used to hold the count, minimum, mean and maximum of each channel for each bucket of
+    # resolution seconds. bucket_times holds the start of each bucket, the other members hold one row for each
+    # bucket and one column for each channel. Values that are not numbers are left out, so a channel without
+    # any values in a bucket has a count of 0 and NaN as minimum, mean and maximum
+
+    def __init__(self, resolution, bucket_times, count, minimum, mean, maximum):
+
+        # Constructor, initialize all member variables
+
+        self.resolution = resolution
+        self.bucket_times = bucket_times
+        self.count = count
+        self.minimum = minimum
+        self.mean = mean
+        self.maximum = maximum
+
+    def rows(self, station_id, instrument_id):
+
+        # Function used to get the aggregates as tuples in the order of AGGREGATE_COLUMNS (see uvsync_storage.py),
+        # one for each bucket and channel. NaN is passed as None, so it is stored as NULL
+
+        buckets, channels = np.indices(self.count.shape).reshape(2, -1)
+        columns = [self.bucket_times[buckets].astype("datetime64[s]").tolist(), (channels + 1).tolist(), self.count.ravel().tolist()]
+        for values in (self.minimum, self.mean, self.maximum):
+            values = values.ravel()
+            column = values.astype(object)
+            column[np.isnan(values)] = None
+            columns.append(column.tolist())
+        return list(zip(repeat(station_id), repeat(instrument_id), repeat(self.resolution), *columns))
+
+def bucket_range(first, last, resolution):
+
+    # Function used to get the start of the first bucket and the end of the last bucket holding the times first and last
+
+    first = int(np.datetime64(first, "s").astype("int64"))
+    last = int(np.datetime64(last, "s").astype("int64"))
+    return np.datetime64(first - first % resolution, "s"), np.datetime64(last - last % resolution + resolution, "s")
+
+def aggregate(times, values, resolution):
+
+    # Function used to aggregate the values of each channel in buckets of resolution seconds, in one vectorized step.
+    # times holds the date/time of each row as datetime64, sorted, and values holds one column for each channel
+
+    if np is None:
+        raise UVSyncAggregateException("NumPy is required to aggregate measurements")
+
+    seconds = np.asarray(times, dtype = "datetime64[s]").astype("int64")
+    values = np.asarray(values, dtype = "f8")
+    if not len(seconds):
+        empty = np.empty((0, values.shape[1]))
+        return UVSyncAggregates(resolution, np.empty(0, dtype = "datetime64[s]"), empty.astype("int64"), empty, empty, empty)
+
+    # The rows are sorted, so each bucket is a slice starting where the bucket number changes
+    buckets = seconds - seconds % resolution
+    starts = np.flatnonzero(np.diff(buckets, prepend = buckets[0] - 1))
+
+    valid = ~np.isnan(values)
+    count = np.add.reduceat(valid.astype("int64"), starts, axis = 0)
+    total = np.add.reduceat(np.where(valid, values, 0.0), starts, axis = 0)
+    minimum = np.fmin.reduceat(values, starts, axis = 0)
+    maximum = np.fmax.reduceat(values, starts, axis = 0)
+    mean = np.divide(total, count, out = np.full(total.shape, np.nan), where = count > 0)
+
+    return UVSyncAggregates(resolution, buckets[starts].astype("datetime64[s]"), count, minimum, mean, maximum)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+import os, re, gzip, json, time, hashlib, logging
+from pathlib import Path
+from shutil import move
+from datetime import date
+from contextlib import contextmanager
+
+# zstd compression is only available if the zstandard module is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Locks on bundles use fcntl on POSIX and msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+_log = logging.getLogger("uvsync.store")
+
+# Suffix added to archived files for each type of compression
+SUFFIXES = { "none": "", "gzip": ".gz", "zstd": ".zst" }
+
+_CHUNK_SIZE = 1 << 20
+
+class UVSyncArchiveException(Exception):
+
+    # Exception class used to report UVSyncArchive speciffic errors
+    pass
+
+class UVSyncArchive():
+
+    # Define a class used to move stored UV log files to the outbox directory, replacing the plain move done before.
+    # Files are written to outbox/<station>/<year>/ either one by one, compressed with gzip or zstd, or packed
+    # in one bundle per station and month (<station>_<year>-<month>.bundle). Each file in a bundle is compressed
+    # on its own, and a JSON index next to the bundle gives its offset, length and SHA-256 checksum, so a single
+    # file can be read back without reading the whole bundle. A file that is archived again, like the file
+    # of today which grows during the day, replaces the earlier copy in the index, and the bundle is compacted
+    # when more than half of it is replaced copies
+
+    def __init__(self, directory_outbox, compression = "none", bundle = False, level = None):
+
+        # Constructor, initialize all member variables
+
+        if compression not in SUFFIXES:
+            raise UVSyncArchiveException("Invalid archive_compression " + str(compression))
+        if compression == "zstd" and zstandard is None:
+            raise UVSyncArchiveException("archive_compression zstd requires the zstandard module")
+
+        self.directory_outbox = Path(directory_outbox)
+        self.compression = compression
+        self.bundle = bundle
+        self.level = level
+
+    def archive(self, file, station_name):
+
+        # Function used to archive a stored file and remove it from the work directory. Returns the archive path
+
+        file = Path(file)
+        year, month = archive_month(file)
+        outdir = self.directory_outbox / station_name / ("%04d" % year)
+        os.makedirs(outdir, exist_ok = True)
+
+        if self.bundle:
+            fout = outdir / ("%s_%04d-%02d.bundle" % (station_name, year, month))
+            _log.info("Archiving %s in %s", file, fout)
+            with bundle_lock(fout):
+                append_member(fout, file, self.compression, self.level)
+        elif self.compression == "none":
+            # Uncompressed files are moved as before
+            fout = outdir / file.name
+            _log.info("Moving from %s to %s", file, fout)
+            move(file, fout)
+            return fout
+        else:
+            fout = outdir / (file.name + SUFFIXES[self.compression])
+            _log.info("Archiving %s as %s", file, fout)
+            tmp = fout.with_name(fout.name + ".tmp")
+            with file.open("rb") as fin, tmp.open("wb") as fd:
+                _copy(fin, fd, self.compression, self.level)
+            os.replace(tmp, fout)
+
+        os.remove(file)
+        return fout
+
+def archive_month(file):
+
+    # Function used to get the year and month of a UV log file from its name (GUV_<serial>_C_<yymmdd>.csv),
+    # or from its modification time if the name has no date
+
+    match = re.search('GUV_[0-9]*_C_([0-9]{2})([0-9]{2})[0-9]{2}', Path(file).name)
+    if match is not None:
+        return 2000 + int(match.group(1)), int(match.group(2))
+    modified = date.fromtimestamp(os.stat(file).st_mtime)
+    return modified.year, modified.month
+
+def bundle_lock(bundle):
+
+    # Function used to get the lock of a bundle, held while the bundle is written or copied
+
+    bundle = Path(bundle)
+    return _locked(bundle.with_name(bundle.name + ".lock"))
+
+@contextmanager
+def _locked(path):
+
+    # Context manager used to hold an exclusive lock on a file, so several workers can append to the same bundle
+
+    with open(path, "a+b") as fd:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            fd.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(fd.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                fd.seek(0)
+                msvcrt.locking(fd.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _copy(fin, fd, compression, level = None):
+
+    # Function used to copy fin to fd, compressed. Returns the SHA-256 checksum and the size of the uncompressed data
+
+    checksum = hashlib.sha256()
+    size = 0
+    if compression == "gzip":
+        writer = gzip.GzipFile(fileobj = fd, mode = "wb", compresslevel = level if level is not None else 6, mtime = 0)
+    elif compression == "zstd":
+        writer = zstandard.ZstdCompressor(level = level if level is not None else 3).stream_writer(fd, closefd = False)
+    else:
+        writer = None
+
+    while True:
+        data = fin.read(_CHUNK_SIZE)
+        if not data:
+            break
+        checksum.update(data)
+        size += len(data)
+        (writer or fd).write(data)
+
+    if writer is not None:
+        writer.close()
+    return checksum.hexdigest(), size
+
+def _decompress(data, compression):
+
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        if zstandard is None:
+            raise UVSyncArchiveException("Reading zstd archives requires the zstandard module")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+def index_path(bundle):
+
+    bundle = Path(bundle)
+    return bundle.with_name(bundle.name + ".index.json")
+
+def read_index(bundle):
+
+    # Function used to read the index of a bundle, an empty index if the bundle doesn't exist yet
+
+    path = index_path(bundle)
+    if not path.exists():
+        return { "members": {}, "dead": 0 }
+    with path.open() as fd:
+        return json.load(fd)
+
+def _write_index(bundle, index):
+
+    path = index_path(bundle)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as fd:
+        json.dump(index, fd, indent = 1, sort_keys = True)
+    os.replace(tmp, path)
+
+def append_member(bundle, file, compression = "none", level = None):
+
+    # Function used to add a file to a bundle, or replace the copy of the file already in it.
+    # The caller must hold the lock of the bundle
+
+    bundle = Path(bundle)
+    file = Path(file)
+    index = read_index(bundle)
+
+    with bundle.open("ab") as fd, file.open("rb") as fin:
+        offset = fd.seek(0, os.SEEK_END)
+        checksum, size = _copy(fin, fd, compression, level)
+        fd.flush()
+        os.fsync(fd.fileno())
+        length = fd.tell() - offset
+
+    old = index["members"].get(file.name)
+    if old is not None:
+        index["dead"] += old["length"]
+    index["members"][file.name] = { "offset": offset, "length": length, "size": size, "sha256": checksum,
+                                   "compression": compression, "archived": time.time() }
+    _write_index(bundle, index)
+
+    live = sum(member["length"] for member in index["members"].values())
+    if index["dead"] > live:
+        compact(bundle)
+
+def compact(bundle):
+
+    # Function used to rewrite a bundle without the copies that have been replaced.
+    # The caller must hold the lock of the bundle
+
+    bundle = Path(bundle)
+    index = read_index(bundle)
+    _log.info("Compacting %s", bundle)
+
+    tmp = bundle.with_name(bundle.name + ".tmp")
+    members = {}
+    with bundle.open("rb") as fin, tmp.open("wb") as fd:
+        for name, member in sorted(index["members"].items(), key = lambda item: item[1]["offset"]):
+            fin.seek(member["offset"])
+            data = fin.read(member["length"])
+            members[name] = dict(member, offset = fd.tell())
+            fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+    # If the process stops between these two steps the index no longer matches the bundle,
+    # which read_member reports as a checksum mismatch
+    os.replace(tmp, bundle)
+    _write_index(bundle, { "members": members, "dead": 0 })
+
+def read_member(bundle, name):
+
+    # Function used to read a single file from a bundle, checking its SHA-256 checksum
+
+    index = read_index(bundle)
+    member = index["members"].get(name)
+    if member is None:
+        raise UVSyncArchiveException("File %s is not in %s" % (name, bundle))
+
+    with open(bundle, "rb") as fd:
+        fd.seek(member["offset"])
+        data = _decompress(fd.read(member["length"]), member["compression"])
+
+    if hashlib.sha256(data).hexdigest() != member["sha256"]:
+        raise UVSyncArchiveException("Checksum mismatch for %s in %s" % (name, bundle))
+    return data
+
+def list_archived(directory):
+
+    # Function used to find all archived UV log files under a directory, like outbox/<station>.
+    # Returns a dictionary from file name to a (path, bundled) tuple, where path is the bundle for bundled files
+
+    files = {}
+    for path in sorted(Path(directory).rglob("*")):
+        if path.name.endswith(".bundle"):
+            for name in read_index(path)["members"]:
+                files[name] = (path, True)
+        elif path.is_file() and not path.name.endswith((".json", ".lock", ".tmp")):
+            name = path.name
+            for suffix in (".gz", ".zst"):
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+            files[name] = (path, False)
+    return files
+
+def read_archived(path, name = None):
+
+    # Function used to read an archived file, as found by list_archived. name is the file name for bundled files
+
+    path = Path(path)
+    if path.name.endswith(".bundle"):
+        if name is None:
+            raise UVSyncArchiveException("A file name is needed to read from " + str(path))
+        return read_member(path, name)
+    with path.open("rb") as fd:
+        data = fd.read()
+    if path.name.endswith(".gz"):
+        return _decompress(data, "gzip")
+    if path.name.endswith(".zst"):
+        return _decompress(data, "zstd")
+    return data
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+# Backfill of archived UV log files, used to load files from the outbox into the database again,
+# like after a schema change or a database restore.
+#
+# The archived files of the selected stations and instruments, and of the selected dates, are found in
+# outbox/<station>/<year>/ (plain, compressed or bundled, see uvsync_archive.py) and split in one partition per
+# station and month. Each partition is validated and stored by a worker process, in a work directory of its own
+# under backfill_directory, so the backfill never touches the inbox, work, outbox and failed directories of the
+# live runs. The ingestion ledger is not used, so whole files are stored again.
+#
+# The files stored, and the files that failed, are saved in a checkpoint after each partition, so a backfill that
+# is interrupted continues with the files not stored yet when it is started again. Files that failed are kept in
+# backfill_directory/failed/<station>/, and are tried again when the backfill is started again, unless they are
+# invalid or have failed too many times (see uvsync_retry.py). The rows stored are limited to backfill_rows_per_sec, shared by the
+# workers, so the backfill leaves room in the database for the live runs.
+#
+# Example:
+#   python uvsync_backfill.py --station Oslo --from 2023-01-01 --to 2024-12-31
+#   python uvsync_backfill.py --instrument GUV_1001 --workers 4 --restart
+
+import os, sys, json, time, shutil, logging, argparse, pidfile
+import uvsync, uvsync_log
+from pathlib import Path
+from fnmatch import fnmatch
+from datetime import date
+from concurrent.futures import as_completed
+from uvsync import ExitStatus
+from uvsync_archive import UVSyncArchive, list_archived, read_archived
+from uvsync_retry import read_sidecar, sidecar_path
+from uvsync_ledger import file_date
+
+_log = logging.getLogger("uvsync")
+
+class UVSyncBackfillException(Exception):
+
+    # Exception class used to report UVSyncBackfill speciffic errors
+    pass
+
+class UVSyncBackfillCheckpoint():
+
+    # Define a class used to remember the files stored, and the files that failed, for each partition.
+    # Files that failed for good, like invalid files, are also listed as permanent.
+    # The checkpoint is written after each partition, so a backfill can continue after an interrupt
+
+    def __init__(self, path):
+
+        # Constructor, load the checkpoint from disk if it exists
+
+        self.path = Path(path)
+        self.partitions = {}
+        if self.path.exists():
+            with self.path.open() as fd:
+                self.partitions = json.load(fd)
+
+    def done(self, key):
+
+        # Function used to get the names of the files of a partition that are stored or failed for good.
+        # Files that failed with a temporary error, like a lost database connection, are backfilled again
+
+        partition = self.partitions.get(key, {})
+        return set(partition.get("stored", [])) | set(partition.get("permanent", []))
+
+    def update(self, result):
+
+        partition = self.partitions.setdefault(result["key"], { "stored": [], "failed": [], "permanent": [], "rows": 0 })
+        partition["stored"] = sorted(set(partition["stored"]) | set(result["stored"]))
+        partition["failed"] = sorted((set(partition["failed"]) | set(result["failed"])) - set(result["stored"]))
+        partition["permanent"] = sorted((set(partition.get("permanent", [])) | set(result["permanent"])) - set(result["stored"]))
+        partition["rows"] += result["rows"]
+        partition["finished"] = time.time()
+
+    def clear(self):
+
+        self.partitions = {}
+        self.save()
+
+    def save(self):
+
+        # Write to a temporary file first so an interrupted run never leaves a truncated checkpoint behind
+
+        os.makedirs(self.path.parent, exist_ok = True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w") as fd:
+            json.dump(self.partitions, fd, indent = 1, sort_keys = True)
+        os.replace(tmp, self.path)
+
+class UVSyncThrottle():
+
+    # Define a class used to limit the rows stored by a worker to rows_per_sec, by sleeping after each transaction
+    # until the average rate is down to the limit. No limit if rows_per_sec is 0
+
+    def __init__(self, rows_per_sec):
+
+        # Constructor, initialize all member variables
+
+        self.rows_per_sec = rows_per_sec
+        self.started = time.monotonic()
+        self.rows = 0
+
+    def wait(self, rows):
+
+        if not self.rows_per_sec:
+            return
+        self.rows += rows
+        delay = self.started + self.rows / float(self.rows_per_sec) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+def select_contexts(contexts, stations = None, instruments = None):
+
+    # Function used to get the contexts of the selected stations and instruments. Instruments are selected by name or id
+
+    selected = []
+    for ctx in contexts:
+        if stations and ctx.station_name not in stations:
+            continue
+        if instruments and ctx.instrument_name not in instruments and str(ctx.instrument_id) not in instruments:
+            continue
+        selected.append(ctx)
+    return selected
+
+def find_partitions(log, directory_outbox, contexts, first = None, last = None, checkpoint = None):
+
+    # Function used to find the archived files of the contexts from first to last (dates, included), as one
+    # partition for each station and month. Files with no date in the name are only selected when no dates are given.
+    # Files already stored, or failed for good, by an earlier backfill are left out. Returns a list of partitions sorted by key
+
+    stations = {}
+    for ctx in contexts:
+        stations.setdefault(ctx.station_name, []).append(ctx)
+
+    partitions = {}
+    for station_name, station_contexts in sorted(stations.items()):
+        directory = Path(directory_outbox) / station_name
+        if not directory.exists():
+            log.info("No archived files for station %s", station_name)
+            continue
+
+        for name, (path, bundled) in sorted(list_archived(directory).items()):
+            day = file_date(name)
+            if day is None and (first is not None or last is not None):
+                continue
+            if (first is not None and day < first) or (last is not None and day > last):
+                continue
+            matches = [ctx for ctx in station_contexts if fnmatch(name, ctx.match_expression)]
+            if not len(matches):
+                log.info("No selected instrument matches archived file %s", name)
+                continue
+
+            # Files with no date in the name are put in the month of the directory they are archived in
+            month = "%04d-%02d" % (day.year, day.month) if day is not None else path.parent.name
+            key = "%s/%s" % (station_name, month)
+            if checkpoint is not None and name in checkpoint.done(key):
+                continue
+            partition = partitions.setdefault(key, { "key": key, "station": station_name, "files": [] })
+            partition["files"].append((matches[0].instrument_id, name, str(path), bundled))
+
+    return [partitions[key] for key in sorted(partitions)]
+
+def backfill_partition(partition, contexts, connections, directory, rows_per_sec):
+
+    # Function used to validate and store the files of a partition, run by the worker processes.
+    # The files are read from the archive into a work directory of the partition, and the contexts are set up to
+    # move stored files to an outbox directory of the partition, which is removed afterwards.
+    # Returns the names of the files stored and failed, the names of the files that failed for good, and the rows stored
+
+    log = logging.getLogger("uvsync")
+    t0 = time.perf_counter()
+    result = { "key": partition["key"], "stored": [], "failed": [], "permanent": [], "rows": 0, "seconds": 0.0 }
+
+    root = Path(directory) / "work" / partition["key"].replace("/", "_")
+    shutil.rmtree(root, ignore_errors = True)
+    throttle = UVSyncThrottle(rows_per_sec)
+
+    try:
+        for ctx in contexts:
+            files = [(name, path, bundled) for instrument_id, name, path, bundled in partition["files"] if instrument_id == ctx.instrument_id]
+            if not len(files):
+                continue
+
+            ctx.reset()
+            ctx.directory_work = root / "work"
+            ctx.directory_outbox = root / "outbox"
+            ctx.directory_failed = Path(directory) / "failed" / partition["station"]
+            ctx.ingestion_ledger = None
+            ctx.archive_compression = "none"
+            ctx.archive_bundle = False
+            for path in (ctx.directory_work, ctx.directory_outbox, ctx.directory_failed):
+                os.makedirs(path, exist_ok = True)
+
+            ctx.work_files = []
+            for name, path, bundled in files:
+                work_file = ctx.directory_work / name
+                work_file.write_bytes(read_archived(path, name if bundled else None))
+                ctx.work_files.append(work_file)
+
+            log.info("Backfilling %d files for instrument %d|%s in %s", len(files), ctx.instrument_id, ctx.instrument_name, partition["key"])
+            ctx.validate_module.validate(ctx)
+
+            # Store the files a transaction at a time, and wait between transactions if the rows stored are above the limit
+            valid = list(ctx.sync_files)
+            for start in range(0, len(valid), ctx.store_files_per_transaction):
+                ctx.sync_files = valid[start:start + ctx.store_files_per_transaction]
+                rows = ctx.metrics["rows_inserted"]
+                ctx.store_module.store(ctx, connections)
+                throttle.wait(ctx.metrics["rows_inserted"] - rows)
+
+            # Stored files are in the outbox of the partition, failed files in the failed directory.
+            # Files left in the work directory, like files of a transaction that could not be committed, are stored again on the next backfill.
+            # A file that failed on an earlier backfill and is now stored is removed from the failed directory
+            stored = set(path.name for path in ctx.directory_outbox.rglob("*") if path.is_file())
+            for name, path, bundled in files:
+                failed = ctx.directory_failed / name
+                if name in stored:
+                    result["stored"].append(name)
+                    for path in (failed, sidecar_path(failed)):
+                        if path.exists():
+                            path.unlink()
+                elif failed.exists():
+                    result["failed"].append(name)
+                    sidecar = read_sidecar(failed)
+                    if sidecar is not None and sidecar.get("permanent"):
+                        result["permanent"].append(name)
+            result["rows"] += ctx.metrics["rows_inserted"]
+    finally:
+        shutil.rmtree(root, ignore_errors = True)
+
+    result["seconds"] = time.perf_counter() - t0
+    return result
+
+def main(log, stations = None, instruments = None, first = None, last = None, workers = None, restart = False, config_file = None):
+
+    # Main function for the backfill of archived files, using backfill_workers, backfill_rows_per_sec and
+    # backfill_directory in config.ini. The arguments select the stations, instruments and dates to backfill
+
+    settings = None
+    connections = None
+
+    try:
+        settings = uvsync.load_settings(log, config_file)
+        options = settings.config['General']
+        workers = workers or options.getint('backfill_workers', fallback = 2)
+        if workers < 1:
+            raise UVSyncBackfillException("Invalid backfill_workers (%d)" % workers)
+        rows_per_sec = options.getfloat('backfill_rows_per_sec', fallback = 0.0)
+        directory = Path(options.get('backfill_directory', fallback = None) or Path(settings.uvsync_directory) / "backfill")
+
+        connections = uvsync.create_connections(settings)
+        catalog = uvsync.create_catalog(settings, connections)
+        contexts = select_contexts(uvsync.create_contexts(log, catalog, settings.config, settings.uvsync_directory), stations, instruments)
+        if not len(contexts):
+            raise UVSyncBackfillException("No instruments selected for backfill")
+
+        checkpoint = UVSyncBackfillCheckpoint(directory / "checkpoint.json")
+        if restart:
+            log.info("Clearing backfill checkpoint %s", checkpoint.path)
+            checkpoint.clear()
+
+        partitions = find_partitions(log, Path(settings.uvsync_directory) / "outbox", contexts, first, last, checkpoint)
+        log.info("Backfilling %d files in %d partitions for %d instruments, with %d workers",
+            sum(len(partition["files"]) for partition in partitions), len(partitions), len(contexts), workers)
+    except Exception as ex:
+        log.error(str(ex), exc_info=True)
+        if connections is not None:
+            connections.close()
+        return ExitStatus.Error
+
+    status = ExitStatus.Success
+    contexts = dict((ctx.instrument_id, ctx) for ctx in contexts)
+
+    # The rows per second are shared by the workers
+    worker_rows_per_sec = rows_per_sec / min(workers, max(len(partitions), 1))
+
+    def partition_contexts(partition):
+        return [contexts[instrument_id] for instrument_id in sorted(set(file[0] for file in partition["files"]))]
+
+    def finished(result):
+        checkpoint.update(result)
+        checkpoint.save()
+        log.info("Backfilled %s: %d files stored (%d rows), %d files failed, in %.1f s",
+            result["key"], len(result["stored"]), result["rows"], len(result["failed"]), result["seconds"])
+        return ExitStatus.Error if len(result["failed"]) else ExitStatus.Success
+
+    executor, listener = uvsync.create_executor(log, workers, 'process') if len(partitions) > 1 else (None, None)
+    try:
+        if executor is None:
+            for partition in partitions:
+                result = backfill_partition(partition, partition_contexts(partition), connections, directory, worker_rows_per_sec)
+                status = max(status, finished(result))
+        else:
+            futures = dict((executor.submit(backfill_partition, partition, partition_contexts(partition), connections, directory, worker_rows_per_sec),
+                partition) for partition in partitions)
+            for count, future in enumerate(as_completed(futures), 1):
+                try:
+                    status = max(status, finished(future.result()))
+                except Exception as ex:
+                    log.error("Unable to backfill %s: %s", futures[future]["key"], ex, exc_info=True)
+                    status = ExitStatus.Error
+                log.info("%d of %d partitions done", count, len(partitions))
+    except KeyboardInterrupt:
+        # The partitions finished are in the checkpoint, the others are backfilled when the backfill is started again
+        log.info("Backfill interrupted, progress is saved in %s", checkpoint.path)
+        if executor is not None:
+            executor.shutdown(wait = False, cancel_futures = True)
+            executor = None
+        status = ExitStatus.Error
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if listener is not None:
+            listener.stop()
+        connections.close()
+
+    return status
+
+def parse_date(text):
+
+    return date.fromisoformat(text)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Store archived UV log files from the outbox in the database again")
+    parser.add_argument("--station", action = "append", help = "name of a station to backfill, may be repeated (default: all stations)")
+    parser.add_argument("--instrument", action = "append", help = "name or id of an instrument to backfill, may be repeated (default: all instruments)")
+    parser.add_argument("--from", dest = "first", type = parse_date, help = "first date to backfill, as yyyy-mm-dd")
+    parser.add_argument("--to", dest = "last", type = parse_date, help = "last date to backfill, as yyyy-mm-dd")
+    parser.add_argument("--workers", type = int, help = "number of worker processes (default: backfill_workers in config.ini)")
+    parser.add_argument("--restart", action = "store_true", help = "clear the checkpoint and backfill all selected files again")
+    args = parser.parse_args()
+
+    try:
+        with pidfile.PIDFile("uvsync_backfill.pid"):
+            log = uvsync_log.create_log("uvsync")
+            log.info("=========== START UVSYNC BACKFILL ===========")
+            status = main(log, args.station, args.instrument, args.first, args.last, args.workers, args.restart)
+            log.info("=========== END UVSYNC BACKFILL ===========")
+            sys.exit(status)
+    except pidfile.AlreadyRunningError:
+        print('uvsync_backfill is already running')
+        sys.exit(ExitStatus.Running)
+    except Exception as ex:
+        print(str(ex))
+        sys.exit(ExitStatus.Error)
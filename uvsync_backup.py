@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+# Backup of the outbox directory, replacing the old uvnetbackup.ps1 script.
+#
+# Files are copied from the outbox to backup_directory, keeping the same layout. A manifest in the backup
+# directory (.uvsync_backup.json) holds the size, modification time and SHA-256 checksum of every file
+# copied, so only new and changed files are copied on the next run. Files that only grew, like the bundles
+# of the current month, get the new bytes appended instead of a full copy. Every copy is read back and
+# checked against the checksum of the source before the manifest is updated.
+# With backup_keep_days set, files that are backed up and have not changed for that many days are removed
+# from the outbox, as uvnetbackup.ps1 did by moving them. The manifest keeps the entry of a removed file, so if a
+# file with the same name is created in the outbox again, it is backed up as <name>.1, <name>.2 and so on instead
+# of overwriting the backup of the removed file.
+#
+# Example:
+#   python uvsync_backup.py
+
+import os, sys, json, time, hashlib, logging, pidfile
+import uvsync, uvsync_log
+from pathlib import Path
+from uvsync import ExitStatus
+from uvsync_archive import bundle_lock, index_path
+
+_log = logging.getLogger("uvsync")
+
+_CHUNK_SIZE = 1 << 20
+
+class UVSyncBackupException(Exception):
+
+    # Exception class used to report UVSyncBackup speciffic errors
+    pass
+
+class UVSyncBackup():
+
+    # Define a class used to make an incremental, checksum verified copy of a directory
+
+    def __init__(self, source, destination, keep_days = None):
+
+        # Constructor, initialize all member variables and load the manifest of earlier backups
+
+        self.source = Path(source)
+        self.destination = Path(destination)
+        self.keep_days = keep_days
+        self.manifest_path = self.destination / ".uvsync_backup.json"
+        self.entries = {}
+        if self.manifest_path.exists():
+            with self.manifest_path.open() as fd:
+                self.entries = json.load(fd)
+
+        self.files_copied = 0
+        self.files_appended = 0
+        self.files_unchanged = 0
+        self.files_failed = 0
+        self.files_removed = 0
+        self.bytes_copied = 0
+
+    def __str__(self):
+
+        return "%d files copied, %d files appended (%d bytes), %d files unchanged, %d files failed, %d files removed from %s" % (
+            self.files_copied, self.files_appended, self.bytes_copied, self.files_unchanged, self.files_failed, self.files_removed, self.source)
+
+    def run(self):
+
+        # Function used to back up all files in the source directory
+
+        os.makedirs(self.destination, exist_ok = True)
+        try:
+            for path in sorted(self.source.rglob("*")):
+                if not path.is_file() or path.name.endswith((".lock", ".tmp", ".bundle.index.json")):
+                    continue
+                name = path.relative_to(self.source).as_posix()
+                try:
+                    # Bundles are locked while they and their index are copied, so files are not added during the copy
+                    if path.name.endswith(".bundle"):
+                        with bundle_lock(path):
+                            self.__backup_file(path, name)
+                            index = index_path(path)
+                            if index.exists():
+                                self.__backup_file(index, index.relative_to(self.source).as_posix())
+                    else:
+                        self.__backup_file(path, name)
+                except Exception as ex:
+                    _log.error("Unable to back up %s: %s", path, ex, exc_info=True)
+                    self.files_failed += 1
+        finally:
+            self.save()
+
+    def __backup_file(self, path, name):
+
+        # Function used to back up a single file, if it is new or has changed since the last backup
+
+        stat = path.stat()
+        entry = self.entries.get(name)
+        if entry is not None and entry.get("removed") is not None:
+            # The file was removed from the source after keep_days and has been created again, keep the backup
+            # of the removed file and back up the new file under a new name
+            target_name = self.__free_name(name)
+            _log.info("%s was created again after it was removed, backing it up as %s", path, target_name)
+            entry = None
+        else:
+            target_name = entry.get("target", name) if entry is not None else name
+        target = self.destination / target_name
+        target_size = target.stat().st_size if target.exists() else None
+
+        if entry is not None and target_size == entry["size"]:
+            if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                self.files_unchanged += 1
+                self.__remove_old(path, name, stat)
+                return
+
+            # If the file only grew since the last backup, append the new bytes to the copy
+            if stat.st_size > entry["size"]:
+                checksum = _checksum(path, entry["size"])
+                if checksum.hexdigest() == entry["sha256"]:
+                    _log.info("Appending %d bytes to %s", stat.st_size - entry["size"], target)
+                    try:
+                        with path.open("rb") as fin, target.open("ab") as fd:
+                            fin.seek(entry["size"])
+                            size = entry["size"] + _copy(fin, fd, checksum)
+                        self.__verify(target, checksum.hexdigest())
+                    except Exception:
+                        # Cut the copy back to the verified part, so the next run can append again
+                        with target.open("r+b") as fd:
+                            fd.truncate(entry["size"])
+                        raise
+                    self.bytes_copied += size - entry["size"]
+                    self.files_appended += 1
+                    self.__update(name, target_name, size, stat, checksum.hexdigest())
+                    return
+
+        _log.info("Copying %s to %s", path, target)
+        os.makedirs(target.parent, exist_ok = True)
+        tmp = target.with_name(target.name + ".tmp")
+        checksum = hashlib.sha256()
+        try:
+            with path.open("rb") as fin, tmp.open("wb") as fd:
+                size = _copy(fin, fd, checksum)
+            self.__verify(tmp, checksum.hexdigest())
+            os.replace(tmp, target)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        self.bytes_copied += size
+        self.files_copied += 1
+        self.__update(name, target_name, size, stat, checksum.hexdigest())
+
+    def __verify(self, target, checksum):
+
+        # Read the copy back and compare it with the checksum of the source
+
+        if _checksum(target).hexdigest() != checksum:
+            raise UVSyncBackupException("Checksum mismatch after copying to " + str(target))
+
+    def __update(self, name, target_name, size, stat, checksum):
+
+        # The size and time of the source are only recorded if the source did not change during the copy.
+        # The name of the copy is only recorded if it differs from the name of the source
+
+        if size != stat.st_size:
+            raise UVSyncBackupException("File %s changed during the backup" % name)
+        self.entries[name] = { "size": size, "mtime_ns": stat.st_mtime_ns, "sha256": checksum, "backed_up": time.time() }
+        if target_name != name:
+            self.entries[name]["target"] = target_name
+
+    def __free_name(self, name):
+
+        # Function used to get the first name <name>.N not used by a backup
+
+        n = 1
+        while (self.destination / ("%s.%d" % (name, n))).exists():
+            n += 1
+        return "%s.%d" % (name, n)
+
+    def __remove_old(self, path, name, stat):
+
+        # Remove a backed up file from the source directory if it has not changed for keep_days days.
+        # The entry is kept and marked as removed, so a new file with the same name does not overwrite the backup
+
+        if self.keep_days is None or time.time() - stat.st_mtime < self.keep_days * 86400:
+            return
+        target = self.destination / self.entries[name].get("target", name)
+        _log.info("Removing %s, backed up as %s", path, target)
+        path.unlink()
+        self.entries[name]["removed"] = time.time()
+        self.files_removed += 1
+
+    def save(self):
+
+        # Write to a temporary file first so an interrupted run never leaves a truncated manifest behind
+
+        tmp = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        with tmp.open("w") as fd:
+            json.dump(self.entries, fd, indent = 1, sort_keys = True)
+        os.replace(tmp, self.manifest_path)
+
+def _copy(fin, fd, checksum):
+
+    # Copy the rest of fin to fd, updating checksum. Returns the number of bytes copied
+
+    size = 0
+    while True:
+        data = fin.read(_CHUNK_SIZE)
+        if not data:
+            break
+        checksum.update(data)
+        fd.write(data)
+        size += len(data)
+    fd.flush()
+    os.fsync(fd.fileno())
+    return size
+
+def _checksum(path, size = None):
+
+    # Function used to get the SHA-256 checksum of a file, or of its first size bytes
+
+    checksum = hashlib.sha256()
+    remaining = size
+    with open(path, "rb") as fd:
+        while remaining is None or remaining > 0:
+            data = fd.read(_CHUNK_SIZE if remaining is None else min(_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            checksum.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return checksum
+
+def main(log, config_file = None):
+
+    # Main function for the backup of the outbox directory, using backup_directory in config.ini
+
+    try:
+        settings = uvsync.load_settings(log, config_file)
+        backup_directory = settings.config['General'].get('backup_directory', fallback = None)
+        if not backup_directory:
+            raise UVSyncBackupException("No backup_directory in config file")
+        keep_days = settings.config['General'].getfloat('backup_keep_days', fallback = None)
+
+        backup = UVSyncBackup(Path(settings.uvsync_directory) / "outbox", backup_directory, keep_days)
+        log.info("Backing up %s to %s", backup.source, backup.destination)
+        backup.run()
+        log.info("Backup summary: %s", backup)
+    except Exception as ex:
+        log.error(str(ex), exc_info=True)
+        return ExitStatus.Error
+
+    return ExitStatus.Error if backup.files_failed else ExitStatus.Success
+
+if __name__ == '__main__':
+
+    try:
+        with pidfile.PIDFile("uvsync_backup.pid"):
+            log = uvsync_log.create_log("uvsync")
+            log.info("=========== START UVSYNC BACKUP ===========")
+            status = main(log)
+            log.info("=========== END UVSYNC BACKUP ===========")
+            sys.exit(status)
+    except pidfile.AlreadyRunningError:
+        print('uvsync_backup is already running')
+        sys.exit(ExitStatus.Running)
+    except Exception as ex:
+        print(str(ex))
+        sys.exit(ExitStatus.Error)
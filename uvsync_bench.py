@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark suite for the fetch, validate and store stages.
+#
+# Synthetic GUVis-3511 and GUVis-3511 BioShade files are generated in a temporary uvsync directory, and the
+# database is replaced by a fake pyodbc module that records every executemany call, so no SQL Server is needed.
+# Each stage is timed separately, followed by a full uvsync.main run. Results are reported as rows/sec and
+# peak memory, and saved as JSON so later runs can be compared against them.
+#
+# Example:
+#   python uvsync_bench.py --rows 20000 --files 10 --error-rate 0.1 --copies 4 --option columnar_parser=yes
+#   python uvsync_bench.py --baseline bench_results/20261018-120000.json
+
+import sys, json, time, random, shutil, logging, argparse, tempfile, tracemalloc, configparser, types
+from datetime import datetime, timedelta
+from pathlib import Path
+from uvsync_format import get_format
+
+_log = logging.getLogger("uvsync")
+
+class FakeCursor():
+
+    # Cursor used in place of a pyodbc cursor, records the statements executed
+
+    def __init__(self, connection):
+
+        self.connection = connection
+        self.fast_executemany = False
+        self.rows = []
+
+    def execute(self, sql, *params):
+
+        self.connection.recorder.execute(sql)
+        if sql.startswith("exec select_station_infos"):
+            self.rows = list(self.connection.recorder.stations)
+        elif sql.startswith("exec select_instrument_contexts"):
+            self.rows = list(self.connection.recorder.instruments)
+        else:
+            self.rows = []
+        return self
+
+    def executemany(self, sql, params):
+
+        self.connection.recorder.executemany(sql, params)
+
+    def fetchall(self):
+
+        return self.rows
+
+class FakeConnection():
+
+    # Connection used in place of a pyodbc connection
+
+    def __init__(self, recorder):
+
+        self.recorder = recorder
+
+    def cursor(self):
+
+        return FakeCursor(self)
+
+    def execute(self, sql, *params):
+
+        return self.cursor().execute(sql, *params)
+
+    def commit(self):
+
+        self.recorder.commits += 1
+
+    def rollback(self):
+
+        pass
+
+    def close(self):
+
+        pass
+
+class FakeRecorder():
+
+    # Define a class used to count the statements sent to the fake database
+
+    def __init__(self):
+
+        self.stations = []
+        self.instruments = []
+        self.reset()
+
+    def reset(self):
+
+        self.statements = 0
+        self.executemany_calls = 0
+        self.rows = 0
+        self.commits = 0
+
+    def execute(self, sql):
+
+        self.statements += 1
+
+    def executemany(self, sql, params):
+
+        self.executemany_calls += 1
+        self.rows += len(params)
+
+def install_fake_pyodbc(recorder):
+
+    # Function used to replace the pyodbc module with a fake one that connects to the recorder
+
+    module = types.ModuleType("pyodbc")
+    module.Error = Exception
+    module.connect = lambda connection_string, autocommit = False: FakeConnection(recorder)
+    sys.modules["pyodbc"] = module
+
+def generate_file(path, fmt, rows, start, invalid = False, seed = 0):
+
+    # Function used to write a synthetic UV log file with a header and the given number of rows in format fmt.
+    # If invalid is set, one row gets a missing column so the file fails validation
+
+    rnd = random.Random(seed)
+    bad_row = rnd.randrange(rows) if invalid and rows else -1
+    filter_values = fmt.filter_values + ("A", "B") if fmt.filter_column is not None else ()
+
+    with open(path, "w", newline = "") as fd:
+        fd.write(",".join("Column%d" % n for n in range(fmt.column_count)) + "\r\n")
+        for n in range(rows):
+            row = ["%.4f" % rnd.uniform(0, 100) for column in range(fmt.column_count)]
+            row[0] = fmt.mode
+            row[fmt.timestamp_column] = (start + timedelta(seconds = n)).strftime(fmt.timestamp_format)
+            if fmt.filter_column is not None:
+                row[fmt.filter_column] = filter_values[n % len(filter_values)]
+            if n == bad_row:
+                row = row[:-1]
+            fd.write(",".join(row) + "\r\n")
+
+def file_name(serial, day):
+
+    return "GUV_%d_C_%s.csv" % (serial, day.strftime("%y%m%d"))
+
+def create_instrument(instrument_id, format_name, serial, fetch_module = "fetch_copy"):
+
+    # Function used to create an instrument row as returned by select_instrument_contexts
+
+    return types.SimpleNamespace(instrument_id = instrument_id, station_id = instrument_id, instrument_name = "bench%d" % instrument_id,
+        station_name = "bench%d" % instrument_id, principal = "bench", channel_count = 20, format = format_name,
+        fetch_module = fetch_module, validate_module = "validate_format", store_module = "store_format",
+        match_expression = "*GUV_%d_C_*.csv" % serial)
+
+def measure(name, setup, func, rows, with_memory):
+
+    # Function used to time a benchmark, and optionally run it a second time to find its peak memory use.
+    # setup is called before each run and is not timed
+
+    setup()
+    t0 = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - t0
+
+    peak = None
+    if with_memory:
+        setup()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = { "name": name, "rows": rows, "seconds": seconds, "rows_per_sec": rows / seconds if seconds else None, "peak_memory": peak }
+    print("%-40s %10d rows %8.3f s %12.0f rows/sec %s" % (name, rows, seconds, result["rows_per_sec"] or 0,
+        "%8.1f MB peak" % (peak / 1e6) if peak is not None else ""))
+    return result
+
+def run(args):
+
+    # Function used to generate the data and run all benchmarks, returns a list of results
+
+    from uvsync_context import UVSyncContext
+    from uvsync_db import UVSyncConnectionManager
+    from uvsync_storage import create_storage
+
+    recorder = FakeRecorder()
+    install_fake_pyodbc(recorder)
+    results = []
+
+    root = Path(tempfile.mkdtemp(prefix = "uvsync_bench_"))
+    try:
+        source = root / "source"
+        source.mkdir()
+        for name in ("inbox", "work", "outbox", "failed", "manifest"):
+            (root / "uvsync" / name).mkdir(parents = True)
+
+        config = configparser.ConfigParser()
+        config["General"] = { "connection_string": "bench", "uvsync_directory": str(root / "uvsync"),
+            "ready_stable_seconds": "0" }
+        for option in args.option:
+            key, value = option.split("=", 1)
+            config["General"][key.strip()] = value.strip()
+        if "ingestion_ledger" in config["General"]:
+            config["General"]["ingestion_ledger"] = str(root / "ledger.sqlite")
+        if "sqlite_database" in config["General"]:
+            config["General"]["sqlite_database"] = str(root / "measurements.sqlite")
+        config_file = root / "config.ini"
+        with open(config_file, "w") as fd:
+            config.write(fd)
+
+        connections = UVSyncConnectionManager("bench")
+        rnd = random.Random(args.seed)
+        today = datetime(2026, 1, 31)
+
+        for instrument_id, format_name in enumerate(args.format, 1):
+            fmt = get_format(format_name)
+            serial = 1000 + instrument_id
+            instrument = create_instrument(instrument_id, format_name, serial, args.fetch_module)
+            recorder.instruments.append(instrument)
+            ctx = UVSyncContext(instrument, root / "uvsync", config["General"])
+
+            # Generate the files for this instrument, the last one is the growing file of today
+            files = []
+            invalid_count = 0
+            for n in range(args.files):
+                day = today - timedelta(days = args.files - 1 - n)
+                invalid = rnd.random() < args.error_rate
+                invalid_count += invalid
+                path = source / file_name(serial, day)
+                generate_file(path, fmt, args.rows, day, invalid, seed = rnd.randrange(1 << 30))
+                files.append(path)
+            rows = args.rows * args.files
+            print("%s: %d files with %d rows each, %d invalid" % (format_name, args.files, args.rows, invalid_count))
+
+            def copy_to_work():
+                for path in ctx.directory_work.glob("*"):
+                    path.unlink()
+                for path in files:
+                    shutil.copy(path, ctx.directory_work / path.name)
+
+            def validate_files():
+                for path in files:
+                    with open(ctx.directory_work / path.name) as fd:
+                        try:
+                            ctx.validate_module.validate_file(fd, ctx)
+                        except Exception:
+                            pass
+
+            def store_files(function):
+                def run():
+                    storage = create_storage(ctx, connections)
+                    try:
+                        for path in files:
+                            with open(ctx.directory_work / path.name) as fd:
+                                try:
+                                    function(storage, fd, ctx)
+                                except Exception:
+                                    pass
+                    finally:
+                        storage.close()
+                return run
+
+            results.append(measure("%s validate_file" % format_name, copy_to_work, validate_files, rows, args.memory))
+            results.append(measure("%s store_file" % format_name, copy_to_work, store_files(ctx.store_module.store_file), rows, args.memory))
+            results.append(measure("%s store_file_fast" % format_name, copy_to_work, store_files(ctx.store_module.store_file_fast), rows, args.memory))
+
+            def copy_to_inbox():
+                for path in ctx.directory_work.glob("*"):
+                    path.unlink()
+                for path in files:
+                    shutil.copy(path, ctx.directory_inbox / ("A" + path.name))
+
+            results.append(measure("%s fetch" % format_name, copy_to_inbox, lambda: ctx.fetch_module.fetch(ctx), rows, args.memory))
+            for path in ctx.directory_work.glob("*"):
+                path.unlink()
+
+        # Run uvsync.main with all instruments. Each run gets the next copy of the growing file of today,
+        # so the cost of storing the same file several times a day is included
+        import uvsync
+
+        # Prepare the files dropped in the inbox before each run, all files are dropped before the first run
+        # and the next copy of each growing file of today before each of the following runs
+        drops = [[] for copy in range(args.copies)]
+        main_rows = 0
+        for instrument_id, format_name in enumerate(args.format, 1):
+            serial = 1000 + instrument_id
+            for path in sorted(source.glob("GUV_%d_C_*.csv" % serial)):
+                if path.name == file_name(serial, today):
+                    lines = path.read_bytes().splitlines(True)
+                    for copy in range(args.copies):
+                        count = 1 + (len(lines) - 1) * (copy + 1) // args.copies
+                        drops[copy].append(("A" + path.name, b"".join(lines[:count])))
+                        main_rows += count - 1
+                else:
+                    drops[0].append(("A" + path.name, path.read_bytes()))
+                    main_rows += args.rows
+
+        def main_runs():
+            for drop in drops:
+                for name, data in drop:
+                    (root / "uvsync" / "inbox" / name).write_bytes(data)
+                uvsync.main(_log, config_file)
+
+        def clean():
+            for name in ("inbox", "work", "outbox", "failed"):
+                shutil.rmtree(root / "uvsync" / name)
+                (root / "uvsync" / name).mkdir()
+            for name in ("ledger.sqlite", "measurements.sqlite"):
+                if (root / name).exists():
+                    (root / name).unlink()
+            recorder.reset()
+
+        result = measure("uvsync.main (%d copies)" % args.copies, clean, main_runs, main_rows, args.memory)
+        result["rows_sent"] = recorder.rows
+        results.append(result)
+        print("%-40s %10d rows sent to the database in %d executemany calls" % ("", recorder.rows, recorder.executemany_calls))
+
+        connections.close()
+    finally:
+        shutil.rmtree(root, ignore_errors = True)
+
+    return results
+
+def compare(results, baseline_file):
+
+    # Function used to print the change in rows/sec and peak memory from a saved baseline
+
+    with open(baseline_file) as fd:
+        baseline = { result["name"]: result for result in json.load(fd)["results"] }
+
+    print("Compared to %s:" % baseline_file)
+    for result in results:
+        old = baseline.get(result["name"])
+        if old is None or not old["rows_per_sec"] or not result["rows_per_sec"]:
+            continue
+        line = "%-40s %+7.1f%% rows/sec" % (result["name"], 100.0 * (result["rows_per_sec"] / old["rows_per_sec"] - 1))
+        if old.get("peak_memory") and result.get("peak_memory"):
+            line += " %+7.1f%% peak memory" % (100.0 * (result["peak_memory"] / old["peak_memory"] - 1))
+        print(line)
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description = "Benchmark the uvsync fetch, validate and store stages")
+    parser.add_argument("--rows", type = int, default = 10000, help = "number of rows in each file")
+    parser.add_argument("--files", type = int, default = 5, help = "number of files for each instrument")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "fraction of files with an invalid row")
+    parser.add_argument("--copies", type = int, default = 1, help = "number of growing copies of today's file stored by uvsync.main")
+    parser.add_argument("--format", action = "append", help = "file format to benchmark, may be repeated (default: GUVis-3511 and GUVis-3511_bs)")
+    parser.add_argument("--fetch-module", default = "fetch_copy", help = "fetch module used by the instruments (default: fetch_copy)")
+    parser.add_argument("--option", action = "append", default = [], help = "config.ini option for the [General] section, as key=value")
+    parser.add_argument("--no-memory", dest = "memory", action = "store_false", help = "skip the peak memory measurement")
+    parser.add_argument("--seed", type = int, default = 1, help = "seed for the synthetic data")
+    parser.add_argument("--output", help = "file to save the results to (default: bench_results/<time>.json)")
+    parser.add_argument("--baseline", help = "saved results to compare against")
+    args = parser.parse_args(argv)
+    if not args.format:
+        args.format = ["GUVis-3511", "GUVis-3511_bs"]
+    return args
+
+if __name__ == '__main__':
+
+    args = parse_args(sys.argv[1:])
+    logging.basicConfig(level = logging.WARNING)
+    results = run(args)
+
+    output = Path(args.output) if args.output else Path(__file__).parent / "bench_results" / (datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    output.parent.mkdir(parents = True, exist_ok = True)
+    with open(output, "w") as fd:
+        json.dump({ "time": datetime.now().isoformat(timespec = "seconds"), "arguments": vars(args), "results": results }, fd, indent = 1)
+    print("Results saved to %s" % output)
+
+    if args.baseline:
+        compare(results, args.baseline)
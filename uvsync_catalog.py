@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import os, json, time, types, decimal, hashlib, logging
+from pathlib import Path
+from uvsync_ftp import UVSyncFTP
+from uvsync_context import UVSyncContext
+
+_log = logging.getLogger("uvsync")
+
+class UVSyncCatalogException(Exception):
+
+    # Exception class used to report UVSyncCatalog speciffic errors
+    pass
+
+class UVSyncCatalog():
+
+    # Define a class used to hold the stations and instruments of the database, as returned by
+    # select_station_infos and select_instrument_contexts.
+    #
+    # With a cache path the rows are saved in a local JSON file, and are used without asking the database
+    # until they are older than ttl seconds. When they are older, the optional version_query is used to ask the
+    # database for a single value that changes when any station or instrument changes, and the rows are
+    # only read again if it has changed. If the database can't be reached, the saved rows are used however old
+    # they are, so stations can still be downloaded.
+    # The UVSyncFTP and UVSyncContext objects are kept between calls, and only rebuilt for rows that changed
+
+    def __init__(self, connections, path = None, ttl = 3600.0, version_query = None):
+
+        # Constructor, initialize all member variables and load the saved rows if they exist
+
+        self.connections = connections
+        self.path = Path(path) if path else None
+        self.ttl = ttl
+        self.version_query = version_query
+        self.cache = None
+        self.stations = {}
+        self.contexts = {}
+
+        if self.path is not None and self.path.exists():
+            try:
+                with self.path.open() as fd:
+                    self.cache = json.load(fd)
+            except ValueError as ex:
+                _log.info("Ignoring invalid catalog cache %s: %s", self.path, ex)
+
+    def refresh(self, log, force = False):
+
+        # Function used to make sure the rows are up to date, reading them from the database if needed.
+        # Raises an exception if the rows can't be read from the database and no rows are saved
+
+        if not force and self.cache is not None and time.time() - self.cache["saved"] < self.ttl:
+            return
+
+        try:
+            with self.connections.connection() as connection:
+                cursor = connection.cursor()
+
+                version = None
+                if self.version_query:
+                    version = _as_json(cursor.execute(self.version_query).fetchall()[0][0])
+                    if self.cache is not None and self.cache.get("version") == version:
+                        log.info("Catalog is unchanged (version %s)", version)
+                        self.cache["saved"] = time.time()
+                        self.__save()
+                        return
+
+                cursor.execute("exec select_station_infos")
+                stations = [_as_dict(row) for row in cursor.fetchall()]
+                cursor.execute("exec select_instrument_contexts")
+                instruments = [_as_dict(row) for row in cursor.fetchall()]
+
+        except Exception as ex:
+            if self.cache is None:
+                raise
+            log.error("Unable to read stations and instruments from the database, using the catalog saved %s: %s",
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.cache["saved"])), ex)
+            return
+
+        self.cache = { "saved": time.time(), "version": version, "stations": stations, "instruments": instruments }
+        self.__save()
+
+    def __save(self):
+
+        # Write to a temporary file first so an interrupted run never leaves a truncated cache behind.
+        # The rows hold the FTP passwords, so the file is created readable by the owner only where the OS supports it.
+        # A temporary file left by an interrupted run is removed first, as it may have been created with other permissions
+
+        if self.path is None:
+            return
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fd:
+            json.dump(self.cache, fd, indent = 1, sort_keys = True, default = str)
+        os.replace(tmp, self.path)
+
+    def get_stations(self, log, uvsync_directory):
+
+        # Function used to get all active stations, as a list of UVSyncFTP objects
+
+        if self.cache is None:
+            raise UVSyncCatalogException("The catalog has not been loaded")
+
+        stations = {}
+        for row in self.cache["stations"]:
+            checksum = _checksum(row)
+            old = self.stations.get(row["id"])
+            if old is not None and old[0] == checksum:
+                stations[row["id"]] = old
+                continue
+            log.info("Creating station %d|%s", row["id"], row["label"])
+            stations[row["id"]] = (checksum, UVSyncFTP(types.SimpleNamespace(**row), uvsync_directory))
+
+        self.stations = stations
+        return [station for checksum, station in stations.values()]
+
+    def get_contexts(self, log, config, uvsync_directory):
+
+        # Function used to get all active instruments, as a list of contexts
+
+        if self.cache is None:
+            raise UVSyncCatalogException("The catalog has not been loaded")
+
+        contexts = {}
+        for row in self.cache["instruments"]:
+            checksum = _checksum(row)
+            old = self.contexts.get(row["instrument_id"])
+            if old is not None and old[0] == checksum:
+                contexts[row["instrument_id"]] = old
+                continue
+            log.info("Creating sync context for instrument %d|%s", row["instrument_id"], row["instrument_name"])
+            contexts[row["instrument_id"]] = (checksum, UVSyncContext(types.SimpleNamespace(**row), uvsync_directory, config['General']))
+
+        self.contexts = contexts
+        return [ctx for checksum, ctx in contexts.values()]
+
+def _as_dict(row):
+
+    # Function used to get the columns of a row as a dictionary, from a pyodbc row or from any object with attributes
+
+    if hasattr(row, "cursor_description"):
+        return dict((column[0], _as_json(value)) for column, value in zip(row.cursor_description, row))
+    return dict((name, _as_json(value)) for name, value in vars(row).items())
+
+def _as_json(value):
+
+    # Decimals are kept as numbers, other values that can't be saved as JSON, like dates, are kept as strings
+
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value if value is None or isinstance(value, (bool, int, float, str)) else str(value)
+
+def _checksum(row):
+
+    return hashlib.sha256(json.dumps(row, sort_keys = True).encode("utf-8")).hexdigest()
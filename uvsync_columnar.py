@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+from itertools import repeat
+
+# NumPy is an optional dependency, only needed when columnar_parser is enabled in config.ini
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class UVSyncColumnarException(Exception):
+
+    # Exception class used to report invalid UV log files found by the columnar parser
+    pass
+
+class UVSyncColumns():
+
+    # Define a class used to hold the content of a UV log file as NumPy arrays, one entry per data row.
+    # The table member holds every field as a string, timestamps holds the parsed date/time of each row
+    # as datetime64 and channels holds the channel values as floats, NaN for values that are not numbers.
+    # channel_columns gives the columns of the table holding the channel values
+
+    def __init__(self, table, timestamps, channels, channel_columns = None):
+
+        # Constructor, initialize all member variables
+
+        self.table = table
+        self.timestamps = timestamps
+        self.channels = channels
+        self.channel_columns = channel_columns
+        self.count = len(table)
+
+    def column(self, index):
+
+        # Function used to get all fields of a speciffic column as a string array
+
+        return self.table[:, index]
+
+    def mask(self, index, values):
+
+        # Function used to get a boolean mask of the rows where a speciffic column holds one of the given values
+
+        return np.isin(self.table[:, index], values)
+
+    def select(self, mask):
+
+        # Function used to get a new UVSyncColumns object holding only the rows selected by a boolean mask
+
+        return UVSyncColumns(self.table[mask], self.timestamps[mask], self.channels[mask], self.channel_columns)
+
+    def measurements(self, ctx, aux_columns, start = 0, stop = None):
+
+        # Function used to build the measurements to store for the rows from start to stop, as tuples
+        # in the order expected by the storage backend (see uvsync_storage.py). The tuples are built by zip
+        # from whole columns, so no per-row work is done in Python
+
+        timestamps = self.timestamps[start:stop]
+        channels = self.channels[start:stop]
+        table = self.table[start:stop]
+
+        # Channel values that are not numbers are passed as the row based store module does: empty values as None,
+        # so they are stored as NULL, and other values as the text in the file
+        values = channels.T.tolist()
+        missing = np.isnan(channels)
+        if self.channel_columns is not None and missing.any():
+            values = channels.T.astype(object)
+            text = table[:, self.channel_columns].T
+            missing = missing.T
+            values[missing] = np.where(text[missing] == "", None, text[missing])
+            values = values.tolist()
+
+        columns = [timestamps.astype("datetime64[s]").tolist()] + values + [table[:, index].tolist() for index in aux_columns]
+        return list(zip(repeat(ctx.station_id), repeat(ctx.instrument_id), repeat(ctx.principal), *columns))
+
+def read_columns(fd, column_count, mode, timestamp_column = 2, channel_columns = slice(7, 27)):
+
+    # Function used to read and validate a UV log file in one vectorized step.
+    # fd is an open text file or any iterable of lines, starting with the header line.
+    # Every row must have column_count columns, hold mode in the first column and a valid date/time
+    # in timestamp_column, otherwise UVSyncColumnarException is raised
+
+    if np is None:
+        raise UVSyncColumnarException("NumPy is required by the columnar parser")
+
+    try:
+        table = np.loadtxt(fd, dtype = str, delimiter = ",", skiprows = 1, ndmin = 2, quotechar = '"', comments = None)
+    except ValueError as ex:
+        raise UVSyncColumnarException("Number of columns is wrong, " + str(ex).split(";")[0])
+
+    if table.size == 0:
+        # channel_columns is a slice or a list of columns (see uvsync_format.py)
+        table = np.empty((0, column_count), dtype = str)
+        return UVSyncColumns(table, np.empty(0, dtype = "datetime64[s]"), np.empty((0, table[:, channel_columns].shape[1])), channel_columns)
+
+    ncol = table.shape[1]
+    if ncol != column_count:
+        raise UVSyncColumnarException("Number of columns is wrong, got " + str(ncol) + ", should be " + str(column_count))
+
+    invalid = np.flatnonzero(table[:, 0] != mode)
+    if len(invalid):
+        raise UVSyncColumnarException("Mode is wrong, got " + str(table[invalid[0], 0]) + ", should be " + mode)
+
+    try:
+        timestamps = table[:, timestamp_column].astype("datetime64[s]")
+    except ValueError:
+        # Find the first invalid date/time, line numbers start at 1 and include the header
+        for n, value in enumerate(table[:, timestamp_column]):
+            try:
+                np.datetime64(value, "s")
+            except ValueError:
+                raise UVSyncColumnarException("Invalid datetime on line " + str(n + 2))
+        raise
+
+    # Dates without a time of day and 'NaT' are accepted by NumPy, but not by the row based validation
+    invalid = np.flatnonzero((np.char.str_len(table[:, timestamp_column]) != 19) | np.isnat(timestamps))
+    if len(invalid):
+        raise UVSyncColumnarException("Invalid datetime on line " + str(invalid[0] + 2))
+
+    # The row based validation accepts any channel value, so values that are not numbers, like empty values, are NaN
+    text = table[:, channel_columns]
+    try:
+        channels = text.astype(float)
+    except ValueError:
+        channels = np.where(text == "", "nan", text)
+        try:
+            channels = channels.astype(float)
+        except ValueError:
+            channels = np.array([[_as_float(value) for value in row] for row in channels], dtype = float).reshape(text.shape)
+
+    return UVSyncColumns(table, timestamps, channels, channel_columns)
+
+def _as_float(value):
+
+    # Channel values that are not numbers are NaN, like in the column store (see uvsync_columnstore.py)
+    try:
+        return float(value)
+    except ValueError:
+        return float("nan")
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import os, logging
+from pathlib import Path
+from datetime import date
+from uvsync_storage import UVSyncStorage
+from uvsync_aggregate import aggregate, bucket_range
+
+# NumPy is an optional dependency, only needed when column_store is set in config.ini
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_log = logging.getLogger("uvsync.store")
+
+# Layout of each measurement in the column store, a fixed size little-endian record with the date/time,
+# the 20 channel values and the 2 aux values of MEASUREMENT_COLUMNS (see uvsync_storage.py)
+RECORD_DTYPE = [("measurement_time", "<M8[s]"), ("channels", "<f8", (20,)), ("aux", "<f8", (2,))]
+
+# Suffix of the files holding the measurements of one day
+SUFFIX = ".uvc"
+
+class UVSyncColumnStoreException(Exception):
+
+    # Exception class used to report UVSyncColumnStore speciffic errors
+    pass
+
+class UVSyncColumnStore():
+
+    # Define a class used to keep a local copy of the stored measurements, so analysis jobs can read recent
+    # data without querying the database. The measurements are kept in one file per station, instrument and day:
+    #
+    #   <directory>/<station_id>/<instrument_id>/<yyyy>/<yyyy-mm-dd>.uvc
+    #
+    # Each file is a plain array of RECORD_DTYPE records sorted by measurement_time, one per measurement time,
+    # so it can be memory mapped and searched without parsing. Measurements later than the last one in a file,
+    # like the new rows of the file of today, are appended. Other measurements are merged with the ones already
+    # in the file, replacing measurements with the same time as the database does, and the file is replaced.
+    # There must be only one writer for each instrument, readers can run at any time
+
+    def __init__(self, directory):
+
+        # Constructor, initialize all member variables
+
+        if np is None:
+            raise UVSyncColumnStoreException("NumPy is required by the column store")
+        self.directory = Path(directory)
+        self.dtype = np.dtype(RECORD_DTYPE)
+
+    def day_path(self, station_id, instrument_id, day):
+
+        return self.directory / str(station_id) / str(instrument_id) / ("%04d" % day.year) / (day.isoformat() + SUFFIX)
+
+    def days(self, station_id, instrument_id):
+
+        # Function used to get the days with measurements for an instrument, sorted
+
+        directory = self.directory / str(station_id) / str(instrument_id)
+        if not directory.exists():
+            return []
+        return sorted(date.fromisoformat(path.name[:-len(SUFFIX)]) for path in directory.glob("*/*" + SUFFIX))
+
+    def records(self, rows):
+
+        # Function used to convert measurements, as tuples in the order of MEASUREMENT_COLUMNS, to records.
+        # The store modules pass the values as strings or as floats, values that are not numbers are stored as NaN
+
+        records = np.empty(len(rows), dtype = self.dtype)
+        records["measurement_time"] = [row[3] for row in rows]
+        values = [row[4:26] for row in rows]
+        try:
+            values = np.array(values, dtype = "f8")
+        except ValueError:
+            values = np.array([[_as_float(value) for value in row] for row in values], dtype = "f8")
+        records["channels"] = values[:, :20]
+        records["aux"] = values[:, 20:22]
+        return records
+
+    def write(self, station_id, instrument_id, records):
+
+        # Function used to add records for an instrument, split in one file per day
+
+        if not len(records):
+            return
+        records = _latest(records)
+        days = records["measurement_time"].astype("M8[D]")
+        bounds = np.flatnonzero(days[1:] != days[:-1]) + 1
+        for part in np.split(records, bounds):
+            day = part["measurement_time"][0].astype("M8[D]").item()
+            self.__write_day(self.day_path(station_id, instrument_id, day), part)
+
+    def __write_day(self, path, records):
+
+        # Append the records to the file of a day if they are all later than the records in it, otherwise merge
+
+        os.makedirs(path.parent, exist_ok = True)
+        existing = self.__open(path)
+        if existing is not None and len(existing) and records["measurement_time"][0] <= existing["measurement_time"][-1]:
+            records = _latest(np.concatenate([existing, records]))
+            del existing
+            tmp = path.with_name(path.name + ".tmp")
+            records.tofile(str(tmp))
+            os.replace(tmp, path)
+            return
+
+        del existing
+        with path.open("ab") as fd:
+            # Cut off a record left incomplete by an interrupted write
+            size = fd.seek(0, os.SEEK_END)
+            if size % self.dtype.itemsize:
+                fd.truncate(size - size % self.dtype.itemsize)
+            fd.write(records.tobytes())
+
+    def __open(self, path):
+
+        # Memory map the complete records of a file, None if there are none
+
+        if not path.exists():
+            return None
+        count = path.stat().st_size // self.dtype.itemsize
+        if count == 0:
+            return None
+        return np.memmap(path, dtype = self.dtype, mode = "r", shape = (count,))
+
+    def iter_days(self, station_id, instrument_id, start, end):
+
+        # Generator used to read the records of an instrument from start (included) to end (excluded), as one
+        # read-only array for each day. The arrays are views of the memory mapped files, nothing is copied
+
+        start = np.datetime64(start, "s")
+        end = np.datetime64(end, "s")
+        for day in self.days(station_id, instrument_id):
+            day = np.datetime64(day, "D")
+            if day + 1 <= start or day >= end:
+                continue
+            records = self.__open(self.day_path(station_id, instrument_id, day.item()))
+            if records is None:
+                continue
+            times = records["measurement_time"]
+            records = records[np.searchsorted(times, start):np.searchsorted(times, end)]
+            if len(records):
+                yield records
+
+    def read(self, station_id, instrument_id, start, end):
+
+        # Function used to read the records of an instrument from start (included) to end (excluded) as one array.
+        # A range within a single day is returned without copying, a longer range is copied into a new array
+
+        parts = list(self.iter_days(station_id, instrument_id, start, end))
+        if not len(parts):
+            return np.empty(0, dtype = self.dtype)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+class UVSyncColumnStoreStorage(UVSyncStorage):
+
+    # Storage backend used to write the measurements to a column store in addition to another storage backend.
+    # The measurements are kept in memory until the transaction is committed, so measurements that are rolled back
+    # are never written to the column store. An error writing to the column store is logged, it does not fail the store.
+    #
+    # With resolutions, the count, minimum, mean and maximum of each channel are also stored for buckets of each
+    # resolution in seconds (see uvsync_aggregate.py). Only the buckets holding new measurements are aggregated again,
+    # from all measurements in the column store for those buckets, since a bucket may hold measurements stored earlier
+
+    def __init__(self, storage, store, resolutions = ()):
+
+        self.storage = storage
+        self.store = store
+        self.resolutions = list(resolutions)
+        self.pending = []
+        self.savepoints = {}
+
+    def load_measurements(self, rows):
+
+        self.storage.load_measurements(rows)
+        if len(rows):
+            self.pending.append((rows[0][0], rows[0][1], self.store.records(rows)))
+
+    def load_aggregates(self, rows):
+
+        self.storage.load_aggregates(rows)
+
+    def savepoint(self, name):
+
+        self.storage.savepoint(name)
+        self.savepoints[name] = len(self.pending)
+
+    def rollback_to_savepoint(self, name):
+
+        self.storage.rollback_to_savepoint(name)
+        del self.pending[self.savepoints.pop(name):]
+
+    def release_savepoint(self, name):
+
+        self.storage.release_savepoint(name)
+        self.savepoints.pop(name, None)
+
+    def commit(self):
+
+        if not len(self.resolutions):
+            self.storage.commit()
+            self.__write()
+            return
+
+        # The aggregates are stored in the same transaction as the measurements, so the measurements are written to
+        # the column store before the commit. If the commit fails the files are stored again on the next run,
+        # replacing the same measurements in the column store
+        written = self.__write()
+        if written is not None:
+            self.__aggregate(written)
+        self.storage.commit()
+
+    def __write(self):
+
+        # Write all pending records of an instrument at once. Returns the time of the first and last record written
+        # for each instrument, None if they could not be written
+
+        pending = self.pending
+        self.pending = []
+        self.savepoints = {}
+
+        try:
+            instruments = {}
+            for station_id, instrument_id, records in pending:
+                instruments.setdefault((station_id, instrument_id), []).append(records)
+            written = {}
+            for (station_id, instrument_id), records in instruments.items():
+                times = np.concatenate([part["measurement_time"] for part in records])
+                self.store.write(station_id, instrument_id, np.concatenate(records))
+                written[(station_id, instrument_id)] = (times.min(), times.max())
+            return written
+        except Exception as ex:
+            _log.error("Unable to write measurements to the column store %s: %s", self.store.directory, ex, exc_info=True)
+            return None
+
+    def __aggregate(self, written):
+
+        # Aggregate the buckets holding the written records, for each resolution
+
+        rows = []
+        for (station_id, instrument_id), (first, last) in written.items():
+            for resolution in self.resolutions:
+                start, end = bucket_range(first, last, resolution)
+                records = self.store.read(station_id, instrument_id, start, end)
+                rows += aggregate(records["measurement_time"], records["channels"], resolution).rows(station_id, instrument_id)
+        if len(rows):
+            _log.info("Storing %d aggregates", len(rows))
+            self.storage.load_aggregates(rows)
+
+    def rollback(self):
+
+        self.storage.rollback()
+        self.pending = []
+        self.savepoints = {}
+
+    def close(self):
+
+        self.storage.close()
+
+def _latest(records):
+
+    # Function used to sort records by time, keeping only the last record for each time
+
+    order = np.argsort(records["measurement_time"], kind = "stable")
+    records = records[order]
+    times = records["measurement_time"]
+    return records[np.append(times[1:] != times[:-1], True)]
+
+def _as_float(value):
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
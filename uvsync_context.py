@@ -2,6 +2,7 @@
 
 import sys, importlib
 from pathlib import Path
+from uvsync_format import has_format
 
 class UVSyncContextException(Exception):
     
@@ -12,9 +13,10 @@ class UVSyncContext():
     
     # Define a class used to hold all relevant information needed to synchronize a speciffic instrument
     
-    def __init__(self, instrument, uvsync_directory):
+    def __init__(self, instrument, uvsync_directory, options = None):
         
-        # Constructor, initialize all member variables
+        # Constructor, initialize all member variables.
+        # The optional options parameter is the [General] section of config.ini
         
         self.instrument_id = int(instrument.instrument_id)
         self.station_id = int(instrument.station_id)
@@ -54,14 +56,101 @@ class UVSyncContext():
         if self.match_expression is None:
             raise UVSyncContextException("Invalid match expression for instrument " + self.instrument_name)
 
+        # Name of the file format used by the generic validate_format and store_format modules (see uvsync_format.py).
+        # Taken from the optional format column, or from the name of the store module, e.g. store_GUVis-3511_bs
+        self.format_name = getattr(instrument, "format", None)
+        if self.format_name:
+            if not has_format(self.format_name):
+                raise UVSyncContextException("Unknown format " + self.format_name + " for instrument " + self.instrument_name)
+        else:
+            self.format_name = self.store_module_name.split("_", 1)[-1]
+            if not has_format(self.format_name):
+                self.format_name = None
+
         # Declare variables for all uvsync directories, and create them if they don't exist already
         self.directory_inbox = Path(uvsync_directory) / "inbox"
         self.directory_work = Path(uvsync_directory) / "work"
         self.directory_outbox = Path(uvsync_directory) / "outbox"
         self.directory_failed = Path(uvsync_directory) / "failed"        
+        self.directory_manifest = Path(uvsync_directory) / "manifest"
             
-        # List of files to store in the database, this list is filled by the validate module
+        # Files in the inbox and work directories for this instrument, found by uvsync.index_directories.
+        # None if the fetch and validate modules should list the directories themselves
+        self.inbox_files = None
+        self.work_files = None
+
+        # Files in the inbox completely written by this process, like finished FTP downloads, set by uvsync.run_contexts.
+        # These are ready to be moved without waiting for them to be stable (see uvsync_ready.py)
+        self.written_files = {}
+
+        # List of files to store in the database, this list is filled by the validate module, and
+        # counters and stage timings for this run, filled by the modules and by uvsync.run_context (see uvsync_metrics.py)
+        self.reset()
+
+        # Validate each row while it is stored, instead of reading each file once in the validate module and once in the store module
+        self.fused_validate_store = options.getboolean('fused_validate_store', fallback = False) if options is not None else False
+
+        # Read and validate each file as NumPy arrays in the validate and store modules (see uvsync_columnar.py)
+        self.columnar_parser = options.getboolean('columnar_parser', fallback = False) if options is not None else False
+
+        # Path to the ingestion ledger used to send only new rows from growing files, None to always store whole files
+        self.ingestion_ledger = options.get('ingestion_ledger', fallback = None) if options is not None else None
+
+        # Storage backend used by the store modules (see uvsync_storage.py), and the number of files to store in one transaction
+        self.storage_backend = options.get('storage_backend', fallback = 'odbc') if options is not None else 'odbc'
+        self.sqlite_database = options.get('sqlite_database', fallback = None) if options is not None else None
+        self.store_files_per_transaction = options.getint('store_files_per_transaction', fallback = 1) if options is not None else 1
+
+        # Directory of the local column store with a copy of the stored measurements, None to only store them in the database
+        self.column_store = options.get('column_store', fallback = None) if options is not None else None
+
+        # Buckets in seconds to aggregate the channel values of the stored measurements in, like 60, 3600 (see uvsync_aggregate.py)
+        resolutions = options.get('aggregate_resolutions', fallback = '') if options is not None else ''
+        self.aggregate_resolutions = [int(resolution) for resolution in resolutions.replace(',', ' ').split()]
+
+        # Number of rows to send to the database at a time while a file is being read, 0 to send all rows of a file at once
+        self.store_batch_size = options.getint('store_batch_size', fallback = 0) if options is not None else 0
+
+        # Compression of the files moved to the outbox directory, and whether they are packed in one bundle per station and month (see uvsync_archive.py)
+        self.archive_compression = options.get('archive_compression', fallback = 'none') if options is not None else 'none'
+        self.archive_bundle = options.getboolean('archive_bundle', fallback = False) if options is not None else False
+
+        # Number of times a file may fail with a temporary error before it is no longer retried, and the seconds to wait before the
+        # first retry, doubled for each attempt up to retry_backoff_max (see uvsync_retry.py)
+        self.retry_max_attempts = options.getint('retry_max_attempts', fallback = 5) if options is not None else 5
+        self.retry_backoff = options.getfloat('retry_backoff', fallback = 300.0) if options is not None else 300.0
+        self.retry_backoff_max = options.getfloat('retry_backoff_max', fallback = 86400.0) if options is not None else 86400.0
+
+        # Check used by fetch_copy to find files in the inbox that are completely written (see uvsync_ready.py)
+        self.ready_check = options.get('ready_check', fallback = 'auto') if options is not None else 'auto'
+        self.ready_stable_seconds = options.getfloat('ready_stable_seconds', fallback = 10.0) if options is not None else 10.0
+
+    def reset(self):
+
+        # Function used to clear the file list and the counters before each run of the context.
+        # In daemon mode the same context is run many times (see uvsync_daemon.py)
+
         self.sync_files = []
+        self.metrics = { "files_validated": 0, "files_stored": 0, "files_failed": 0, "files_deferred": 0, "rows_parsed": 0, "rows_inserted": 0 }
+
+    def __getstate__(self):
+
+        # Modules can not be pickled, so leave them out when a context is sent to a worker process
+
+        state = self.__dict__.copy()
+        del state["fetch_module"]
+        del state["validate_module"]
+        del state["store_module"]
+        return state
+
+    def __setstate__(self, state):
+
+        # Import the modules again by name when a context is received by a worker process
+
+        self.__dict__.update(state)
+        self.fetch_module = self.get_module(self.fetch_module_name)
+        self.validate_module = self.get_module(self.validate_module_name)
+        self.store_module = self.get_module(self.store_module_name)
 
     def get_module(self, module_name):        
 
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+import time, signal
+import uvsync, uvsync_profile
+from pathlib import Path
+from fnmatch import fnmatch
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from uvsync import ExitStatus
+from uvsync_metrics import UVSyncMetrics
+from uvsync_watch import create_watcher
+from uvsync_lease import station_resource
+
+# Longest time to wait for events before checking if the daemon should stop
+_MAX_WAIT = 5.0
+
+class UVSyncDaemon():
+
+    # Define a class used to run uvsync as a long running process instead of once an hour.
+    # The stations, the instrument contexts, the worker pool and the database connections are created once
+    # and kept between runs. The inbox directory is watched for new files, and each file is processed by the
+    # contexts with a matching match_expression a few seconds after it arrives. The work directory is not watched,
+    # as the files moved there by fetch would run the same contexts a second time. Files put in work by hand
+    # are processed by the next sweep.
+    # Each station is downloaded in the background every ftp_interval seconds, taken from the station or from config.ini.
+    # All contexts are run every daemon_sweep_interval seconds, and the stations and contexts are
+    # loaded from the database again every daemon_catalog_refresh seconds. Files in the failed directory are
+    # retried on each sweep, and when the earliest of them is due.
+    # With lease_backend in config.ini, only the stations this node holds leases on are downloaded and run, and
+    # the share of each node is claimed again every lease_duration / 3 seconds (see uvsync_lease.py)
+
+    def __init__(self, log, settings, connections, node = None):
+
+        # Constructor, initialize all member variables
+
+        self.log = log
+        self.settings = settings
+        self.connections = connections
+        self.catalog = uvsync.create_catalog(settings, connections)
+        self.leases = uvsync.create_leases(settings, connections, node)
+
+        options = settings.config['General']
+        self.ftp_interval = options.getfloat('ftp_interval', fallback = 3600.0)
+        self.settle_seconds = options.getfloat('daemon_settle_seconds', fallback = 2.0)
+        self.sweep_interval = options.getfloat('daemon_sweep_interval', fallback = 900.0)
+        self.catalog_refresh = options.getfloat('daemon_catalog_refresh', fallback = 3600.0)
+        self.watcher = options.get('daemon_watcher', fallback = 'auto')
+        self.poll_interval = options.getfloat('daemon_poll_interval', fallback = 5.0)
+        self.ready_stable_seconds = options.getfloat('ready_stable_seconds', fallback = 10.0)
+
+        self.stations = []
+        self.contexts = []
+
+        # Time of the next download for each station id, and the downloads in progress
+        self.next_download = {}
+        self.downloads = {}
+
+        # Time to run each instrument again, for instruments with files that were not ready when they were last run
+        self.retries = {}
+
+        # Time (time.time) the next file in the failed directory is due for a retry
+        self.next_failed_retry = None
+
+        # Time the share of this node is claimed again, None to claim it at once
+        self.next_assign = None
+
+        self.metrics = UVSyncMetrics()
+        self.stopping = False
+
+    def stop(self, *args):
+
+        # Function used to stop the daemon after the current run, also used as signal handler
+
+        self.log.info("Stopping uvsync daemon")
+        self.stopping = True
+
+    def load_catalog(self):
+
+        # Function used to load the stations and the instrument contexts from the catalog, which reads them from the
+        # database when they are older than catalog_ttl. Only stations and instruments that changed are created again.
+        # If the database can't be reached the stations and contexts already loaded are kept
+
+        try:
+            stations = uvsync.create_stations(self.log, self.catalog, self.settings.uvsync_directory)
+            contexts = uvsync.create_contexts(self.log, self.catalog, self.settings.config, self.settings.uvsync_directory)
+        except Exception as ex:
+            self.log.error("Unable to load stations and instruments: %s", ex, exc_info=True)
+            return False
+
+        self.stations = stations
+        self.contexts = contexts
+        self.log.info("Loaded %d stations and %d instruments", len(stations), len(contexts))
+        return True
+
+    def assign_leases(self):
+
+        # Function used to claim this node's share of the stations. On error the leases already held are kept.
+        # Returns True if this node got new stations
+
+        if self.leases is None:
+            return False
+        try:
+            held = set(self.leases.held)
+            return len(self.leases.acquire(self.log, [station_resource(station.station_id) for station in self.stations]) - held) > 0
+        except Exception as ex:
+            self.log.error("Unable to claim leases: %s", ex, exc_info=True)
+            return False
+
+    def held_stations(self):
+
+        return self.stations if self.leases is None else self.leases.select(self.stations)
+
+    def held_contexts(self):
+
+        return self.contexts if self.leases is None else self.leases.select(self.contexts)
+
+    def start_downloads(self, downloader, now):
+
+        # Function used to start a download for each station that is due and not already downloading
+
+        currdate = date.today().strftime("%y%m%d")
+        for station in self.held_stations():
+            if station.station_id in self.downloads or self.next_download.get(station.station_id, 0) > now:
+                continue
+            interval = float(station.ftp_interval) if station.ftp_interval else self.ftp_interval
+            self.next_download[station.station_id] = now + interval
+            self.downloads[station.station_id] = downloader.submit(uvsync.download_station, self.log, station, currdate)
+
+    def collect_downloads(self):
+
+        # Function used to log the summary of finished downloads. Returns True if any download finished
+
+        finished = False
+        for station_id, future in list(self.downloads.items()):
+            if not future.done():
+                continue
+            del self.downloads[station_id]
+            finished = True
+            try:
+                result = future.result()
+                self.log.info("Download summary for station %s", result)
+                self.metrics.add_station(result)
+            except Exception as ex:
+                self.log.error(str(ex), exc_info=True)
+        return finished
+
+    def select_contexts(self, names):
+
+        # Function used to get the contexts matching any of the given file names, or all contexts if names is None
+
+        if names is None:
+            return self.held_contexts()
+        return [ctx for ctx in self.held_contexts() if any(fnmatch(name, ctx.match_expression) for name in names)]
+
+    def select_retries(self, now):
+
+        # Function used to get the contexts that should run again because some of their files were not ready
+
+        due = [instrument_id for instrument_id, retry in self.retries.items() if retry <= now]
+        for instrument_id in due:
+            del self.retries[instrument_id]
+        return [ctx for ctx in self.held_contexts() if ctx.instrument_id in due]
+
+    def schedule_retries(self, contexts, now):
+
+        # Function used to run contexts again when their files have had time to settle, since
+        # files that were not ready may not cause any new events
+
+        for ctx in contexts:
+            if self.metrics.instruments.get(ctx.instrument_name, {}).get("files_deferred"):
+                self.retries[ctx.instrument_id] = now + self.ready_stable_seconds
+
+    def wait(self, watcher, now, swept, loaded):
+
+        # Function used to wait for new files until the next download, sweep or catalog refresh is due.
+        # Returns the set of new or changed file names, or None if any file may have changed
+
+        timeout = min(_MAX_WAIT, swept + self.sweep_interval - now, loaded + self.catalog_refresh - now)
+        for station in self.held_stations():
+            if station.station_id not in self.downloads:
+                timeout = min(timeout, self.next_download.get(station.station_id, 0) - now)
+        if len(self.downloads):
+            timeout = min(timeout, 1.0)
+        if self.next_failed_retry is not None:
+            timeout = min(timeout, self.next_failed_retry - time.time())
+        if self.next_assign is not None:
+            timeout = min(timeout, self.next_assign - now)
+        for retry in self.retries.values():
+            timeout = min(timeout, retry - now)
+
+        names = watcher.wait(max(timeout, 0))
+
+        # Wait until no more files arrive for settle_seconds, so files copied together are processed together
+        while (names is None or len(names)) and not self.stopping:
+            more = watcher.wait(self.settle_seconds)
+            if more is not None and not len(more):
+                break
+            names = None if more is None or names is None else names | more
+
+        return names
+
+    def run(self):
+
+        # Main loop of the daemon, returns when stop is called or a SIGTERM is received
+
+        settings = self.settings
+        status = ExitStatus.Success
+
+        if not self.load_catalog():
+            return ExitStatus.Error
+        loaded = time.monotonic()
+
+        signal.signal(signal.SIGTERM, self.stop)
+
+        directory = Path(settings.uvsync_directory) / "inbox"
+        watcher = create_watcher([directory], self.watcher, self.poll_interval)
+        self.log.info("Watching %s with %s", directory, type(watcher).__name__)
+
+        downloader = ThreadPoolExecutor(max_workers = settings.download_workers)
+        executor, listener = uvsync.create_executor(self.log, settings.pipeline_workers, settings.pipeline_executor)
+
+        try:
+            # Run all contexts at start, for files that arrived while the daemon was not running
+            names = None
+            swept = time.monotonic()
+            if self.leases is not None:
+                self.leases.start()
+
+            while not self.stopping:
+                now = time.monotonic()
+
+                if now - loaded >= self.catalog_refresh:
+                    self.load_catalog()
+                    loaded = now
+                    self.next_assign = None
+
+                    # Merge the profiles written since the last refresh when the daemon runs with --profile
+                    try:
+                        uvsync_profile.merge(self.log)
+                    except Exception as ex:
+                        self.log.error("Unable to merge profiles: %s", ex, exc_info=True)
+
+                # Claim the share of this node again, and run all contexts if it got new stations
+                if self.leases is not None and (self.next_assign is None or now >= self.next_assign):
+                    if self.assign_leases():
+                        names = None
+                    self.next_assign = now + self.leases.duration / 3.0
+
+                changed = self.collect_downloads()
+                self.start_downloads(downloader, now)
+
+                if now - swept >= self.sweep_interval:
+                    names = None
+                    swept = now
+
+                contexts = self.select_contexts(names) if names is None or len(names) else []
+                contexts += [ctx for ctx in self.select_retries(now) if ctx not in contexts]
+                if len(contexts):
+                    self.log.info("Running %d instruments", len(contexts))
+                    uvsync.index_directories(self.log, self.contexts, settings.uvsync_directory, self.metrics)
+                    status = uvsync.run_contexts(self.log, self.connections, contexts, executor, self.metrics)
+                    self.schedule_retries(contexts, time.monotonic())
+                    changed = True
+
+                if names is None or (self.next_failed_retry is not None and self.next_failed_retry <= time.time()):
+                    scan = uvsync.retry_failed(self.log, self.connections, self.held_contexts(), settings.config, executor, self.metrics)
+                    self.next_failed_retry = scan.next_retry if scan is not None else None
+                    changed = True
+
+                if changed:
+                    uvsync.write_metrics(self.log, settings.config, self.metrics, status)
+
+                names = self.wait(watcher, time.monotonic(), swept, loaded)
+
+        except KeyboardInterrupt:
+            self.stop()
+        finally:
+            # Release the leases, so the other nodes take over the stations at once
+            if self.leases is not None:
+                self.leases.stop(release = True)
+            watcher.close()
+            downloader.shutdown()
+            if executor is not None:
+                executor.shutdown()
+            if listener is not None:
+                listener.stop()
+
+        return ExitStatus.Success
+
+def run(log, config_file = None, node = None):
+
+    # Function used to start uvsync in daemon mode, see uvsync.py --daemon
+
+    try:
+        settings = uvsync.load_settings(log, config_file)
+        connections = uvsync.create_connections(settings)
+    except Exception as ex:
+        log.error(str(ex), exc_info=True)
+        return ExitStatus.Error
+
+    try:
+        return UVSyncDaemon(log, settings, connections, node).run()
+    finally:
+        connections.close()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import time, logging, threading
+from contextlib import contextmanager
+
+_log = logging.getLogger("uvsync")
+
+class UVSyncDBException(Exception):
+
+    # Exception class used to report UVSyncConnectionManager speciffic errors
+    pass
+
+class UVSyncConnectionManager():
+
+    # Define a class used to share database connections during a run.
+    # uvsync.main creates one connection manager, which is passed to the store modules.
+    # Connections are returned to a pool when they are released, and are reused by the next caller.
+    # A connection that has been idle in the pool for more than health_check_interval seconds is checked
+    # before it is handed out. New connections are opened with exponential backoff between failed attempts.
+    # Connections are opened with autocommit off, so each caller controls its own transactions
+
+    def __init__(self, connection_string, pool_size = 4, connect_retries = 3, connect_backoff = 2.0, health_check_interval = 30.0, connect = None):
+
+        # Constructor, initialize all member variables.
+        # The optional connect parameter is the function used to open a connection, pyodbc.connect by default
+
+        self.connection_string = connection_string
+        self.pool_size = pool_size
+        self.connect_retries = connect_retries
+        self.connect_backoff = connect_backoff
+        self.health_check_interval = health_check_interval
+        self.connect = connect
+        self.pool = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+
+        # Connections can not be sent to a worker process, so each process starts with an empty pool
+
+        state = self.__dict__.copy()
+        state["pool"] = []
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __open(self):
+
+        # Function used to open a new connection, retrying with exponential backoff
+
+        connect = self.connect
+        if connect is None:
+            import pyodbc
+            connect = pyodbc.connect
+
+        delay = self.connect_backoff
+        for attempt in range(1, self.connect_retries + 1):
+            try:
+                return connect(self.connection_string, autocommit = False)
+            except Exception as ex:
+                if attempt == self.connect_retries:
+                    raise UVSyncDBException("Unable to connect to database after %d attempts: %s" % (attempt, str(ex)))
+                _log.info("Unable to connect to database (attempt %d), retrying in %.1f seconds: %s", attempt, delay, ex)
+                time.sleep(delay)
+                delay *= 2
+
+    def __is_healthy(self, connection):
+
+        # Function used to check that a connection still works
+
+        try:
+            connection.cursor().execute("select 1").fetchall()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+
+        # Function used to get a connection from the pool, or a new connection if the pool is empty
+
+        while True:
+            with self.lock:
+                if not len(self.pool):
+                    break
+                connection, released = self.pool.pop()
+
+            if time.monotonic() - released < self.health_check_interval or self.__is_healthy(connection):
+                return connection
+
+            _log.info("Discarding broken database connection")
+            self.__close(connection)
+
+        return self.__open()
+
+    def release(self, connection, healthy = True):
+
+        # Function used to return a connection to the pool. Any open transaction is rolled back.
+        # Connections that are not healthy, or that don't fit in the pool, are closed
+
+        if healthy:
+            try:
+                connection.rollback()
+            except Exception:
+                healthy = False
+
+        if healthy:
+            with self.lock:
+                if len(self.pool) < self.pool_size:
+                    self.pool.append((connection, time.monotonic()))
+                    return
+
+        self.__close(connection)
+
+    @contextmanager
+    def connection(self):
+
+        # Context manager used to borrow a connection from the pool for the duration of a with block
+
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def __close(self, connection):
+
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+
+        # Function used to close all connections in the pool, at the end of a run
+
+        with self.lock:
+            pool = self.pool
+            self.pool = []
+        for connection, released in pool:
+            self.__close(connection)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from operator import itemgetter
+
+class UVSyncFormatException(Exception):
+
+    # Exception class used to report UVSyncFormat speciffic errors
+    pass
+
+class UVSyncFormat():
+
+    # Define a class used to declare the layout of the UV log files written by a speciffic type of instrument.
+    # Each format is declared once in this file, and compiled into itemgetter based extractors used by the
+    # generic validate_format and store_format modules, so new instruments don't need their own modules.
+    #
+    #   name               Name of the format, used to find it in the registry
+    #   column_count       Number of columns in each row
+    #   mode               Expected value of the Measurement Mode column (the first column)
+    #   timestamp_column   Column holding the date/time of each row, in timestamp_format
+    #   channel_columns    Columns holding the channel values, passed to the database in this order
+    #   aux_columns        Columns passed to the database after the channel values
+    #   filter_column      Column used to select the rows to store, None to store all rows
+    #   filter_values      Values of filter_column for the rows to store
+
+    def __init__(self, name, column_count, mode, channel_columns, aux_columns,
+                 timestamp_column = 2, timestamp_format = "%Y-%m-%d %H:%M:%S", filter_column = None, filter_values = ()):
+
+        # Constructor, initialize all member variables and compile the extractors
+
+        self.name = name
+        self.column_count = column_count
+        self.mode = mode
+        self.channel_columns = list(channel_columns)
+        self.aux_columns = list(aux_columns)
+        self.timestamp_column = timestamp_column
+        self.timestamp_format = timestamp_format
+        self.filter_column = filter_column
+        self.filter_values = tuple(filter_values)
+
+        for column in self.channel_columns + self.aux_columns + [timestamp_column]:
+            if column >= column_count:
+                raise UVSyncFormatException("Column %d is out of range for format %s" % (column, name))
+
+        # Get the date/time field of a row
+        self.timestamp = itemgetter(timestamp_column)
+
+        # Get the values passed to the database for a row, channel values first, as one tuple
+        self.values = itemgetter(*(self.channel_columns + self.aux_columns))
+
+        # Filter used on (row, date/time) pairs to select the rows to store, None if all rows are stored
+        self.accept = None
+        if filter_column is not None:
+            accepted = frozenset(self.filter_values)
+            select = itemgetter(filter_column)
+            self.accept = lambda pair: select(pair[0]) in accepted
+
+# Registry of all known formats, by name
+_formats = {}
+
+def register_format(fmt):
+
+    # Function used to add a format to the registry
+
+    if fmt.name in _formats:
+        raise UVSyncFormatException("Format %s is already registered" % fmt.name)
+    _formats[fmt.name] = fmt
+    return fmt
+
+def get_format(name):
+
+    # Function used to get a format from the registry
+
+    if name not in _formats:
+        raise UVSyncFormatException("Unknown format " + str(name))
+    return _formats[name]
+
+def has_format(name):
+
+    return name in _formats
+
+# GUVis-3511, all rows are stored
+register_format(UVSyncFormat("GUVis-3511", column_count = 30, mode = "0",
+    channel_columns = range(7, 27), aux_columns = (28, 27)))
+
+# GUVis-3511 with BioShade, only rows with BioShadeMode 'P' or 'Z' are stored
+register_format(UVSyncFormat("GUVis-3511_bs", column_count = 32, mode = "3",
+    channel_columns = range(7, 27), aux_columns = (30, 29), filter_column = 28, filter_values = ("P", "Z")))
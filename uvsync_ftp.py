@@ -1,14 +1,85 @@
 # -*- coding: utf-8 -*-
 
-import os
+import os, json, time
+import uvsync_ready
 from pathlib import Path
-from ftplib import FTP, error_perm
+from ftplib import FTP, error_perm, error_reply
 
 class UVSyncFTPException(Exception):
     
     # Exception class used to report UVSyncFTP speciffic errors    
     pass
 
+class UVSyncFTPResult():
+
+    # Define a class used to summarize the outcome of a download from a speciffic station
+
+    def __init__(self, station_name):
+
+        # Constructor, initialize all member variables
+
+        self.station_name = station_name
+        self.files_downloaded = 0
+        self.files_skipped = 0
+        self.files_failed = 0
+        self.bytes_downloaded = 0
+        self.error = None
+
+        # Wall time in seconds spent connecting and logging in, listing remote files and transferring files
+        self.connect_seconds = 0.0
+        self.list_seconds = 0.0
+        self.transfer_seconds = 0.0
+
+    def __str__(self):
+
+        status = "OK" if self.error is None and self.files_failed == 0 else "FAILED"
+        return "%s: %s, %d files downloaded (%d bytes), %d files unchanged, %d files failed" % (
+            self.station_name, status, self.files_downloaded, self.bytes_downloaded, self.files_skipped, self.files_failed)
+
+class UVSyncFTPManifest():
+
+    # Define a class used to remember the remote size and timestamp of every file transferred from a station,
+    # so unchanged files can be skipped and growing files can be resumed on the next run
+
+    def __init__(self, path):
+
+        # Constructor, load the manifest from disk if it exists
+
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with self.path.open() as fd:
+                self.entries = json.load(fd)
+
+    def get(self, file):
+
+        return self.entries.get(file)
+
+    def update(self, file, size, modify):
+
+        self.entries[file] = { "size": size, "modify": modify }
+
+    def remove(self, file):
+
+        self.entries.pop(file, None)
+
+    def prune(self, files):
+
+        # Forget files that are no longer present on the remote machine
+
+        for file in list(self.entries):
+            if file not in files:
+                del self.entries[file]
+
+    def save(self):
+
+        # Write to a temporary file first so an interrupted run never leaves a truncated manifest behind
+
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w") as fd:
+            json.dump(self.entries, fd, indent = 1, sort_keys = True)
+        os.replace(tmp, self.path)
+
 class UVSyncFTP():
     
     # Define a class used to hold all relevant information needed to download from a station
@@ -26,6 +97,9 @@ class UVSyncFTP():
             raise UVSyncFTPException("Missing FTP host for station " + self.station_name)
         self.ftp_host = station.ftp_host        
 
+        # Port of the FTP server, taken from the optional ftp_port column. Defaults to 21
+        self.ftp_port = int(getattr(station, "ftp_port", None) or 21)
+
         if not station.ftp_user:
             raise UVSyncFTPException("Missing FTP user for station " + self.station_name)
         self.ftp_user = station.ftp_user
@@ -38,72 +112,167 @@ class UVSyncFTP():
         self.ftp_local_dir = station.ftp_local_dir        
         self.ftp_passive_mode = int(station.ftp_passive_mode)
 
+        # Seconds between downloads from this station in daemon mode, taken from the optional ftp_interval column.
+        # None to use ftp_interval in config.ini
+        self.ftp_interval = getattr(station, "ftp_interval", None)
+
         # Declare variables for all uvsync directories, and create them if they don't exist already
         self.directory_inbox = Path(uvsync_directory) / "inbox"
         self.directory_work = Path(uvsync_directory) / "work"
         self.directory_outbox = Path(uvsync_directory) / "outbox"
         self.directory_failed = Path(uvsync_directory) / "failed"
+        self.directory_manifest = Path(uvsync_directory) / "manifest"
 
     def download(self, log, currdate):
         
-        # Function used to download UV log files from a speciffic station
+        # Function used to download UV log files from a speciffic station.
+        # Each call opens its own FTP session and never changes the working directory of the process,
+        # so several stations can be downloaded concurrently. Returns a UVSyncFTPResult summary
         
+        result = UVSyncFTPResult(self.station_name)
+        manifest = None
+
         try:
-            log.info("Retrieving files for station %s" % self.station_name)
-            log.info("Logging in to host %s as %s" % (self.ftp_host, self.ftp_user))
+            log.info("Retrieving files for station %s", self.station_name)
+            manifest = UVSyncFTPManifest(self.directory_manifest / ("%d.json" % self.station_id))
+
+            log.info("Logging in to host %s as %s", self.ftp_host, self.ftp_user)
 
             # Open FTP connection
-            with FTP(self.ftp_host) as ftp:                
+            t0 = time.perf_counter()
+            with FTP() as ftp:                
+                ftp.connect(self.ftp_host, self.ftp_port)
                 ftp.login(user=self.ftp_user, passwd=self.ftp_password)            
+                result.connect_seconds = time.perf_counter() - t0
                 
-                log.info("Set FTP passive mode: %d" % self.ftp_passive_mode)
+                log.info("Set FTP passive mode: %d", self.ftp_passive_mode)
                 ftp.set_pasv(self.ftp_passive_mode)
 
-                # Change local and remote directory
+                # Change remote directory and resolve the local directory without touching the process working directory
                 if self.ftp_remote_dir:
-                    log.info("Changing remote directory to %s" % self.ftp_remote_dir)
+                    log.info("Changing remote directory to %s", self.ftp_remote_dir)
                     ftp.cwd(self.ftp_remote_dir)                
-                if self.ftp_local_dir:
-                    log.info("Changing local directory to %s" % self.ftp_local_dir)
-                    os.chdir(self.ftp_local_dir)                
+                local_dir = Path(self.ftp_local_dir) if self.ftp_local_dir else Path.cwd()
+                log.info("Using local directory %s", local_dir)
 
-                # Get a list of remote files
-                files = ftp.nlst()            
-                for file in files:
+                # Get a list of remote files with size and modification time
+                t0 = time.perf_counter()
+                files = self.__list_files(log, ftp)
+                result.list_seconds = time.perf_counter() - t0
+                manifest.prune(files)
+                for file, (size, modify) in files.items():
                     # Call the 'handle_file' function for each UV log file
                     if file.find("_C_") != -1:
-                        self.__handle_file(log, ftp, file, currdate)                
+                        t0 = time.perf_counter()
+                        nbytes = self.__handle_file(log, ftp, manifest, file, size, modify, local_dir / file, currdate)
+                        result.transfer_seconds += time.perf_counter() - t0
+                        if nbytes is None:
+                            result.files_failed += 1
+                        elif nbytes > 0:
+                            result.files_downloaded += 1
+                            result.bytes_downloaded += nbytes
+                        else:
+                            result.files_skipped += 1
 
         except Exception as ex:
+            result.error = ex
             log.error(str(ex), exc_info=True) 
+        finally:
+            if manifest is not None:
+                try:
+                    manifest.save()
+                except Exception as ex:
+                    log.error("Unable to save manifest for station %s: %s", self.station_name, ex)
+
+        return result
+
+    def __list_files(self, log, ftp):
+
+        # Function used to list remote files as a dictionary of file name to (size, modify).
+        # MLSD is used where the server supports it, otherwise NLST followed by SIZE and MDTM for each file.
+        # Size and modify are None if the server is unable to report them
 
-    def __handle_file(self, log, ftp, file, currdate):
+        files = {}
+        try:
+            for file, facts in ftp.mlsd(facts = ["type", "size", "modify"]):
+                if facts.get("type", "file") != "file":
+                    continue
+                size = int(facts["size"]) if "size" in facts else None
+                files[file] = (size, facts.get("modify"))
+            return files
+        except (error_perm, error_reply):
+            log.info("MLSD not supported by host %s, using NLST", self.ftp_host)
+
+        ftp.voidcmd("TYPE I")
+        for file in ftp.nlst():
+            size = None
+            modify = None
+            if file.find("_C_") != -1:
+                try:
+                    size = ftp.size(file)
+                except (error_perm, error_reply):
+                    pass
+                try:
+                    modify = ftp.voidcmd("MDTM " + file).split()[-1]
+                except (error_perm, error_reply):
+                    pass
+            files[file] = (size, modify)
+        return files
+
+    def __handle_file(self, log, ftp, manifest, file, size, modify, local_file, currdate):
         
-        # Function used to download a speciffic UV log file using FTP
+        # Function used to download a speciffic UV log file using FTP.
+        # Files whose remote size and timestamp match the manifest are skipped, and a file that has grown
+        # since the last run is resumed from the last byte received if the partial copy is still in the local directory.
+        # Returns the number of bytes received, 0 if the file was unchanged, or None if the transfer failed
         
         try:
-            log.info("Transfering remote file %s" % file)
-            # Create a new file locally
-            with open(file, 'wb') as f:        
-                # Set up a callback function to receive blocks of data from FTP
-                def callback(data):
-                    f.write(data)
-
-                # Start downloading the file
-                ftp.retrbinary("RETR %s" % file, callback)                    
-
-                # Check if downloaded file is from today, if not, try to delete it on the remote machine
-                filedate = file.split("_")[3]
-                filedate = filedate.split(".")[0]                
-                if filedate != currdate:
-                    try:
-                        log.info("Deleting old remote file %s" % file)
-                        ftp.delete(file)
-                    except:
-                        log.error("Unable to delete old remote file %s" % file)
+            entry = manifest.get(file)
+            nbytes = 0
+
+            if entry is not None and size is not None and modify is not None and entry["size"] == size and entry["modify"] == modify:
+                log.info("Remote file %s is unchanged, skipping", file)
+            else:
+                offset = 0
+                if entry is not None and size is not None and size > entry["size"] and local_file.exists() and local_file.stat().st_size == entry["size"]:
+                    offset = entry["size"]
+
+                if offset:
+                    log.info("Resuming remote file %s to %s from byte %d", file, local_file, offset)
+                else:
+                    log.info("Transfering remote file %s to %s", file, local_file)
+
+                # Create a new file locally, or append to the partial copy when resuming
+                with open(local_file, 'ab' if offset else 'wb') as f:        
+                    # Set up a callback function to receive blocks of data from FTP
+                    def callback(data):
+                        nonlocal nbytes
+                        nbytes += len(data)
+                        f.write(data)
+
+                    # Start downloading the file
+                    ftp.retrbinary("RETR %s" % file, callback, rest = offset if offset else None)
+
+                manifest.update(file, offset + nbytes, modify)
+
+                # The download is complete, so the file can be moved from the inbox without waiting for it to be stable
+                uvsync_ready.mark_written(local_file)
+
+            # Check if downloaded file is from today, if not, try to delete it on the remote machine
+            filedate = file.split("_")[3]
+            filedate = filedate.split(".")[0]                
+            if filedate != currdate:
+                try:
+                    log.info("Deleting old remote file %s", file)
+                    ftp.delete(file)
+                    manifest.remove(file)
+                except:
+                    log.error("Unable to delete old remote file %s", file)
+            return nbytes
         except error_perm as ep:
-            log.error("File permission error " + str(ep)) 
-            if os.path.isfile(file):
-                os.remove(file)
+            log.error("File permission error %s", ep) 
+            if os.path.isfile(local_file):
+                os.remove(local_file)
         except Exception as ex:
-            log.error(str(ex), exc_info=True) 
\ No newline at end of file
+            log.error(str(ex), exc_info=True) 
+        return None
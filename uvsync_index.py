@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import os, re
+from fnmatch import translate
+from pathlib import Path
+
+class UVSyncDirectoryIndex():
+
+    # Define a class used to list a directory once per run and find the instrument of each file, by matching
+    # the file name against the match_expression of all contexts. The fetch and validate modules use the files
+    # found for their context (ctx.inbox_files and ctx.work_files) instead of listing the directory themselves.
+    # A file matching several instruments is given to the first of them, in the order of the contexts
+
+    def __init__(self, directory, contexts):
+
+        # Constructor, list the directory and build the index
+
+        self.directory = Path(directory)
+        self.files = {}
+        self.unmatched = []
+        self.ambiguous = []
+        self.count = 0
+
+        # Compile each distinct expression once, as glob does, several instruments may share an expression.
+        # All expressions are also combined in one pattern, so files that match no instrument are found in one step
+        expressions = {}
+        for ctx in contexts:
+            expressions.setdefault(ctx.match_expression, []).append(ctx)
+        patterns = [(re.compile(translate(os.path.normcase(expression))), matching) for expression, matching in expressions.items()]
+        combined = re.compile("|".join("(?:%s)" % pattern.pattern for pattern, matching in patterns)) if len(patterns) else None
+
+        with os.scandir(self.directory) as entries:
+            names = sorted(entry.name for entry in entries if entry.is_file())
+
+        for name in names:
+            self.count += 1
+            path = self.directory / name
+            key = os.path.normcase(name)
+
+            if combined is None or not combined.match(key):
+                self.unmatched.append(path)
+                continue
+
+            matches = [ctx for pattern, matching in patterns if pattern.match(key) for ctx in matching]
+            if len(matches) > 1:
+                self.ambiguous.append((path, matches))
+            self.files.setdefault(matches[0].instrument_id, []).append(path)
+
+    def get_files(self, ctx):
+
+        # Function used to get the files of a speciffic instrument, sorted by name
+
+        return list(self.files.get(ctx.instrument_id, []))
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+import os, json, math, time, socket, hashlib, logging, threading
+from pathlib import Path
+
+_log = logging.getLogger("uvsync")
+
+# Prefix of the leases used by each node to tell the other nodes it is alive
+NODE_PREFIX = "node:"
+
+class UVSyncLeaseException(Exception):
+
+    # Exception class used to report UVSyncLease speciffic errors
+    pass
+
+class UVSyncDirectoryLeaseStore():
+
+    # Define a class used to keep leases in a directory shared by all nodes, like a network share.
+    # All leases are kept in one JSON file, leases.json, which is only read and written while holding leases.lock.
+    # The lock file is created with O_EXCL, which works on network shares where fcntl and msvcrt locks may not.
+    # A lock file older than stale_seconds is left by a node that stopped while holding it, and is removed.
+    # It is first renamed to a name of this node's own, so only one of the nodes finding it stale removes it.
+    # The expiry times use the clock of each node, so the clocks of the nodes must be in sync
+
+    def __init__(self, directory, stale_seconds = 30.0):
+
+        # Constructor, initialize all member variables
+
+        self.directory = Path(directory)
+        self.path = self.directory / "leases.json"
+        self.lock_path = self.directory / "leases.lock"
+        self.stale_seconds = stale_seconds
+        os.makedirs(self.directory, exist_ok = True)
+
+    def __lock(self):
+
+        # Function used to create the lock file, waiting while another node holds it
+
+        deadline = time.time() + self.stale_seconds * 2
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode("ascii"))
+                os.close(fd)
+                return
+            except FileExistsError:
+                pass
+            try:
+                if time.time() - os.stat(self.lock_path).st_mtime > self.stale_seconds:
+                    self.__remove_stale()
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() > deadline:
+                raise UVSyncLeaseException("Timeout waiting for " + str(self.lock_path))
+            time.sleep(0.05)
+
+    def __remove_stale(self):
+
+        # Rename the stale lock file before removing it. Another node may have removed the stale lock and created a
+        # new one since it was found stale, so the renamed file is only removed if it is still stale, otherwise it is
+        # put back. The rename fails with FileNotFoundError if another node got there first
+
+        stale_path = self.lock_path.with_name("%s.%s.%d.%d" % (self.lock_path.name, socket.gethostname(), os.getpid(), threading.get_ident()))
+        os.rename(self.lock_path, stale_path)
+        if time.time() - os.stat(stale_path).st_mtime > self.stale_seconds:
+            _log.info("Removing stale lease lock %s", self.lock_path)
+            os.remove(stale_path)
+            return
+        try:
+            os.link(stale_path, self.lock_path)
+        except FileExistsError:
+            _log.error("Lease lock %s was taken while it was put back", self.lock_path)
+        except OSError:
+            # The share has no hard links, put the lock back by renaming it instead
+            os.rename(stale_path, self.lock_path)
+            return
+        os.remove(stale_path)
+
+    def __unlock(self):
+
+        try:
+            os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass
+
+    def __read(self):
+
+        if not self.path.exists():
+            return {}
+        with self.path.open() as fd:
+            return json.load(fd)
+
+    def __write(self, leases):
+
+        # Write to a temporary file first so a node that stops never leaves a truncated file behind
+
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w") as fd:
+            json.dump(leases, fd, indent = 1, sort_keys = True)
+        os.replace(tmp, self.path)
+
+    def leases(self):
+
+        # Function used to get the leases that have not expired, as a dictionary from resource to (node, seconds left)
+
+        self.__lock()
+        try:
+            leases = self.__read()
+        finally:
+            self.__unlock()
+        now = time.time()
+        return dict((resource, (lease["node"], lease["expires"] - now)) for resource, lease in leases.items() if lease["expires"] > now)
+
+    def claim(self, resource, node, duration):
+
+        # Function used to claim or renew a lease for duration seconds. Fails if another node holds a lease that has not expired
+
+        self.__lock()
+        try:
+            leases = self.__read()
+            now = time.time()
+            lease = leases.get(resource)
+            if lease is not None and lease["node"] != node and lease["expires"] > now:
+                return False
+            leases[resource] = { "node": node, "expires": now + duration }
+
+            # Leases that expired long ago are removed, so the file only holds leases of resources still in use
+            for name, lease in list(leases.items()):
+                if lease["expires"] < now - 86400:
+                    del leases[name]
+            self.__write(leases)
+            return True
+        finally:
+            self.__unlock()
+
+    def release(self, resource, node):
+
+        # Function used to give up a lease, so another node can claim it at once
+
+        self.__lock()
+        try:
+            leases = self.__read()
+            lease = leases.get(resource)
+            if lease is not None and lease["node"] == node:
+                del leases[resource]
+                self.__write(leases)
+        finally:
+            self.__unlock()
+
+class UVSyncDatabaseLeaseStore():
+
+    # Define a class used to keep leases in the database, with the procedures claim_uvsync_lease,
+    # release_uvsync_lease and select_uvsync_leases. The procedures use the clock of the database, so the clocks
+    # of the nodes don't need to be in sync. claim_uvsync_lease must claim or renew the lease in one statement,
+    # and return 1 if the lease is held by the node afterwards, otherwise 0
+
+    def __init__(self, connections):
+
+        # Constructor, initialize all member variables
+
+        self.connections = connections
+
+    def leases(self):
+
+        with self.connections.connection() as connection:
+            rows = connection.cursor().execute("exec select_uvsync_leases").fetchall()
+        return dict((row[0], (row[1], float(row[2]))) for row in rows if float(row[2]) > 0)
+
+    def claim(self, resource, node, duration):
+
+        with self.connections.connection() as connection:
+            claimed = connection.cursor().execute("exec claim_uvsync_lease ?, ?, ?", resource, node, int(math.ceil(duration))).fetchall()[0][0]
+            connection.commit()
+        return bool(claimed)
+
+    def release(self, resource, node):
+
+        with self.connections.connection() as connection:
+            connection.cursor().execute("exec release_uvsync_lease ?, ?", resource, node)
+            connection.commit()
+
+class UVSyncLeases():
+
+    # Define a class used to share the stations between several uvsync nodes. Each node holds a lease on each
+    # of its stations, and only downloads from these stations and runs their instruments. The leases are renewed
+    # every duration / 3 seconds while the node runs. The leases of a node that stops or crashes expire after
+    # duration seconds and are taken over by the other nodes.
+    #
+    # Each node also holds a lease on itself (node:<name>), so the nodes can count each other and claim an equal
+    # share of the stations. Each node prefers the stations in its own order, given by a hash of the node
+    # and station, so nodes rarely compete for the same stations and keep their stations between runs.
+    #
+    # A one-shot run claims its share only once, so it waits settle_seconds after registering and claims its share
+    # again (see settle), giving nodes started at about the same time an equal share. The daemon claims its share
+    # again every duration / 3 seconds instead
+
+    def __init__(self, store, node, duration = 600.0, settle_seconds = 10.0):
+
+        # Constructor, initialize all member variables
+
+        self.store = store
+        self.node = node
+        self.duration = duration
+        self.settle_seconds = settle_seconds
+        self.held = set()
+        self.lock = threading.Lock()
+        self.renewing = None
+        self.stopping = threading.Event()
+
+    def __preference(self, resource):
+
+        return hashlib.sha256((self.node + "|" + resource).encode("utf-8")).hexdigest()
+
+    def acquire(self, log, resources):
+
+        # Function used to claim this node's share of the resources, and give up resources above the share
+        # so nodes that just started can claim them. Returns the set of resources held
+
+        self.store.claim(NODE_PREFIX + self.node, self.node, self.duration)
+        leases = self.store.leases()
+        nodes = set(lease[0] for resource, lease in leases.items() if resource.startswith(NODE_PREFIX)) | { self.node }
+        share = int(math.ceil(len(resources) / float(len(nodes))))
+
+        ordered = sorted(set(resources), key = self.__preference)
+        held = [resource for resource in ordered if leases.get(resource, (None,))[0] == self.node]
+        for resource in held[share:]:
+            log.info("Releasing lease on %s to other nodes", resource)
+            self.store.release(resource, self.node)
+        held = [resource for resource in held[:share] if self.store.claim(resource, self.node, self.duration)]
+
+        for resource in ordered:
+            if len(held) >= share:
+                break
+            if resource in held or resource in leases:
+                continue
+            if self.store.claim(resource, self.node, self.duration):
+                log.info("Claimed lease on %s", resource)
+                held.append(resource)
+
+        with self.lock:
+            self.held = set(held)
+        log.info("Node %s holds %d of %d leases (%d nodes)", self.node, len(held), len(ordered), len(nodes))
+        return set(held)
+
+    def settle(self, log, resources):
+
+        # Function used by a one-shot run to claim this node's share of the resources. The first acquire registers the
+        # node, and the second, settle_seconds later, gives up the resources above the share if other nodes registered
+        # meanwhile, and claims resources given up by other nodes. Returns the set of resources held
+
+        held = self.acquire(log, resources)
+        if self.settle_seconds <= 0:
+            return held
+        log.info("Waiting %g seconds for other nodes to register", self.settle_seconds)
+        time.sleep(self.settle_seconds)
+        return self.acquire(log, resources)
+
+    def holds(self, resource):
+
+        with self.lock:
+            return resource in self.held
+
+    def select(self, items):
+
+        # Function used to get the stations or contexts of the stations this node holds leases on
+
+        return [item for item in items if self.holds(station_resource(item.station_id))]
+
+    def renew(self):
+
+        # Function used to renew the leases held, leases taken over by other nodes are dropped
+
+        self.store.claim(NODE_PREFIX + self.node, self.node, self.duration)
+        with self.lock:
+            held = set(self.held)
+        lost = set(resource for resource in held if not self.store.claim(resource, self.node, self.duration))
+        for resource in lost:
+            _log.error("Lease on %s was taken over by another node", resource)
+        with self.lock:
+            self.held -= lost
+
+    def start(self):
+
+        # Function used to renew the leases in a background thread until stop is called
+
+        if self.renewing is not None:
+            return
+        self.stopping.clear()
+        self.renewing = threading.Thread(target = self.__renew_loop, name = "uvsync-lease", daemon = True)
+        self.renewing.start()
+
+    def __renew_loop(self):
+
+        while not self.stopping.wait(self.duration / 3.0):
+            try:
+                self.renew()
+            except Exception as ex:
+                _log.error("Unable to renew leases: %s", ex, exc_info=True)
+
+    def stop(self, release = False):
+
+        # Function used to stop renewing the leases, and optionally to release them so other nodes can take over at once
+
+        self.stopping.set()
+        if self.renewing is not None:
+            self.renewing.join()
+            self.renewing = None
+        if release:
+            with self.lock:
+                held = self.held
+                self.held = set()
+            for resource in held | { NODE_PREFIX + self.node }:
+                try:
+                    self.store.release(resource, self.node)
+                except Exception as ex:
+                    _log.error("Unable to release lease on %s: %s", resource, ex)
+
+def station_resource(station_id):
+
+    return "station:%s" % station_id
+
+def default_node():
+
+    # The default name of a node is the host name, which stays the same between runs so a node keeps its stations.
+    # Several nodes on one host need their own names (see uvsync.py --node)
+
+    return socket.gethostname()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import os, re, time, sqlite3, locale
+from pathlib import Path
+from datetime import date, datetime
+
+class UVSyncLedger():
+
+    # Define a class used to remember how much of each UV log file has been ingested for a speciffic instrument.
+    # The ledger is a local SQLite file holding the byte offset and the date/time of the last row committed
+    # for each instrument and file, so growing daily files only have their new rows sent to the database.
+    # A new SQLite connection is opened for each call, so the ledger can be used from several threads and processes
+
+    def __init__(self, path):
+
+        # Constructor, create the ledger table if it doesn't exist already
+
+        self.path = str(path)
+        connection = self.__connect()
+        try:
+            connection.execute("""create table if not exists ingestion_ledger (
+                instrument_id integer not null,
+                file_name text not null,
+                byte_offset integer not null,
+                last_timestamp text,
+                updated text not null,
+                primary key (instrument_id, file_name))""")
+        finally:
+            connection.close()
+
+    def __connect(self):
+
+        return sqlite3.connect(self.path, timeout = 60)
+
+    def get_offset(self, ctx, file):
+
+        # Function used to get the byte offset up to which a file has been ingested, 0 if the file is new
+
+        connection = self.__connect()
+        try:
+            row = connection.execute("select byte_offset from ingestion_ledger where instrument_id = ? and file_name = ?",
+                (ctx.instrument_id, file.name)).fetchone()
+        finally:
+            connection.close()
+        return row[0] if row is not None else 0
+
+    def update(self, ctx, file, byte_offset, last_timestamp):
+
+        # Function used to record the byte offset and date/time of the last row committed for a file.
+        # Must only be called after the rows have been committed to the database
+
+        connection = self.__connect()
+        try:
+            with connection:
+                connection.execute("""insert into ingestion_ledger (instrument_id, file_name, byte_offset, last_timestamp, updated)
+                    values (?, ?, ?, ?, ?)
+                    on conflict (instrument_id, file_name) do update set
+                    byte_offset = excluded.byte_offset,
+                    last_timestamp = coalesce(excluded.last_timestamp, last_timestamp),
+                    updated = excluded.updated""",
+                    (ctx.instrument_id, file.name, byte_offset,
+                     last_timestamp.isoformat(sep = ' ') if last_timestamp is not None else None,
+                     datetime.now().isoformat(sep = ' ', timespec = 'seconds')))
+        finally:
+            connection.close()
+
+class UVSyncLedgerReader():
+
+    # Define a class used to read the lines of a UV log file opened in binary mode, starting at a byte offset.
+    # The header line is always returned first, so the file can be parsed as if it was read from the beginning.
+    # The offset member holds the position after the last complete line returned, which is where the next
+    # run should start. A partial last line, from a copy taken while the instrument was writing, is not returned,
+    # so a truncated row never reaches validate and store, and it is read again in full on the next run.
+    # If the file is complete, it will not grow any more (see may_grow), a last line without a line break is returned
+
+    def __init__(self, fd, offset, encoding = None, complete = False):
+
+        # Constructor, initialize all member variables
+
+        self.fd = fd
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.complete = complete
+
+        # Start from the beginning if the file is smaller than the offset, it has been replaced since the last run
+        size = os.fstat(fd.fileno()).st_size
+        self.start = offset if offset <= size else 0
+        self.offset = 0
+
+    def __iter__(self):
+
+        header = self.fd.readline()
+        if not header:
+            return
+        if header.endswith(b"\n") or self.complete:
+            self.offset = len(header)
+        yield header.decode(self.encoding)
+
+        if self.start > self.offset:
+            self.fd.seek(self.start)
+            self.offset = self.start
+
+        for line in self.fd:
+            if not line.endswith(b"\n") and not self.complete:
+                break
+            self.offset += len(line)
+            yield line.decode(self.encoding)
+
+def file_date(name):
+
+    # Function used to get the date of a UV log file from its name (GUV_<serial>_C_<yymmdd>.csv), None if the name has no date
+
+    match = re.search('GUV_[0-9]*_C_([0-9]{6})', name)
+    if match is None:
+        return None
+    try:
+        return datetime.strptime(match.group(1), "%y%m%d").date()
+    except ValueError:
+        return None
+
+def may_grow(file, now = None):
+
+    # Function used to check if the instrument may still write to a UV log file. Only the file of the current day
+    # grows, files of earlier days are deleted on the station once they are downloaded (see uvsync_ftp.py).
+    # A file without a date in the name may grow until it has not changed for a day
+
+    now = now or time.time()
+    day = file_date(Path(file).name)
+    if day is not None:
+        return day >= date.fromtimestamp(now)
+    return now - os.stat(file).st_mtime < 86400
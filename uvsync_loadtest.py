@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+# End-to-end load test with local FTP stations.
+#
+# For each scenario a local FTP server is started for each station, and synthetic GUV_*_C_yymmdd.csv files are
+# written to it. The stations and instruments are given to uvsync by a stand-in catalog (the fake pyodbc module of
+# uvsync_bench.py), and the full uvsync.main is run against the SQLite storage backend. A thread polls the SQLite
+# database, so the latency from the time a file is written on its FTP server until its rows are stored is found
+# for each file. Scenarios are all combinations of the station counts, file sizes and network delays given.
+# Results are saved as JSON like the benchmark, and can be compared against an earlier run.
+#
+# pyftpdlib is needed to run the FTP servers, it is not needed by uvsync itself.
+#
+# Example:
+#   python uvsync_loadtest.py --stations 1,8,32 --rows 1000,20000 --delay 0,0.05 --runs 3
+#   python uvsync_loadtest.py --stations 16 --bandwidth 256 --option download_workers=8 --baseline bench_results/<file>.json
+
+import sys, json, time, types, shutil, sqlite3, logging, argparse, tempfile, threading, configparser, itertools
+from datetime import datetime, timedelta
+from pathlib import Path
+from uvsync_format import get_format
+from uvsync_bench import FakeRecorder, install_fake_pyodbc, generate_file, file_name, create_instrument, compare
+
+# pyftpdlib is an optional dependency, only needed to run the load test
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    from pyftpdlib.ioloop import IOLoop
+except ImportError:
+    ThreadedFTPServer = None
+
+_log = logging.getLogger("uvsync")
+
+class UVSyncLoadTestException(Exception):
+
+    # Exception class used to report UVSyncLoadTest speciffic errors
+    pass
+
+class UVSyncLoadTestStation():
+
+    # Define a class used to run the FTP server of one station in a background thread.
+    # delay is added before the reply to each FTP command, like the round trip time of a slow network,
+    # and bandwidth limits the transfer rate of each file in bytes/sec (0 for no limit)
+
+    def __init__(self, station_id, directory, delay = 0.0, bandwidth = 0):
+
+        # Constructor, initialize all member variables and start the server on a free port
+
+        if ThreadedFTPServer is None:
+            raise UVSyncLoadTestException("pyftpdlib is required by the load test (pip install pyftpdlib)")
+
+        self.station_id = station_id
+        self.directory = Path(directory)
+        self.user = "station%d" % station_id
+        self.password = "loadtest"
+        self.directory.mkdir(parents = True, exist_ok = True)
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(self.user, self.password, str(self.directory), perm = "elrd")
+
+        class DelayedHandler(FTPHandler):
+
+            def process_command(self, cmd, *args, **kwargs):
+                if delay:
+                    time.sleep(delay)
+                return FTPHandler.process_command(self, cmd, *args, **kwargs)
+
+        DelayedHandler.authorizer = authorizer
+        if bandwidth:
+            DelayedHandler.dtp_handler = type("ThrottledHandler", (ThrottledDTPHandler,), { "write_limit": bandwidth })
+
+        # Each server has its own IOLoop, as the shared one is closed with the first server closed
+        self.server = ThreadedFTPServer(("127.0.0.1", 0), DelayedHandler, ioloop = IOLoop())
+        self.port = self.server.address[1]
+        self.thread = threading.Thread(target = self.server.serve_forever, kwargs = { "handle_exit": False },
+            name = "loadtest-ftp-%d" % station_id, daemon = True)
+        self.thread.start()
+
+    def row(self, inbox):
+
+        # Function used to create the station row as returned by select_station_infos
+
+        return types.SimpleNamespace(id = self.station_id, label = "load%d" % self.station_id, ftp_host = "127.0.0.1", ftp_port = self.port,
+            ftp_user = self.user, ftp_password = self.password, ftp_remote_dir = None, ftp_local_dir = str(inbox), ftp_passive_mode = 1)
+
+    def close(self):
+
+        self.server.close_all()
+        self.thread.join(5)
+
+class UVSyncLoadTestPoller():
+
+    # Define a class used to find the time the rows of each file are stored, by counting the rows of each instrument
+    # in the SQLite database every interval seconds. Each file expected holds the instrument, the row count the
+    # instrument reaches when the file is stored, and the time the file arrived on the FTP server
+
+    def __init__(self, database, interval = 0.05):
+
+        # Constructor, initialize all member variables
+
+        self.database = database
+        self.interval = interval
+        self.expected = []
+        self.stored = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def expect(self, instrument_id, count, arrived):
+
+        with self.lock:
+            self.expected.append((instrument_id, count, arrived))
+
+    def start(self):
+
+        self.stopping.clear()
+        self.thread = threading.Thread(target = self.__poll_loop, name = "loadtest-poll", daemon = True)
+        self.thread.start()
+
+    def __counts(self):
+
+        try:
+            connection = sqlite3.connect(str(self.database), timeout = 60)
+            try:
+                return dict(connection.execute("select instrument_id, count(*) from measurement group by instrument_id").fetchall())
+            finally:
+                connection.close()
+        except sqlite3.OperationalError:
+            # The database or the table has not been created yet
+            return {}
+
+    def poll(self):
+
+        # Function used to record the time of the files whose rows are all stored
+
+        now = time.time()
+        counts = self.__counts()
+        with self.lock:
+            for expected in self.expected:
+                if expected not in self.stored and counts.get(expected[0], 0) >= expected[1]:
+                    self.stored[expected] = now
+
+    def __poll_loop(self):
+
+        while not self.stopping.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+
+        # Function used to stop polling, with a last poll so rows stored at the end of the run are found
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.poll()
+
+    def latencies(self):
+
+        # Function used to get the latency of each stored file in seconds, and the number of files not stored
+
+        with self.lock:
+            latencies = sorted(self.stored[expected] - expected[2] for expected in self.expected if expected in self.stored)
+            return latencies, len(self.expected) - len(latencies)
+
+def stored_rows(fmt, rows):
+
+    # Function used to get the number of rows of a file from generate_file that are stored, as rows not accepted
+    # by the filter of the format are skipped
+
+    if fmt.filter_column is None:
+        return rows
+    values = len(fmt.filter_values) + 2
+    return sum(1 for n in range(rows) if n % values < len(fmt.filter_values))
+
+def percentile(values, fraction):
+
+    if not len(values):
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run_scenario(args, station_count, rows, delay):
+
+    # Function used to run uvsync.main args.runs times against station_count local FTP stations.
+    # Before each run one new file with the given number of rows is written to each station, the last one is a file of today
+
+    import uvsync
+
+    name = "%d stations, %d rows, %.3f s delay" % (station_count, rows, delay)
+    if args.bandwidth:
+        name += ", %d KB/sec" % args.bandwidth
+    fmt = get_format(args.format)
+    recorder = FakeRecorder()
+    install_fake_pyodbc(recorder)
+
+    root = Path(tempfile.mkdtemp(prefix = "uvsync_loadtest_"))
+    stations = []
+    try:
+        inbox = root / "uvsync" / "inbox"
+        database = root / "measurements.sqlite"
+        metrics_json = root / "metrics.json"
+
+        config = configparser.ConfigParser()
+        config["General"] = { "connection_string": "loadtest", "uvsync_directory": str(root / "uvsync"), "storage_backend": "sqlite",
+            "sqlite_database": str(database), "metrics_json": str(metrics_json), "log_level": "WARNING",
+            "ready_stable_seconds": "0" }
+        for option in args.option:
+            key, value = option.split("=", 1)
+            config["General"][key.strip()] = value.strip()
+        config_file = root / "config.ini"
+        with open(config_file, "w") as fd:
+            config.write(fd)
+
+        for station_id in range(1, station_count + 1):
+            station = UVSyncLoadTestStation(station_id, root / "ftp" / str(station_id), delay, args.bandwidth * 1024)
+            stations.append(station)
+            recorder.stations.append(station.row(inbox))
+            recorder.instruments.append(create_instrument(station_id, args.format, 1000 + station_id))
+
+        poller = UVSyncLoadTestPoller(database, args.poll)
+        today = datetime.combine(datetime.now().date(), datetime.min.time())
+        run_seconds = 0.0
+        ftp_seconds = 0.0
+        pipeline_seconds = 0.0
+        file_bytes = 0
+        errors = 0
+
+        poller.start()
+        try:
+            for run in range(args.runs):
+                day = today - timedelta(days = args.runs - 1 - run)
+                for station in stations:
+                    path = station.directory / file_name(1000 + station.station_id, day)
+                    generate_file(path, fmt, rows, day, seed = station.station_id * 1000 + run)
+                    file_bytes += path.stat().st_size
+                    poller.expect(station.station_id, stored_rows(fmt, rows) * (run + 1), time.time())
+
+                t0 = time.perf_counter()
+                status = uvsync.main(_log, config_file)
+                run_seconds += time.perf_counter() - t0
+                if status != uvsync.ExitStatus.Success:
+                    errors += 1
+
+                # Time spent by all download workers, and by all pipeline workers, from the report of the run
+                with open(metrics_json) as fd:
+                    report = json.load(fd)
+                ftp_seconds += sum(values["connect_seconds"] + values["list_seconds"] + values["transfer_seconds"]
+                    for values in report["stations"].values())
+                pipeline_seconds += sum(values.get("fetch_seconds", 0.0) + values.get("validate_seconds", 0.0) + values.get("store_seconds", 0.0)
+                    for values in report["instruments"].values())
+        finally:
+            poller.stop()
+
+        latencies, missing = poller.latencies()
+        total_rows = stored_rows(fmt, rows) * station_count * args.runs
+        result = { "name": name, "stations": station_count, "rows": total_rows, "rows_per_file": rows, "delay": delay,
+            "bandwidth": args.bandwidth, "runs": args.runs, "errors": errors, "files_missing": missing,
+            "seconds": run_seconds, "rows_per_sec": total_rows / run_seconds if run_seconds else None,
+            "bytes_per_sec": file_bytes / run_seconds if run_seconds else None,
+            "ftp_seconds": ftp_seconds, "pipeline_seconds": pipeline_seconds,
+            "latency_p50": percentile(latencies, 0.5), "latency_p95": percentile(latencies, 0.95),
+            "latency_max": latencies[-1] if len(latencies) else None }
+
+        print("%-40s %8.3f s/run %10.0f rows/sec %8.2f MB/sec   latency p50 %6.3f s p95 %6.3f s max %6.3f s%s" % (
+            name, run_seconds / args.runs, result["rows_per_sec"] or 0, (result["bytes_per_sec"] or 0) / 1e6,
+            result["latency_p50"] or 0, result["latency_p95"] or 0, result["latency_max"] or 0,
+            "   %d files not stored, %d runs failed" % (missing, errors) if missing or errors else ""))
+        return result
+
+    finally:
+        for station in stations:
+            station.close()
+        shutil.rmtree(root, ignore_errors = True)
+
+def run(args):
+
+    # Function used to run all scenarios, returns a list of results
+
+    results = []
+    for station_count, rows, delay in itertools.product(args.stations, args.rows, args.delay):
+        results.append(run_scenario(args, station_count, rows, delay))
+    return results
+
+def parse_list(type):
+
+    # Function used to parse a comma separated list of values given on the command line
+
+    return lambda text: [type(value) for value in text.split(",") if value.strip()]
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description = "Load test uvsync.main against local FTP stations")
+    parser.add_argument("--stations", type = parse_list(int), default = [1, 4, 16], help = "comma separated station counts (default: 1,4,16)")
+    parser.add_argument("--rows", type = parse_list(int), default = [10000], help = "comma separated number of rows in each file (default: 10000)")
+    parser.add_argument("--delay", type = parse_list(float), default = [0.0], help = "comma separated seconds added to each FTP command (default: 0)")
+    parser.add_argument("--bandwidth", type = int, default = 0, help = "transfer rate of each FTP server in KB/sec (default: no limit)")
+    parser.add_argument("--runs", type = int, default = 2, help = "number of runs of uvsync.main for each scenario, with one new file for each station before each run")
+    parser.add_argument("--format", default = "GUVis-3511", help = "file format of the instruments (default: GUVis-3511)")
+    parser.add_argument("--option", action = "append", default = [], help = "config.ini option for the [General] section, as key=value")
+    parser.add_argument("--poll", type = float, default = 0.05, help = "seconds between checks of the rows stored (default: 0.05)")
+    parser.add_argument("--output", help = "file to save the results to (default: bench_results/loadtest-<time>.json)")
+    parser.add_argument("--baseline", help = "saved results to compare against")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+
+    args = parse_args(sys.argv[1:])
+    logging.basicConfig(level = logging.WARNING)
+    logging.getLogger("pyftpdlib").setLevel(logging.WARNING)
+    try:
+        results = run(args)
+    except UVSyncLoadTestException as ex:
+        print(str(ex))
+        sys.exit(1)
+
+    output = Path(args.output) if args.output else Path(__file__).parent / "bench_results" / ("loadtest-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    output.parent.mkdir(parents = True, exist_ok = True)
+    with open(output, "w") as fd:
+        json.dump({ "time": datetime.now().isoformat(timespec = "seconds"), "arguments": vars(args), "results": results }, fd, indent = 1)
+    print("Results saved to %s" % output)
+
+    if args.baseline:
+        compare(results, args.baseline)
@@ -1,19 +1,61 @@
 # -*- coding: utf-8 -*-
 
-import logging
+import json, queue, atexit, logging, multiprocessing
 from pathlib import Path
-from logging.handlers import RotatingFileHandler
+from datetime import datetime
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# Format of each line in the text log
+LOG_FORMAT = '%(asctime)s [%(levelname)s](%(module)s:%(lineno)d) %(message)s'
+
+# Stages with their own log object and log level, like uvsync.store (see log_level_<stage> in config.ini)
+STAGES = ("download", "fetch", "validate", "store")
+
+# Handlers written by the writer thread of each log object created by create_log
+_handlers = {}
+
+class UVSyncLogException(Exception):
+
+    # Exception class used to report UVSyncLog speciffic errors
+    pass
+
+class _ThreadQueueHandler(QueueHandler):
+
+    # Handler used to pass log records to the writer thread. Records only reach the handler when their level is
+    # enabled, so records below the level are never formatted. The message is merged with its arguments here, on
+    # the calling thread, so arguments changed after the call are logged with the value they had when logged.
+    # The standard QueueHandler also formats the whole line and the exception here, that is left to the writer thread
+
+    def prepare(self, record):
+
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+class _JSONFormatter(logging.Formatter):
+
+    # Formatter used to write each log record as one JSON object per line
+
+    def format(self, record):
+
+        entry = { "time": datetime.fromtimestamp(record.created).isoformat(timespec = "milliseconds"), "level": record.levelname,
+                  "logger": record.name, "module": record.module, "line": record.lineno, "message": record.getMessage() }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
 
 def create_log(name):
     
     # Create a logger object and save the log file under %PUBLIC%\uvnet.
     # On Windows the %PUBLIC% system variable typically refers to "C:\Brukere\Felles".
     # Set up a rotating log so that a new log file is created after 1MB file size is reached, 
-    # and store up to 5 backup log files
+    # and store up to 5 backup log files.
+    # Records are passed through a queue to a writer thread, which writes them to the log file and the console,
+    # so logging never waits for the disk. The writer thread is stopped, and the queue emptied, when the program exits
     
     # Create log object
-    logfmt = '%(asctime)s [%(levelname)s](%(module)s:%(lineno)d) %(message)s'
-    logging.basicConfig(level=logging.INFO, format=logfmt)
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
     uvlogger = logging.getLogger(name)
 
     # Create logfile path
@@ -21,9 +63,85 @@ def create_log(name):
     logfile = name + ".log"
     logpath = script_dir / logfile    
 
-    # Create rotating log
+    # Create rotating log, and a console log replacing the console log of basicConfig
     handler = RotatingFileHandler(logpath, maxBytes=1000000, backupCount=5)
-    formatter = logging.Formatter(logfmt)
+    console = logging.StreamHandler()
+    formatter = logging.Formatter(LOG_FORMAT)
     handler.setFormatter(formatter)
-    uvlogger.addHandler(handler)    
+    console.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler, console, respect_handler_level = True)
+    listener.start()
+    atexit.register(listener.stop)
+    _handlers[name] = [handler, console]
+
+    uvlogger.addHandler(_ThreadQueueHandler(records))
+    uvlogger.propagate = False
+    return uvlogger
+
+def configure_log(name, options):
+
+    # Function used to apply the log settings in config.ini: log_format (text or json), log_level and
+    # log_level_<stage> for each of STAGES. Records below the level of a stage are dropped before the message is formatted
+
+    log_format = options.get('log_format', fallback = 'text')
+    if log_format not in ('text', 'json'):
+        raise UVSyncLogException("Invalid log_format in config file (%s)" % log_format)
+    formatter = _JSONFormatter() if log_format == 'json' else logging.Formatter(LOG_FORMAT)
+    for handler in _handlers.get(name, []):
+        handler.setFormatter(formatter)
+
+    logging.getLogger(name).setLevel(_level(options.get('log_level', fallback = 'INFO')))
+    for stage in STAGES:
+        level = options.get('log_level_' + stage, fallback = None)
+        logging.getLogger(name + "." + stage).setLevel(_level(level) if level else logging.NOTSET)
+
+def get_levels(name):
+
+    # Function used to get the levels set by configure_log, to set the same levels in worker processes
+
+    return dict((logger, logging.getLogger(logger).level) for logger in [name] + [name + "." + stage for stage in STAGES])
+
+def _level(name):
+
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise UVSyncLogException("Invalid log level in config file (%s)" % name)
+    return level
+
+class _LogForwarder(logging.Handler):
+
+    # Handler used to pass log records received from worker processes on to a log object in this process
+
+    def __init__(self, log):
+
+        super().__init__()
+        self.log = log
+
+    def emit(self, record):
+
+        self.log.handle(record)
+
+def create_worker_queue(log):
+
+    # Create a queue that worker processes can send log records through, and a listener
+    # that passes the records on to the handlers of the given log object in this process.
+    # The listener must be started before, and stopped after, the worker processes run
+
+    queue = multiprocessing.Queue()
+    listener = QueueListener(queue, _LogForwarder(log))
+    return queue, listener
+
+def init_worker_log(name, queue, levels = None):
+
+    # Set up the log object in a worker process so all records are sent to the parent process,
+    # with the levels of the parent process (see get_levels)
+
+    uvlogger = logging.getLogger(name)
+    uvlogger.setLevel(logging.INFO)
+    for logger, level in (levels or {}).items():
+        logging.getLogger(logger).setLevel(level)
+    uvlogger.handlers = [QueueHandler(queue)]
+    uvlogger.propagate = False
     return uvlogger
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import os, json, time, threading
+from pathlib import Path
+
+class UVSyncMetrics():
+
+    # Define a class used to collect per-stage timing and throughput for a run, and to write them
+    # as a JSON report and as a Prometheus textfile-collector file at the end of the run.
+    # Station metrics come from the UVSyncFTPResult of each download, instrument metrics from the
+    # metrics dictionary of each UVSyncContext, filled by the modules and by uvsync.run_context
+
+    def __init__(self):
+
+        # Constructor, initialize all member variables
+
+        self.started = time.time()
+        self.finished = None
+        self.status = None
+        self.stations = {}
+        self.instruments = {}
+        self.directories = {}
+        self.retry = {}
+        self.lock = threading.Lock()
+
+    def add_station(self, result):
+
+        # Function used to record the outcome of a download from a station
+
+        with self.lock:
+            self.stations[result.station_name] = {
+                "connect_seconds": result.connect_seconds,
+                "list_seconds": result.list_seconds,
+                "transfer_seconds": result.transfer_seconds,
+                "bytes": result.bytes_downloaded,
+                "files_downloaded": result.files_downloaded,
+                "files_skipped": result.files_skipped,
+                "files_failed": result.files_failed,
+                "error": str(result.error) if result.error is not None else None }
+
+    def add_instrument(self, ctx, metrics):
+
+        # Function used to record the counters and stage timings of an instrument
+
+        metrics = dict(metrics)
+        seconds = metrics.get("validate_seconds", 0.0) + metrics.get("store_seconds", 0.0)
+        metrics["rows_per_sec"] = metrics["rows_parsed"] / seconds if seconds else 0.0
+        metrics["instrument_id"] = ctx.instrument_id
+        metrics["station"] = ctx.station_name
+        with self.lock:
+            self.instruments[ctx.instrument_name] = metrics
+
+    def add_directory(self, name, index):
+
+        # Function used to record the number of files found in a directory by a UVSyncDirectoryIndex
+
+        with self.lock:
+            self.directories[name] = { "files": index.count, "unmatched": len(index.unmatched), "ambiguous": len(index.ambiguous) }
+
+    def add_retry(self, scan, retried):
+
+        # Function used to record the state of the failed directory, from a UVSyncRetryScan
+
+        with self.lock:
+            self.retry = { "due": sum(len(files) for files in scan.due.values()), "waiting": scan.waiting,
+                           "permanent": scan.permanent, "unknown": scan.unknown, "retried": retried }
+
+    def finish(self, status):
+
+        self.finished = time.time()
+        self.status = status
+
+    def report(self):
+
+        # Function used to get all metrics as a dictionary
+
+        finished = self.finished or time.time()
+        return {
+            "started": self.started,
+            "finished": finished,
+            "duration_seconds": finished - self.started,
+            "status": self.status,
+            "stations": self.stations,
+            "instruments": self.instruments,
+            "directories": self.directories,
+            "retry": self.retry }
+
+    def write_json(self, path):
+
+        _write_atomic(path, json.dumps(self.report(), indent = 1, sort_keys = True))
+
+    def write_prometheus(self, path):
+
+        # Function used to write the metrics in the Prometheus text format, for the node_exporter textfile collector
+
+        report = self.report()
+        lines = []
+
+        def metric(name, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s gauge" % name)
+            for labels, value in samples:
+                label_text = ",".join('%s="%s"' % (key, _escape(str(label))) for key, label in labels)
+                lines.append("%s{%s} %s" % (name, label_text, repr(float(value))) if label_text else "%s %s" % (name, repr(float(value))))
+
+        metric("uvsync_run_timestamp_seconds", "Time the last run finished", [((), report["finished"])])
+        metric("uvsync_run_duration_seconds", "Wall time of the last run", [((), report["duration_seconds"])])
+        metric("uvsync_run_status", "Exit status of the last run, 0 is success", [((), report["status"] or 0)])
+
+        stations = sorted(report["stations"].items())
+        for key, help in (("connect_seconds", "FTP connect and login time"), ("list_seconds", "FTP listing time"),
+                          ("transfer_seconds", "FTP transfer time"), ("bytes", "Bytes downloaded by FTP")):
+            metric("uvsync_ftp_" + key, help, [((("station", name),), values[key]) for name, values in stations])
+        metric("uvsync_ftp_files", "Files handled by FTP",
+            [((("station", name), ("state", state)), values["files_" + state]) for name, values in stations for state in ("downloaded", "skipped", "failed")])
+        metric("uvsync_ftp_up", "1 if the station could be reached", [((("station", name),), values["error"] is None) for name, values in stations])
+
+        metric("uvsync_directory_files", "Files found in the inbox and work directories, and files matching no instrument or several",
+            [((("directory", name), ("state", state)), values[state]) for name, values in sorted(report["directories"].items())
+                for state in ("files", "unmatched", "ambiguous")])
+
+        metric("uvsync_failed_files", "Files in the failed directory by retry state, and files retried in the last run",
+            [((("state", state),), value) for state, value in sorted(report["retry"].items())])
+
+        instruments = sorted(report["instruments"].items())
+        metric("uvsync_stage_seconds", "Wall time of each stage",
+            [((("instrument", name), ("station", values["station"]), ("stage", stage)), values.get(stage + "_seconds", 0.0))
+                for name, values in instruments for stage in ("fetch", "validate", "store")])
+        for key, help in (("rows_parsed", "Rows read from files"), ("rows_inserted", "Rows sent to the database"),
+                          ("rows_per_sec", "Rows read per second of validate and store time"),
+                          ("files_stored", "Files stored"), ("files_failed", "Files moved to the failed directory"),
+                          ("files_deferred", "Files left in the inbox because they were still being written")):
+            metric("uvsync_" + key, help, [((("instrument", name), ("station", values["station"])), values[key]) for name, values in instruments])
+
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+def _escape(value):
+
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _write_atomic(path, text):
+
+    # Write to a temporary file first, so readers never see a partial file
+
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as fd:
+        fd.write(text)
+    os.replace(tmp, path)
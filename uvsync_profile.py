@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import os, io, json, time, pstats, random, cProfile, logging, threading, itertools, tracemalloc, contextlib
+from pathlib import Path
+
+_log = logging.getLogger("uvsync")
+
+# Stages that are profiled, in the order they are reported
+STAGES = ("download", "fetch", "validate", "store")
+
+# Settings of the profiler of this process, None when profiling is off
+_settings = None
+
+# Number used to give each profile of this process its own file name
+_sequence = itertools.count()
+
+# Number of stages tracing allocations, tracemalloc only runs while a stage that is profiled runs
+_tracing = 0
+_tracing_lock = threading.Lock()
+
+class UVSyncProfileException(Exception):
+
+    # Exception class used to report UVSyncProfile speciffic errors
+    pass
+
+def enable(directory, sample_rate = 1.0, memory = False, top = 25):
+
+    # Function used to turn profiling on for this run (see uvsync.py --profile). The results are written to a
+    # new directory under directory for each run. Each download from a station and each fetch, validate and store
+    # of an instrument is profiled with probability sample_rate, so the overhead on a large run can be kept low.
+    # With memory, allocations are traced with tracemalloc while a stage that is profiled runs, which slows down
+    # the stage more than cProfile.
+    # Returns the directory of the run
+
+    global _settings
+
+    if not 0.0 < sample_rate <= 1.0:
+        raise UVSyncProfileException("Invalid profile sample rate (%s)" % sample_rate)
+
+    run_directory = Path(directory) / ("%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+    for stage in STAGES:
+        os.makedirs(run_directory / stage, exist_ok = True)
+    _settings = { "directory": str(run_directory), "sample_rate": sample_rate, "memory": memory, "top": top }
+    init_worker_profile(_settings)
+    return run_directory
+
+def get_settings():
+
+    # Function used to get the settings of the profiler, to turn profiling on in worker processes
+
+    return _settings
+
+def init_worker_profile(settings):
+
+    # Function used to turn profiling on in a worker process, with the settings of the parent process (see get_settings)
+
+    global _settings
+
+    _settings = settings
+
+def profile(stage, name):
+
+    # Function used to profile a stage for a station or instrument, used as a context manager.
+    # Does nothing when profiling is off or the stage is not sampled
+
+    if _settings is None or random.random() >= _settings["sample_rate"]:
+        return contextlib.nullcontext()
+    return _profile(stage, name)
+
+@contextlib.contextmanager
+def _profile(stage, name):
+
+    # Only one cProfile profiler can be active at a time on some Python versions, a stage that can't be profiled
+    # while another worker thread is profiled is run without profiling
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        yield
+        return
+    profiler.disable()
+
+    memory = _settings["memory"]
+    if memory:
+        _start_tracing()
+
+    t0 = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        seconds = time.perf_counter() - t0
+        try:
+            _save(profiler, stage, name, seconds, memory)
+        except Exception as ex:
+            _log.error("Unable to save profile of %s %s: %s", stage, name, ex)
+        finally:
+            if memory:
+                _stop_tracing()
+
+def _start_tracing():
+
+    global _tracing
+
+    with _tracing_lock:
+        if _tracing == 0:
+            tracemalloc.start()
+        _tracing += 1
+
+def _stop_tracing():
+
+    global _tracing
+
+    with _tracing_lock:
+        _tracing -= 1
+        if _tracing == 0:
+            tracemalloc.stop()
+
+def _save(profiler, stage, name, seconds, memory):
+
+    # Write the profile of a stage, and the memory use of the stage as JSON next to it.
+    # Only allocations made while tracing are traced, so the snapshot holds the allocations made by the stage that
+    # are still held at the end of it. With several worker threads, the peak and the snapshot include the other
+    # stages that are profiled at the same time
+
+    result = { "name": name, "seconds": seconds, "peak": None, "allocations": [] }
+    if memory:
+        result["peak"] = tracemalloc.get_traced_memory()[1]
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:_settings["top"]]:
+            frame = stat.traceback[0]
+            result["allocations"].append(["%s:%d" % (frame.filename, frame.lineno), stat.size, stat.count])
+
+    # The JSON file is written first, and the profile is renamed in place when complete, so merge never reads a
+    # profile that is partly written or without its JSON file
+    path = Path(_settings["directory"]) / stage / ("%s_%d_%d" % (_file_name(name), os.getpid(), next(_sequence)))
+    with open(str(path) + ".json", "w") as fd:
+        json.dump(result, fd)
+    profiler.dump_stats(str(path) + ".prof.tmp")
+    os.replace(str(path) + ".prof.tmp", str(path) + ".prof")
+
+def merge(log):
+
+    # Function used to merge the profiles of each station or instrument into one file for each stage, <stage>.prof,
+    # with the time and memory use in <stage>.json, and to write summary.txt with the functions using the most time
+    # and the largest allocations of each stage. Also merges the profiles written by worker processes.
+    # The daemon merges the profiles on each catalog refresh, so the profile directory does not grow while it runs
+
+    if _settings is None:
+        return
+    _merge(_settings)
+    log.info("Profiles written to %s", _settings["directory"])
+
+def finish(log):
+
+    # Function used to merge the profiles when the run is done (see merge). Profiling is turned off
+
+    global _settings
+
+    if _settings is None:
+        return
+    settings = _settings
+    _settings = None
+    _merge(settings)
+    log.info("Profiles written to %s", settings["directory"])
+
+def _merge(settings):
+
+    directory = Path(settings["directory"])
+    summary = io.StringIO()
+    for stage in STAGES:
+        merged = directory / (stage + ".prof")
+        totals_path = directory / (stage + ".json")
+        totals = { "count": 0, "seconds": 0.0, "peak_max": None, "peak_sum": 0, "peak_count": 0, "allocations": {} }
+        if totals_path.exists():
+            with totals_path.open() as fd:
+                totals = json.load(fd)
+
+        profiles = sorted((directory / stage).glob("*.prof"))
+        if len(profiles):
+            for path in profiles:
+                try:
+                    with path.with_suffix(".json").open() as fd:
+                        item = json.load(fd)
+                except (OSError, ValueError):
+                    continue
+                totals["count"] += 1
+                totals["seconds"] += item["seconds"]
+                if item["peak"] is not None:
+                    totals["peak_max"] = max(totals["peak_max"] or 0, item["peak"])
+                    totals["peak_sum"] += item["peak"]
+                    totals["peak_count"] += 1
+                for line, size, count in item["allocations"]:
+                    totals["allocations"][line] = max(totals["allocations"].get(line, 0), size)
+
+            # Add the profiles to the merged profile of earlier merges, and remove the profiles of each station or
+            # instrument. Only the largest allocations are kept
+            paths = [str(path) for path in profiles] + ([str(merged)] if merged.exists() else [])
+            pstats.Stats(*paths).dump_stats(str(merged) + ".tmp")
+            os.replace(str(merged) + ".tmp", str(merged))
+            totals["allocations"] = dict(sorted(totals["allocations"].items(), key = lambda item: -item[1])[:settings["top"]])
+            with open(str(totals_path) + ".tmp", "w") as fd:
+                json.dump(totals, fd)
+            os.replace(str(totals_path) + ".tmp", str(totals_path))
+            for path in profiles:
+                path.unlink()
+                if path.with_suffix(".json").exists():
+                    path.with_suffix(".json").unlink()
+
+        if not merged.exists():
+            continue
+        stats = pstats.Stats(str(merged), stream = summary)
+
+        summary.write("=" * 100 + "\n")
+        summary.write("%s: %d profiled, %.3f s\n" % (stage, totals["count"], totals["seconds"]))
+        summary.write("=" * 100 + "\n")
+        stats.sort_stats("tottime").print_stats(settings["top"])
+
+        if totals["peak_count"]:
+            summary.write("Peak memory: %.1f MB (largest), %.1f MB (mean)\n" % (totals["peak_max"] / 1e6, totals["peak_sum"] / totals["peak_count"] / 1e6))
+            summary.write("Largest allocations held at the end of the stage:\n")
+            for line, size in sorted(totals["allocations"].items(), key = lambda item: -item[1])[:settings["top"]]:
+                summary.write("%12.1f KB  %s\n" % (size / 1e3, line))
+            summary.write("\n")
+
+    with (directory / "summary.txt").open("w") as fd:
+        fd.write(summary.getvalue())
+
+def _file_name(name):
+
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in str(name))
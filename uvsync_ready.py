@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import os, json, time, logging, threading
+from pathlib import Path
+
+# The Win32 exclusive access check is only available with pywin32, and advisory locks only on POSIX
+try:
+    from win32file import CreateFile, CloseHandle
+    from win32con import GENERIC_READ, GENERIC_WRITE, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL
+except ImportError:
+    CreateFile = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_log = logging.getLogger("uvsync")
+
+# Files completely written by this process, with their size and modification time (see mark_written)
+_written = {}
+_written_lock = threading.Lock()
+
+class UVSyncReadyException(Exception):
+
+    # Exception class used to report UVSyncReadinessTracker speciffic errors
+    pass
+
+def has_exclusive_access(filename):
+
+    # Check if we have exclusive access to a file, using the Win32 API
+    try:
+        handle = CreateFile(str(filename), GENERIC_READ | GENERIC_WRITE, 0, None, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, None)
+        CloseHandle(handle)
+    except:
+        return False
+    return True
+
+def has_advisory_lock(filename):
+
+    # Check that no other process holds an advisory lock on a file, by taking and releasing an exclusive lock.
+    # Always True where the OS has no advisory locks
+    if fcntl is None:
+        return True
+    try:
+        with open(filename, "rb") as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    except OSError:
+        return False
+    return True
+
+def mark_written(file):
+
+    # Function used to record that this process has completely written a file, like a finished FTP download,
+    # so the file is ready as long as its size and modification time are unchanged
+
+    stat = os.stat(file)
+    with _written_lock:
+        _written[os.path.abspath(file)] = (stat.st_size, stat.st_mtime_ns)
+
+def get_written():
+
+    # Function used to get the files written by this process that are still unchanged, to pass them on to the
+    # contexts (see uvsync.run_contexts). Files that have been moved or changed are forgotten
+
+    with _written_lock:
+        for name, written in list(_written.items()):
+            try:
+                stat = os.stat(name)
+            except OSError:
+                del _written[name]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != written:
+                del _written[name]
+        return dict(_written)
+
+class UVSyncReadinessTracker():
+
+    # Define a class used to decide if a file in the inbox is completely written and can be moved to work.
+    #
+    #   exclusive   The file can be opened with exclusive access (Win32 only, the check used before)
+    #   stable      The size and modification time of the file have not changed for stable_seconds, and no
+    #               other process holds an advisory lock on it. Works on all platforms
+    #   auto        exclusive if pywin32 is installed, stable otherwise
+    #
+    # The size, modification time and state of each file are saved in a small JSON file between runs, so
+    # files are only opened for the lock check once their size and modification time have settled,
+    # and files found ready are not opened again. Files in written, completely written by this process
+    # (see get_written), are ready with both strategies as long as they are unchanged
+
+    def __init__(self, path, strategy = "auto", stable_seconds = 10.0, written = None):
+
+        # Constructor, load the saved state if it exists
+
+        if strategy == "auto":
+            strategy = "exclusive" if CreateFile is not None else "stable"
+        if strategy not in ("exclusive", "stable"):
+            raise UVSyncReadyException("Invalid ready_check " + str(strategy))
+        if strategy == "exclusive" and CreateFile is None:
+            raise UVSyncReadyException("ready_check exclusive requires pywin32")
+
+        self.path = Path(path)
+        self.strategy = strategy
+        self.stable_seconds = stable_seconds
+        self.written = written if written is not None else {}
+        self.entries = {}
+        if self.path.exists():
+            try:
+                with self.path.open() as fd:
+                    self.entries = json.load(fd)
+            except ValueError as ex:
+                _log.info("Ignoring invalid readiness state %s: %s", self.path, ex)
+
+    def is_ready(self, file):
+
+        # Function used to check if a file is ready to be moved
+
+        written = self.written.get(os.path.abspath(file))
+        if written is not None:
+            stat = os.stat(file)
+            if (stat.st_size, stat.st_mtime_ns) == tuple(written):
+                return True
+
+        if self.strategy == "exclusive":
+            return has_exclusive_access(file)
+
+        stat = os.stat(file)
+        now = time.time()
+        name = Path(file).name
+        entry = self.entries.get(name)
+
+        # A file seen for the first time counts as unchanged since its modification time,
+        # a file that changed since the last scan counts as unchanged from now
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            since = min(now, stat.st_mtime) if entry is None else now
+            entry = { "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "since": since, "ready": False }
+            self.entries[name] = entry
+
+        if not entry["ready"]:
+            if now - entry["since"] < self.stable_seconds:
+                return False
+            if not has_advisory_lock(file):
+                return False
+            entry["ready"] = True
+
+        return True
+
+    def remove(self, file):
+
+        # Function used to forget a file after it has been moved
+
+        self.entries.pop(Path(file).name, None)
+
+    def prune(self, files):
+
+        # Forget files that are no longer in the inbox
+
+        names = set(Path(file).name for file in files)
+        for name in list(self.entries):
+            if name not in names:
+                del self.entries[name]
+
+    def save(self):
+
+        # Write to a temporary file first so an interrupted run never leaves a truncated state file behind
+
+        if self.strategy == "exclusive":
+            return
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w") as fd:
+            json.dump(self.entries, fd, indent = 1, sort_keys = True)
+        os.replace(tmp, self.path)
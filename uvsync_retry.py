@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import os, csv, json, time, logging
+from pathlib import Path
+from shutil import move
+from uvsync_format import UVSyncFormatException
+from uvsync_columnar import UVSyncColumnarException
+
+_log = logging.getLogger("uvsync")
+
+# Suffix of the sidecar file written next to each file in the failed directory
+SIDECAR_SUFFIX = ".retry.json"
+
+# Exceptions raised for files that are invalid, and will fail the same way however often they are retried.
+# Modules add their own with register_permanent
+_permanent_exceptions = [ValueError, IndexError, UnicodeDecodeError, csv.Error, UVSyncFormatException, UVSyncColumnarException]
+
+class UVSyncRetryException(Exception):
+
+    # Exception class used to report UVSyncRetry speciffic errors
+    pass
+
+def register_permanent(exception_class):
+
+    # Function used to declare an exception class raised for files that are invalid for good
+
+    if exception_class not in _permanent_exceptions:
+        _permanent_exceptions.append(exception_class)
+    return exception_class
+
+def is_permanent(ex):
+
+    return isinstance(ex, tuple(_permanent_exceptions))
+
+def sidecar_path(file):
+
+    file = Path(file)
+    return file.with_name(file.name + SIDECAR_SUFFIX)
+
+def read_sidecar(file):
+
+    # Function used to read the sidecar of a file in the failed directory, None if it has none
+
+    path = sidecar_path(file)
+    if not path.exists():
+        return None
+    with path.open() as fd:
+        return json.load(fd)
+
+def _write_sidecar(file, sidecar):
+
+    path = sidecar_path(file)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as fd:
+        json.dump(sidecar, fd, indent = 1, sort_keys = True)
+    os.replace(tmp, path)
+
+def fail_file(ctx, file, stage, ex):
+
+    # Function used to move a file that could not be validated or stored to the failed directory, with a sidecar
+    # holding the cause and the number of attempts. Files that failed with a permanent exception, or that have
+    # failed ctx.retry_max_attempts times, are not retried. Others are retried after ctx.retry_backoff seconds,
+    # doubled for each attempt up to ctx.retry_backoff_max.
+    # The sidecar holds the size and modification time of the file, so a new file with the same name starts over
+
+    ctx.metrics["files_failed"] += 1
+    fout = ctx.directory_failed / file.name
+    _log.info("Storing failed file %s as %s", file, fout)
+    move(file, fout)
+
+    now = time.time()
+    stat = fout.stat()
+    sidecar = read_sidecar(fout)
+    if sidecar is not None and (sidecar.get("size", stat.st_size), sidecar.get("mtime_ns", stat.st_mtime_ns)) != (stat.st_size, stat.st_mtime_ns):
+        _log.info("File %s is not the file that failed before, starting over", fout.name)
+        sidecar = None
+    sidecar = sidecar or { "attempts": 0, "first_failed": now }
+    sidecar["attempts"] += 1
+    sidecar["size"] = stat.st_size
+    sidecar["mtime_ns"] = stat.st_mtime_ns
+    sidecar["instrument_id"] = ctx.instrument_id
+    sidecar["instrument_name"] = ctx.instrument_name
+    sidecar["stage"] = stage
+    sidecar["cause"] = "%s: %s" % (type(ex).__name__, str(ex))
+    sidecar["last_failed"] = now
+    sidecar["permanent"] = is_permanent(ex) or sidecar["attempts"] >= ctx.retry_max_attempts
+    sidecar["next_retry"] = None if sidecar["permanent"] else now + min(ctx.retry_backoff * 2 ** (sidecar["attempts"] - 1), ctx.retry_backoff_max)
+    _write_sidecar(fout, sidecar)
+
+    if sidecar["permanent"]:
+        _log.info("File %s will not be retried (%s, attempt %d)", fout.name, sidecar["cause"], sidecar["attempts"])
+    else:
+        _log.info("File %s will be retried in %.0f seconds (attempt %d)", fout.name, sidecar["next_retry"] - now, sidecar["attempts"])
+
+def clear_file(ctx, file):
+
+    # Function used to remove the sidecar of a retried file once it has been stored
+
+    path = sidecar_path(ctx.directory_failed / file.name)
+    if path.exists():
+        path.unlink()
+
+class UVSyncRetryScan():
+
+    # Define a class used to list the failed directory once and sort its files by their sidecars:
+    #
+    #   due         Files to retry now, by instrument id
+    #   waiting     Files to retry later, the earliest retry time is next_retry
+    #   permanent   Files that are invalid for good, or that have failed too many times
+    #   unknown     Files without a sidecar, moved to the failed directory by hand or before retries were added
+    #
+    # Sidecars left behind by files that have been retried and stored are removed
+
+    def __init__(self, directory_failed, directory_work, now = None):
+
+        # Constructor, list the directory and sort the files
+
+        now = time.time() if now is None else now
+        self.due = {}
+        self.waiting = 0
+        self.permanent = 0
+        self.unknown = 0
+        self.next_retry = None
+
+        with os.scandir(directory_failed) as entries:
+            names = set(entry.name for entry in entries if entry.is_file())
+
+        for name in sorted(names):
+            path = Path(directory_failed) / name
+            if name.endswith(SIDECAR_SUFFIX):
+                file = name[:-len(SIDECAR_SUFFIX)]
+                # A file being retried is in the work directory until it is stored or fails again
+                if file not in names and not (Path(directory_work) / file).exists():
+                    path.unlink()
+                continue
+            if name.endswith(".tmp"):
+                continue
+
+            sidecar = read_sidecar(path)
+            if sidecar is None:
+                self.unknown += 1
+            elif sidecar["permanent"]:
+                self.permanent += 1
+            elif sidecar["next_retry"] <= now:
+                self.due.setdefault(sidecar["instrument_id"], []).append(path)
+            else:
+                self.waiting += 1
+                self.next_retry = sidecar["next_retry"] if self.next_retry is None else min(self.next_retry, sidecar["next_retry"])
+
+def prepare_retries(log, sync_contexts, batch_size):
+
+    # Function used to move the files due for a retry back to the work directory, at most batch_size files
+    # per instrument. Returns the scan and the contexts to run, with ctx.work_files set to the files to retry
+
+    if not len(sync_contexts):
+        return None, []
+
+    scan = UVSyncRetryScan(sync_contexts[0].directory_failed, sync_contexts[0].directory_work)
+    contexts = []
+    for ctx in sync_contexts:
+        files = scan.due.get(ctx.instrument_id, [])[:batch_size]
+        if not len(files):
+            continue
+        ctx.inbox_files = []
+        ctx.work_files = []
+        for file in files:
+            fwork = ctx.directory_work / file.name
+            log.info("Retrying failed file %s for instrument %s", file.name, ctx.instrument_name)
+            move(file, fwork)
+            ctx.work_files.append(fwork)
+        contexts.append(ctx)
+
+    return scan, contexts
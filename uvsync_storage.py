@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import abc, sqlite3
+
+# Columns of a measurement, in the same order as the parameters of the insert_measurement2 procedure
+MEASUREMENT_COLUMNS = ["station_id", "instrument_id", "principal", "measurement_time"] + \
+    ["channel_%02d" % n for n in range(1, 21)] + ["aux_1", "aux_2"]
+
+# Columns of an aggregate of one channel over resolution seconds from bucket_time (see uvsync_aggregate.py)
+AGGREGATE_COLUMNS = ["station_id", "instrument_id", "resolution", "bucket_time", "channel", "count", "minimum", "mean", "maximum"]
+
+class UVSyncStorageException(Exception):
+
+    # Exception class used to report UVSyncStorage speciffic errors
+    pass
+
+class UVSyncStorage(abc.ABC):
+
+    # Define the interface used by the store modules to write measurements to a database.
+    # Each measurement is a tuple with the values listed in MEASUREMENT_COLUMNS.
+    # Several files can be stored in one transaction, with a savepoint around each file so a file
+    # that fails can be rolled back on its own. A backend missing any of the abstract methods
+    # fails when it is created, not in the middle of a transaction
+
+    @abc.abstractmethod
+    def load_measurements(self, rows):
+
+        # Insert or update a list of measurements
+        pass
+
+    @abc.abstractmethod
+    def load_aggregates(self, rows):
+
+        # Insert or update a list of aggregates, replacing the aggregates of the same buckets
+        pass
+
+    @abc.abstractmethod
+    def savepoint(self, name):
+
+        # Mark the start of a file within the current transaction
+        pass
+
+    @abc.abstractmethod
+    def rollback_to_savepoint(self, name):
+
+        # Discard any changes made since the savepoint was set
+        pass
+
+    def release_savepoint(self, name):
+
+        # Keep the changes made since the savepoint was set, as part of the current transaction
+        pass
+
+    def commit(self):
+
+        self.connection.commit()
+
+    def rollback(self):
+
+        self.connection.rollback()
+
+    def close(self):
+
+        self.connection.close()
+
+class UVSyncODBCStorage(UVSyncStorage):
+
+    # Storage backend that calls the insert_measurement2 procedure once for each measurement.
+    # The connection is borrowed from the connection manager (see uvsync_db.py) and returned when the storage is closed
+
+    def __init__(self, connections):
+
+        self.connections = connections
+        self.connection = connections.acquire()
+
+    def load_measurements(self, rows):
+
+        cursor = self.connection.cursor()
+        cursor.fast_executemany = True
+        cursor.executemany('exec insert_measurement2 ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?', rows)
+
+    def load_aggregates(self, rows):
+
+        # The aggregates are loaded into the #aggregate_staging temporary table, and upserted with the set-based
+        # insert_aggregates_staging procedure
+        cursor = self.connection.cursor()
+        cursor.execute("if object_id('tempdb..#aggregate_staging') is not null drop table #aggregate_staging; " +
+            "create table #aggregate_staging (station_id int, instrument_id int, resolution int, bucket_time datetime2(0), " +
+            "channel int, count int, minimum float, mean float, maximum float)")
+        cursor.fast_executemany = True
+        cursor.executemany("insert into #aggregate_staging (%s) values (%s)" % (
+            ", ".join(AGGREGATE_COLUMNS), ", ".join("?" * len(AGGREGATE_COLUMNS))), rows)
+        cursor.execute("exec insert_aggregates_staging")
+
+    def savepoint(self, name):
+
+        # With autocommit off the ODBC driver runs SQL Server with implicit transactions, where the first statement
+        # opens the transaction and commit ends it. A BEGIN TRANSACTION would nest a second transaction that commit
+        # leaves open, so no BEGIN is issued. SAVE TRANSACTION needs an open transaction and does not open one by itself,
+        # so a select from a table, which does, is run first if no transaction is open yet
+        self.connection.execute("if @@trancount = 0 select top 0 1 from sys.objects; save transaction %s" % name)
+
+    def rollback_to_savepoint(self, name):
+
+        self.connection.execute("rollback transaction %s" % name)
+
+    def close(self):
+
+        self.connections.release(self.connection)
+
+class UVSyncODBCBulkStorage(UVSyncODBCStorage):
+
+    # Storage backend that loads all measurements of a file into the #measurement_staging temporary table
+    # in one round trip, and then upserts them with the set-based insert_measurements_staging procedure
+
+    def load_measurements(self, rows):
+
+        cursor = self.connection.cursor()
+        cursor.execute("if object_id('tempdb..#measurement_staging') is not null drop table #measurement_staging; " +
+            "create table #measurement_staging (station_id int, instrument_id int, principal nvarchar(255), measurement_time datetime2(0), " +
+            ", ".join("%s varchar(32)" % column for column in MEASUREMENT_COLUMNS[4:]) + ")")
+        cursor.fast_executemany = True
+        cursor.executemany("insert into #measurement_staging (%s) values (%s)" % (
+            ", ".join(MEASUREMENT_COLUMNS), ", ".join("?" * len(MEASUREMENT_COLUMNS))), rows)
+        cursor.execute("exec insert_measurements_staging")
+
+class UVSyncSQLiteStorage(UVSyncStorage):
+
+    # Storage backend that stores measurements in a local SQLite database, used to test and benchmark
+    # the store modules without SQL Server. Measurements are loaded into a staging table and upserted
+    # with a single set-based statement, like the ODBC bulk backend
+
+    def __init__(self, path):
+
+        # Transactions are handled explicitly, so savepoints can be used inside them
+        self.connection = sqlite3.connect(str(path), timeout = 60, isolation_level = None)
+        self.connection.execute("create table if not exists measurement (" +
+            "station_id integer not null, instrument_id integer not null, principal text, measurement_time text not null, " +
+            ", ".join("%s real" % column for column in MEASUREMENT_COLUMNS[4:]) +
+            ", primary key (station_id, instrument_id, measurement_time))")
+        self.connection.execute("create temporary table if not exists measurement_staging (%s)" % ", ".join(MEASUREMENT_COLUMNS))
+        self.connection.execute("create table if not exists measurement_aggregate (" +
+            "station_id integer not null, instrument_id integer not null, resolution integer not null, bucket_time text not null, " +
+            "channel integer not null, count integer, minimum real, mean real, maximum real, " +
+            "primary key (station_id, instrument_id, resolution, bucket_time, channel))")
+
+    def __begin(self):
+
+        if not self.connection.in_transaction:
+            self.connection.execute("begin")
+
+    def load_measurements(self, rows):
+
+        self.__begin()
+        self.connection.execute("delete from measurement_staging")
+        self.connection.executemany("insert into measurement_staging values (%s)" % ", ".join("?" * len(MEASUREMENT_COLUMNS)),
+            ((row[0], row[1], row[2], row[3].isoformat(sep = ' ')) + tuple(row[4:]) for row in rows))
+        self.connection.execute("insert into measurement select * from measurement_staging where true " +
+            "on conflict (station_id, instrument_id, measurement_time) do update set " +
+            ", ".join("%s = excluded.%s" % (column, column) for column in MEASUREMENT_COLUMNS[2:3] + MEASUREMENT_COLUMNS[4:]))
+
+    def load_aggregates(self, rows):
+
+        self.__begin()
+        self.connection.executemany("insert or replace into measurement_aggregate values (%s)" % ", ".join("?" * len(AGGREGATE_COLUMNS)),
+            ((row[0], row[1], row[2], row[3].isoformat(sep = ' ')) + tuple(row[4:]) for row in rows))
+
+    def savepoint(self, name):
+
+        self.__begin()
+        self.connection.execute("savepoint %s" % name)
+
+    def rollback_to_savepoint(self, name):
+
+        self.connection.execute("rollback to %s" % name)
+        self.connection.execute("release %s" % name)
+
+    def release_savepoint(self, name):
+
+        self.connection.execute("release %s" % name)
+
+    def commit(self):
+
+        if self.connection.in_transaction:
+            self.connection.execute("commit")
+
+    def rollback(self):
+
+        if self.connection.in_transaction:
+            self.connection.execute("rollback")
+
+def create_storage(ctx, connections):
+
+    # Function used to create the storage backend selected with storage_backend in config.ini.
+    # The ODBC backends use connections from the connection manager (see uvsync_db.py)
+
+    if ctx.storage_backend == "odbc":
+        return UVSyncODBCStorage(connections)
+    if ctx.storage_backend == "odbc_bulk":
+        return UVSyncODBCBulkStorage(connections)
+    if ctx.storage_backend == "sqlite":
+        if not ctx.sqlite_database:
+            raise UVSyncStorageException("Missing sqlite_database for storage backend sqlite")
+        return UVSyncSQLiteStorage(ctx.sqlite_database)
+    raise UVSyncStorageException("Unknown storage backend " + str(ctx.storage_backend))
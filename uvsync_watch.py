@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import os, sys, time, select, struct, logging, ctypes, ctypes.util
+
+_log = logging.getLogger("uvsync")
+
+# inotify event flags, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+class UVSyncWatchException(Exception):
+
+    # Exception class used to report UVSyncWatcher speciffic errors
+    pass
+
+class UVSyncPollingWatcher():
+
+    # Define a class used to wait for new or changed files in a set of directories, by comparing the name,
+    # size and modification time of all files every poll_interval seconds. Works on all platforms
+
+    def __init__(self, directories, poll_interval = 5.0):
+
+        # Constructor, initialize all member variables and take the first snapshot
+
+        self.directories = [str(directory) for directory in directories]
+        self.poll_interval = poll_interval
+        self.snapshot = self.__scan()
+
+    def __scan(self):
+
+        snapshot = {}
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError as ex:
+                _log.error("Unable to scan directory %s: %s", directory, ex)
+        return snapshot
+
+    def wait(self, timeout):
+
+        # Function used to wait up to timeout seconds for new or changed files.
+        # Returns the set of file names that changed, empty if nothing changed
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return set()
+            time.sleep(min(self.poll_interval, remaining))
+
+            snapshot = self.__scan()
+            names = set(os.path.basename(path) for path, stat in snapshot.items() if self.snapshot.get(path) != stat)
+            self.snapshot = snapshot
+            if names:
+                return names
+
+    def close(self):
+        pass
+
+class UVSyncInotifyWatcher():
+
+    # Define a class used to wait for files that are closed after writing, or moved into a set of directories,
+    # using inotify on Linux. libc is called through ctypes, so no extra packages are needed
+
+    def __init__(self, directories):
+
+        # Constructor, create the inotify instance and add a watch for each directory
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        for directory in directories:
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, "inotify_add_watch failed for " + str(directory))
+
+    def wait(self, timeout):
+
+        # Function used to wait up to timeout seconds for new or changed files.
+        # Returns the set of file names that changed, empty if nothing changed, or None if the
+        # kernel queue overflowed and any file may have changed
+
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not ready:
+            return set()
+
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            # Each event is a struct inotify_event followed by a null padded file name
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                offset += 16
+                if mask & IN_Q_OVERFLOW:
+                    names = None
+                elif names is not None and length:
+                    names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+                offset += length
+        return names
+
+    def close(self):
+
+        os.close(self.fd)
+
+def create_watcher(directories, watcher = "auto", poll_interval = 5.0):
+
+    # Function used to create the watcher given by the daemon_watcher option in config.ini.
+    # With auto, inotify is used on Linux and polling is used on other platforms or if inotify fails
+
+    if watcher not in ("auto", "inotify", "poll"):
+        raise UVSyncWatchException("Invalid watcher " + str(watcher))
+
+    if watcher == "inotify" or (watcher == "auto" and sys.platform.startswith("linux")):
+        try:
+            return UVSyncInotifyWatcher(directories)
+        except (OSError, AttributeError) as ex:
+            if watcher == "inotify":
+                raise UVSyncWatchException("Unable to use inotify: " + str(ex))
+            _log.info("Unable to use inotify, polling every %.1f seconds instead: %s", poll_interval, ex)
+
+    return UVSyncPollingWatcher(directories, poll_interval)